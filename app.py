@@ -9,23 +9,156 @@ import hashlib
 import random
 import string
 import io
+import itertools
 import base64
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context, session, make_response, send_from_directory
+import bisect
+import codecs
+import cProfile
+import logging
+import gzip
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context, session, make_response, send_from_directory, g, got_request_exception
+from flask.logging import default_handler
+from werkzeug.exceptions import RequestEntityTooLarge
 import secrets
 
+try:
+    import fcntl  # POSIX advisory locks so gunicorn workers don't clobber each other's writes
+except ImportError:  # Windows dev machines only get in-process locking
+    fcntl = None
+
+try:
+    import redis  # Optional: shared /chat -> /stream context store across hosts
+except ImportError:
+    redis = None
+
+try:
+    import zstandard  # Optional: smaller and faster than gzip for stored histories
+except ImportError:
+    zstandard = None
+
+try:
+    import pillow_avif  # Optional: registers an AVIF encoder with Pillow for image variants
+except ImportError:
+    pillow_avif = None
+
 # Import configuration
 from config import (
     VENICE_API_KEY, VENICE_URL, VENICE_IMAGE_URL, DEFAULT_MODEL_ID, DEFAULT_IMAGE_MODEL_ID, 
     CHAT_DIR, MAX_HISTORY_SIZE, AVAILABLE_MODELS, AVAILABLE_IMAGE_MODELS,
+    HISTORY_COMPRESSION, HISTORY_COMPRESSION_LEVEL, HISTORY_CACHE_MAX_ENTRIES, HISTORY_CACHE_MAX_BYTES,
+    HISTORY_RETENTION_HOURS, RETENTION_SWEEP_INTERVAL_SECONDS, RETENTION_SWEEP_BATCH_SIZE,
+    CLIENT_CONTEXT_TTL_SECONDS, CLIENT_CONTEXT_MAX_ENTRIES, CLIENT_CONTEXT_MAX_BYTES,
+    CLIENT_CONTEXT_STORE, CLIENT_CONTEXT_SQLITE_PATH, CLIENT_CONTEXT_REDIS_URL,
+    CLIENT_CONTEXT_MAX_MESSAGES, ROLLING_CONTEXT_TTL_SECONDS,
+    MAX_REQUEST_BODY_BYTES, ROUTE_BODY_LIMITS, UPDATE_STREAM_KEEPALIVE_SECONDS,
+    IMAGE_DIR, IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_FORMATS, IMAGE_VARIANT_QUALITY,
+    IMAGE_PLACEHOLDER_WIDTH, IMAGE_PIPELINE_WORKERS, IMAGE_COMPRESS_WORKERS, IMAGE_COMPRESS_MAX_PENDING,
+    IMAGE_COMPRESS_WAIT_SECONDS, IMAGE_COMPRESS_BATCH_MAX_IMAGES, IMAGE_BINARY_TRANSFER, IMAGE_MAX_BYTES,
+    IMAGE_PREVIEW_ENABLED, IMAGE_PREVIEW_SETTINGS, IMAGE_DEDUP_ENABLED, IMAGE_DEDUP_MAX_DISTANCE, UPDATE_STREAM_MAX_SECONDS,
+    METRICS_ENABLED, METRICS_DIR, METRICS_SNAPSHOT_SECONDS, METRICS_TOKEN, METRICS_PUBLIC, STREAM_TIMING_IN_DONE,
+    LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES, ADMIN_TOKEN, PROFILE_SAMPLE_RATE, PROFILE_MODE, PROFILE_INTERVAL_MS,
+    PROFILE_DIR, PROFILE_MAX_FILES, PROFILE_MAX_BYTES, PROFILE_MAX_CONCURRENT,
+    USAGE_STORE, USAGE_SQLITE_PATH, USAGE_RETENTION_SECONDS, USER_TOKEN_BUDGET_PER_HOUR, USER_COST_BUDGET_PER_DAY,
+    GLOBAL_COST_BUDGET_PER_DAY, UPSTREAM_MAX_STREAMS, UPSTREAM_TOKENS_PER_MINUTE, ADMISSION_OUTPUT_TOKEN_ESTIMATE,
+    ADMISSION_MAX_WAIT_SECONDS, ADMISSION_MAX_QUEUED, ADMISSION_HEARTBEAT_SECONDS, JOBS_MAX_ACTIVE, JOBS_MAX_PER_USER,
+    JOBS_MAX_PER_GAME, JOBS_MAX_QUEUED, JOBS_MAX_QUEUED_PER_USER, JOBS_MAX_WAIT_SECONDS, JOBS_DEFAULT_SECONDS,
+    SECRET_KEY, SECRET_KEY_FILE,
     SYSTEM_PROMPT_BASE, MULTIPLAYER_PROMPT_ADDITION, SINGLEPLAYER_PROMPT_ADDITION, PROMPT_ENDING
 )
+# Process-pool workers: a module of their own so spawned pool processes don't import (and start) the app
+from image_workers import compress_image_bytes, render_image_variants
+
+class RouteLimitedRequest(Request):
+    """Request whose body limit is its route's entry in ROUTE_BODY_LIMITS (else MAX_REQUEST_BODY_BYTES)"""
+    
+    @property
+    def max_content_length(self):
+        # Werkzeug applies this while the body is read, so chunked bodies with no Content-Length are held to it too
+        return ROUTE_BODY_LIMITS.get(self.endpoint, MAX_REQUEST_BODY_BYTES)
 
 app = Flask(__name__, static_folder='static')
-app.secret_key = os.urandom(24)  # Required for session
+app.request_class = RouteLimitedRequest
+
+def load_secret_key():
+    """Session signing key shared by all workers: AIDM_SECRET_KEY, else a key generated once into SECRET_KEY_FILE"""
+    if SECRET_KEY:
+        return SECRET_KEY
+    key_dir = os.path.dirname(os.path.abspath(SECRET_KEY_FILE))
+    os.makedirs(key_dir, exist_ok=True)
+    try:
+        with open(SECRET_KEY_FILE, 'rb') as key_file:
+            key = key_file.read()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+    # Workers started without preload may race here: link() only succeeds for the first, the rest read its key
+    fd, tmp_path = tempfile.mkstemp(dir=key_dir, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(secrets.token_hex(32).encode('ascii'))
+        try:
+            os.link(tmp_path, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    with open(SECRET_KEY_FILE, 'rb') as key_file:
+        return key_file.read()
+
+app.secret_key = load_secret_key()  # Required for session
+# Largest route limit, for code that reads the config; requests are held to their own route's limit (RouteLimitedRequest)
+app.config['MAX_CONTENT_LENGTH'] = max([MAX_REQUEST_BODY_BYTES] + list(ROUTE_BODY_LIMITS.values()))
+
+class StructuredLogFormatter(logging.Formatter):
+    """
+    One JSON object per log line. Records from log_event() carry their event name and fields;
+    plain app.logger calls are wrapped as {"message": ...} so every line parses the same way.
+    """
+    
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name}
+        if hasattr(record, 'event'):
+            entry["event"] = record.event
+            entry.update(record.fields)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def log_event(level, event, **fields):
+    """
+    Structured log event that costs nothing when discarded: the level is checked and the event
+    sampled (LOG_SAMPLE_RATES) before any field is touched, and callable field values are only
+    called once the event will really be written - pass `lambda: len(json.dumps(payload))`.
+    """
+    if not app.logger.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE_RATES.get(event, 1.0)
+    if rate < 1.0:
+        if random.random() >= rate:
+            return
+        fields["sample_rate"] = rate
+    fields = {key: value() if callable(value) else value for key, value in fields.items()}
+    app.logger.log(level, "%s %s", event, json.dumps(fields, default=str), extra={"event": event, "fields": fields})
+
+if LOG_LEVEL:
+    app.logger.setLevel(LOG_LEVEL.upper())
+if LOG_FORMAT == 'json':
+    default_handler.setFormatter(StructuredLogFormatter())
 
 # Create a directory to store user chat histories
 if not os.path.exists(CHAT_DIR):
     os.makedirs(CHAT_DIR)
+os.makedirs(IMAGE_DIR, exist_ok=True)
 
 # Validate API key
 if not VENICE_API_KEY:
@@ -58,10 +191,263 @@ def load_chat_history(user_id, game_id=None):
     # Hybrid mode - load from server as before
     file_path = get_chat_file_path(user_id, game_id)
     if os.path.exists(file_path):
-        with open(file_path, 'r') as file:
-            return json.load(file)
+        return read_history_cached(file_path)
     return []
 
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def encode_history(chat_history, compression=None, level=None):
+    """Serialize a history to bytes in the configured at-rest format"""
+    compression = HISTORY_COMPRESSION if compression is None else compression
+    level = HISTORY_COMPRESSION_LEVEL if level is None else level
+    raw = json.dumps(chat_history).encode('utf-8')
+    
+    if compression == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=level if level is not None else 3).compress(raw)
+        app.logger.warning("HISTORY_COMPRESSION is 'zstd' but zstandard is not installed, using gzip")
+        compression = 'gzip'
+        level = None
+    if compression == 'gzip':
+        return gzip.compress(raw, compresslevel=level if level is not None else 6, mtime=0)
+    return raw
+
+def decompress_history(data):
+    """Return the raw JSON bytes of stored history, detecting gzip or zstd from the magic bytes"""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if data[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("History file is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=0)
+    return data
+
+def decode_history(data):
+    """Parse stored history bytes in plain JSON, gzip or zstd format"""
+    return json.loads(decompress_history(data))
+
+def read_history_file(file_path):
+    """Read and parse a stored history file in whatever format it was written"""
+    with open(file_path, 'rb') as file:
+        return decode_history(file.read())
+
+def history_file_signature(file_path):
+    """Identity of a history file's current contents - atomic replace always changes the inode"""
+    stat = os.stat(file_path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+class HistoryCache:
+    """
+    Bounded per-worker LRU of parsed history files.
+    Entries are checked against the file signature on every lookup, so writes made by
+    other workers are never served stale; this worker's writes invalidate explicitly.
+    """
+    
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file path -> (signature, history, size in bytes)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, file_path, signature):
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(file_path)
+            self.misses += 1
+            return None
+    
+    def put(self, file_path, signature, history, size_bytes):
+        if size_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if file_path in self._entries:
+                self._remove(file_path)
+            self._entries[file_path] = (signature, history, size_bytes)
+            self._bytes += size_bytes
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def invalidate(self, file_path):
+        with self._lock:
+            if file_path in self._entries:
+                self._remove(file_path)
+    
+    def _remove(self, file_path):
+        _, _, size_bytes = self._entries.pop(file_path)
+        self._bytes -= size_bytes
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "size_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+HISTORY_CACHE = HistoryCache(HISTORY_CACHE_MAX_ENTRIES, HISTORY_CACHE_MAX_BYTES)
+
+def read_history_cached(file_path):
+    """
+    Parsed history for a file, served from HISTORY_CACHE while the file is unchanged.
+    Returns a fresh list each call so callers can append without touching the cache;
+    the message dicts are shared and must be treated as read-only.
+    """
+    try:
+        signature = history_file_signature(file_path)
+    except OSError:
+        HISTORY_CACHE.invalidate(file_path)
+        raise
+    
+    started = time.perf_counter()
+    chat_history = HISTORY_CACHE.get(file_path, signature)
+    cache = 'hit'
+    if chat_history is None:
+        cache = 'miss'
+        with open(file_path, 'rb') as file:
+            raw = decompress_history(file.read())
+        chat_history = json.loads(raw)
+        HISTORY_CACHE.put(file_path, signature, chat_history, len(raw))
+    METRICS.observe('aidm_history_io_seconds', time.perf_counter() - started, op='load', cache=cache)
+    return list(chat_history)
+
+def remove_chat_file(file_path):
+    """Delete a stored history file and drop it from this worker's cache"""
+    HISTORY_CACHE.invalidate(file_path)
+    os.remove(file_path)
+
+# Per-game lock files live in a hidden subdirectory so they never match chat_history_* listings
+HISTORY_LOCK_DIR = os.path.join(CHAT_DIR, '.locks')
+if not os.path.exists(HISTORY_LOCK_DIR):
+    os.makedirs(HISTORY_LOCK_DIR, exist_ok=True)
+
+# Striped in-process locks - flock only coordinates between processes, not threads sharing a worker
+_HISTORY_THREAD_LOCKS = [threading.Lock() for _ in range(64)]
+
+@contextmanager
+def chat_history_lock(user_id, game_id=None):
+    """Hold an exclusive per-game lock (across threads and worker processes) while the block runs"""
+    file_path = get_chat_file_path(user_id, game_id)
+    lock_name = os.path.basename(file_path) + '.lock'
+    thread_lock = _HISTORY_THREAD_LOCKS[hash(lock_name) % len(_HISTORY_THREAD_LOCKS)]
+    
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        
+        with open(os.path.join(HISTORY_LOCK_DIR, lock_name), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def write_file_atomic(file_path, data):
+    """Write bytes to a temp file in the same directory, then rename it over the target.
+    Readers only ever see the old file or the complete new one, never a half-written file."""
+    dir_name = os.path.dirname(file_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=dir_name)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class GameUpdateHub:
+    """
+    Wakes /subscribe_updates listeners when a game's stored history changes.
+    Only games with at least one listener hold any state, so idle games cost nothing.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._games = {}  # chat file path -> {'condition', 'history', 'version', 'subscribers'}
+    
+    def subscribe(self, file_path):
+        with self._lock:
+            state = self._games.get(file_path)
+            if state is None:
+                state = {'condition': threading.Condition(), 'history': None, 'version': 0, 'subscribers': 0}
+                self._games[file_path] = state
+            state['subscribers'] += 1
+            return state
+    
+    def unsubscribe(self, file_path):
+        with self._lock:
+            state = self._games.get(file_path)
+            if state is None:
+                return
+            state['subscribers'] -= 1
+            if state['subscribers'] <= 0:
+                del self._games[file_path]
+    
+    def publish(self, file_path, chat_history):
+        """
+        Hand the freshly written history to waiting listeners (no-op when nobody listens).
+        Pass None when the history isn't in memory; listeners then re-read the file.
+        """
+        with self._lock:
+            state = self._games.get(file_path)
+        if state is None:
+            return
+        with state['condition']:
+            state['history'] = list(chat_history) if chat_history is not None else None
+            state['version'] += 1
+            state['condition'].notify_all()
+    
+    def wake_all(self):
+        """Wake every listener without a new version (used when the worker shuts down)"""
+        with self._lock:
+            states = list(self._games.values())
+        for state in states:
+            with state['condition']:
+                state['condition'].notify_all()
+
+GAME_UPDATES = GameUpdateHub()
+
+# Set when the server asks this worker to stop (see gunicorn.conf.py): update streams end so their
+# clients reconnect to a live worker, /healthz turns 503, and turns already in flight run to completion
+DRAINING = threading.Event()
+
+def begin_drain():
+    """Start a graceful shutdown of this worker; safe to call more than once"""
+    if DRAINING.is_set():
+        return
+    DRAINING.set()
+    jobs = JOB_SLOTS.stats()
+    app.logger.info(f"Worker {os.getpid()} draining: {sum(jobs['running'].values())} jobs running, "
+                    f"{sum(jobs['queued'].values())} queued")
+    GAME_UPDATES.wake_all()
+    try:
+        METRICS.maybe_write_snapshot(force=True)
+    except OSError as e:
+        app.logger.warning(f"Could not write metrics snapshot: {str(e)}")
+
 def save_chat_history(user_id, chat_history, game_id=None):
     """Save chat history - respects storage mode preference"""
     storage_mode = session.get('storage_mode', 'client-only')
@@ -73,8 +459,718 @@ def save_chat_history(user_id, chat_history, game_id=None):
     
     # Hybrid mode - save to server as before
     file_path = get_chat_file_path(user_id, game_id)
-    with open(file_path, 'w') as file:
-        json.dump(chat_history, file)
+    with METRICS.time('aidm_history_io_seconds', op='save', cache='none'), chat_history_lock(user_id, game_id):
+        write_file_atomic(file_path, encode_history(chat_history))
+        HISTORY_CACHE.invalidate(file_path)
+    GAME_UPDATES.publish(file_path, chat_history)
+
+def update_chat_history(user_id, update_fn, game_id=None):
+    """
+    Read-modify-write the stored history under the per-game lock.
+    update_fn receives the freshly loaded history list and mutates it in place;
+    its return value is passed back to the caller. Returning None means nothing
+    changed, so the file is not rewritten and no update is published.
+    """
+    storage_mode = session.get('storage_mode', 'client-only')
+    
+    # In client-only mode there is nothing stored to protect - run against an empty history
+    if storage_mode == 'client-only':
+        return update_fn([])
+    
+    file_path = get_chat_file_path(user_id, game_id)
+    # Timed including the lock wait, which is where concurrent writers to one game show up
+    with METRICS.time('aidm_history_io_seconds', op='update', cache='none'), chat_history_lock(user_id, game_id):
+        # Always read from disk here - update_fn mutates message dicts the cache may share
+        chat_history = read_history_file(file_path) if os.path.exists(file_path) else []
+        result = update_fn(chat_history)
+        if result is None:
+            return None
+        write_file_atomic(file_path, encode_history(chat_history))
+        HISTORY_CACHE.invalidate(file_path)
+    GAME_UPDATES.publish(file_path, chat_history)
+    return result
+
+def append_chat_message(user_id, message, game_id=None):
+    """Append one message to stored history without losing messages appended concurrently"""
+    def append(chat_history):
+        chat_history.append(message)
+        return len(chat_history)
+    
+    update_chat_history(user_id, append, game_id)
+
+class RetentionSweeper:
+    """
+    Background thread that deletes stored histories older than HISTORY_RETENTION_HOURS
+    and carries out privacy purges queued by request handlers, so no handler waits on
+    file deletion. Each worker runs its own thread; the periodic sweep takes a non-blocking
+    flock so only one worker walks the directory per interval.
+    """
+    
+    def __init__(self, retention_hours, interval, batch_size):
+        self.retention_hours = retention_hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending_purges = []  # (user_id, file names to keep)
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.files_expired = 0
+        self.files_purged = 0
+        self.last_sweep = None
+    
+    def ensure_running(self):
+        """Start the thread in this process - threads don't survive a pre-fork server's fork"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='retention-sweeper', daemon=True)
+            self._thread.start()
+    
+    def schedule_purge(self, user_id, keep_files=()):
+        """Queue deletion of every stored history for a user except keep_files"""
+        with self._lock:
+            self._pending_purges.append((user_id, set(keep_files)))
+        self.ensure_running()
+        self._wake.set()
+    
+    def _run(self):
+        next_sweep = time.time()
+        while True:
+            self._wake.wait(timeout=max(0, next_sweep - time.time()))
+            self._wake.clear()
+            try:
+                self._process_purges()
+                if time.time() >= next_sweep:
+                    self._sweep_expired()
+                    next_sweep = time.time() + self.interval
+            except Exception as e:
+                app.logger.error(f"Retention sweeper error: {str(e)}")
+    
+    def _delete_in_batches(self, file_paths):
+        deleted = 0
+        for i, file_path in enumerate(file_paths, start=1):
+            try:
+                remove_chat_file(file_path)
+                deleted += 1
+            except FileNotFoundError:
+                pass  # Already removed by another worker
+            except OSError as e:
+                app.logger.error(f"Error deleting {os.path.basename(file_path)}: {str(e)}")
+            if i % self.batch_size == 0:
+                time.sleep(0.05)
+        return deleted
+    
+    def _process_purges(self):
+        with self._lock:
+            purges, self._pending_purges = self._pending_purges, []
+        for user_id, keep_files in purges:
+            prefix = f"chat_history_{user_id}_"
+            file_paths = [os.path.join(CHAT_DIR, f) for f in os.listdir(CHAT_DIR)
+                          if f.startswith(prefix) and f not in keep_files]
+            # The user's generated images go too: none of them belong to the game being kept
+            file_paths += [os.path.join(IMAGE_DIR, f) for f in os.listdir(IMAGE_DIR) if f.startswith(f"{user_id}_")]
+            deleted = self._delete_in_batches(file_paths)
+            self.files_purged += deleted
+            app.logger.info(f"Privacy cleanup: Deleted {deleted} chat history and image files for user {user_id}")
+    
+    def _sweep_expired(self):
+        if not self.retention_hours:
+            return
+        
+        lock_file = open(os.path.join(HISTORY_LOCK_DIR, 'retention_sweep.lock'), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # Another worker is sweeping
+            
+            now = time.time()
+            cutoff = now - self.retention_hours * 3600
+            expired = []
+            image_groups = {}  # Image prefix -> (files, newest mtime)
+            for directory in (CHAT_DIR, IMAGE_DIR):
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if not entry.is_file():
+                            continue
+                        mtime = entry.stat().st_mtime
+                        if entry.name.startswith('.tmp_'):
+                            if mtime < now - 3600:
+                                expired.append(entry.path)  # Left behind by a write that crashed mid-way
+                        elif directory == IMAGE_DIR:
+                            # An image goes with its variants and sidecars, and stays while a near-duplicate
+                            # sharing it is still fresh, so no alias or hash is left pointing at a deleted file
+                            group = image_file_group(entry.path)
+                            files, newest = image_groups.get(group, ([], 0))
+                            files.append(entry.path)
+                            image_groups[group] = (files, max(newest, mtime))
+                        elif entry.name.startswith('chat_history_') and mtime < cutoff:
+                            expired.append(entry.path)
+            expired += [file_path for files, newest in image_groups.values() if newest < cutoff for file_path in files]
+            
+            deleted = self._delete_in_batches(expired)
+            self.files_expired += deleted
+            self.last_sweep = now
+            if deleted:
+                app.logger.info(f"Retention sweep: Deleted {deleted} files older than {self.retention_hours} hours")
+        finally:
+            lock_file.close()
+
+RETENTION_SWEEPER = RetentionSweeper(HISTORY_RETENTION_HOURS, RETENTION_SWEEP_INTERVAL_SECONDS, RETENTION_SWEEP_BATCH_SIZE)
+
+@app.before_request
+def start_background_workers():
+    RETENTION_SWEEPER.ensure_running()
+
+# Routes that parse their body incrementally from request.stream; the read itself raises 413 past the limit
+STREAMED_BODY_ENDPOINTS = {'import_history', 'compress_images'}
+
+@app.before_request
+def enforce_body_limit():
+    """Reject oversized bodies before anything parses them"""
+    limit = request.max_content_length
+    if request.content_length is not None and request.content_length > limit:
+        app.logger.warning(f"Rejected {request.content_length} byte body for {request.endpoint} (limit {limit})")
+        return jsonify({"success": False, "error": "Request body too large", "limit_bytes": limit}), 413
+    if request.content_length is None and 'Transfer-Encoding' in request.headers and request.endpoint not in STREAMED_BODY_ENDPOINTS:
+        # Chunked body: read it here, so a 413 isn't swallowed by a view's except block. The request
+        # stream stops at the limit; one more byte left in the server's input means the body is over it
+        try:
+            too_large = len(request.get_data(cache=True)) >= limit and request.environ['wsgi.input'].read(1) != b''
+        except RequestEntityTooLarge:
+            too_large = True
+        if too_large:
+            app.logger.warning(f"Rejected chunked body for {request.endpoint} over its {limit} byte limit")
+            return jsonify({"success": False, "error": "Request body too large", "limit_bytes": limit}), 413
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({"success": False, "error": "Request body too large"}), 413
+
+class MetricsRegistry:
+    """
+    Prometheus counters and histograms for this worker, plus gauges read from live objects.
+    Every few seconds each worker snapshots its series into METRICS_DIR, so whichever worker
+    answers /metrics can merge all live workers on the host into one scrape.
+    """
+    
+    def __init__(self, snapshot_dir, snapshot_seconds, enabled=True):
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_seconds = snapshot_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, help text, bucket bounds or None)
+        self._gauge_callbacks = []  # fn() -> [(name, labels dict, value)]
+        self._reset()
+    
+    def _reset(self):
+        # Counts are per process: a forked worker starts from zero under its own snapshot file
+        self._pid = os.getpid()
+        self._counters = {}  # (name, label pairs) -> value
+        self._histograms = {}  # (name, label pairs) -> [per-bucket counts..., +Inf count, sum, count]
+        self._last_snapshot = 0.0
+    
+    def counter(self, name, help_text):
+        self._families[name] = ('counter', help_text, None)
+    
+    def histogram(self, name, help_text, buckets):
+        self._families[name] = ('histogram', help_text, tuple(sorted(buckets)))
+    
+    def gauge(self, name, help_text, callback=None):
+        self._families[name] = ('gauge', help_text, None)
+        if callback is not None:
+            self._gauge_callbacks.append(callback)
+    
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self._families[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 3)
+            series[bisect.bisect_left(buckets, value)] += 1  # Index len(buckets) is the +Inf bucket
+            series[-2] += value
+            series[-1] += 1
+    
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the block's wall time into a histogram (recorded even if the block raises)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def snapshot(self):
+        """This worker's series as JSON-safe lists, gauges evaluated now"""
+        gauges = []
+        for callback in self._gauge_callbacks:
+            try:
+                gauges.extend([name, sorted(labels.items()), value] for name, labels, value in callback())
+            except Exception as e:
+                app.logger.warning(f"Metrics gauge callback failed: {str(e)}")
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            return {
+                'pid': self._pid,
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(series)] for (name, labels), series in self._histograms.items()],
+                'gauges': gauges
+            }
+    
+    def maybe_write_snapshot(self, force=False):
+        """Publish this worker's snapshot for other workers' scrapes, at most every snapshot_seconds"""
+        now = time.time()
+        if not self.enabled or (not force and now - self._last_snapshot < self.snapshot_seconds):
+            return
+        self._last_snapshot = now
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        snapshot = self.snapshot()
+        write_file_atomic(os.path.join(self.snapshot_dir, f"{snapshot['pid']}.json"), json.dumps(snapshot).encode('utf-8'))
+        return snapshot
+    
+    def collect(self):
+        """Snapshots of every live worker on this host; files left by dead workers are removed"""
+        own = self.maybe_write_snapshot(force=True)
+        snapshots = [own]
+        try:
+            entries = list(os.scandir(self.snapshot_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            pid_text = entry.name[:-len('.json')]
+            if not entry.name.endswith('.json') or not pid_text.isdigit() or int(pid_text) == own['pid']:
+                continue
+            try:
+                os.kill(int(pid_text), 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass  # Alive, just owned by another user
+            try:
+                with open(entry.path, 'rb') as snapshot_file:
+                    snapshots.append(json.loads(snapshot_file.read()))
+            except (OSError, ValueError):
+                continue  # Replaced or removed mid-read; its numbers show up next scrape
+        return snapshots
+    
+    def render(self):
+        """All live workers merged into the Prometheus text exposition format (version 0.0.4)"""
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in self.collect():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, series in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                histograms[key] = series if merged is None else [a + b for a, b in zip(merged, series)]
+            for name, labels, value in snapshot['gauges']:
+                # Gauges describe one process (cache sizes, pool depth), so each keeps its pid
+                gauges[(name, tuple(map(tuple, labels)) + (('pid', str(snapshot['pid'])),))] = value
+        
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], series):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels + (('le', self._number(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {self._number(series[-2])}")
+                    lines.append(f"{name}_count{self._labels(labels)} {series[-1]}")
+            else:
+                values = counters if kind == 'counter' else gauges
+                for (series_name, labels), value in sorted(values.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{self._labels(labels)} {self._number(value)}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        pairs = []
+        for key, value in labels:
+            escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{escaped}"')
+        return '{' + ','.join(pairs) + '}'
+    
+    @staticmethod
+    def _number(value):
+        if isinstance(value, str):
+            return value
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+METRICS = MetricsRegistry(METRICS_DIR, METRICS_SNAPSHOT_SECONDS, enabled=METRICS_ENABLED)
+METRICS.histogram('aidm_http_request_duration_seconds',
+                  'Time until a route returns its response (streamed bodies continue after this).',
+                  [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+METRICS.histogram('aidm_stream_time_to_first_token_seconds',
+                  'From sending a /stream request upstream to receiving its first content.',
+                  [0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32])
+METRICS.histogram('aidm_stream_tokens_per_second',
+                  'Estimated output tokens per second after the first token of a /stream reply.',
+                  [1, 5, 10, 20, 40, 80, 160, 320])
+METRICS.counter('aidm_stream_output_tokens_total', 'Estimated output tokens streamed to clients.')
+METRICS.histogram('aidm_image_generation_seconds', 'Upstream image generation time, preview or full render.',
+                  [0.5, 1, 2, 5, 10, 20, 30, 60])
+METRICS.histogram('aidm_history_io_seconds', 'Chat history load and save time (cache hits included).',
+                  [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1])
+METRICS.counter('aidm_errors_total', 'Errors by type: upstream failures, exceptions and 5xx responses.')
+METRICS.counter('aidm_usage_tokens_total', 'Tokens used by /stream turns (input estimated, output counted).')
+METRICS.counter('aidm_usage_cost_dollars_total', 'Estimated USD cost of /stream turns from model pricing.')
+METRICS.counter('aidm_admission_shed_total', 'Turns and image jobs refused by job slots or upstream admission, by reason.')
+METRICS.histogram('aidm_admission_wait_seconds', 'Time a /stream turn waited in the admission queue before starting.',
+                  [0.1, 0.5, 1, 2, 5, 10, 20])
+METRICS.histogram('aidm_job_queue_wait_seconds', 'Time a /stream turn or image job waited for a per-user/per-game slot.',
+                  [0.1, 0.5, 1, 2, 5, 10, 20, 45, 90])
+
+def cache_gauges():
+    """Entries and bytes held by this worker's caches and pools"""
+    samples = []
+    caches = {'history': HISTORY_CACHE.stats(), 'client_context': CLIENT_CONTEXT_CACHE.stats(),
+              'rolling_context': ROLLING_CONTEXTS.stats()}
+    for cache, stats in caches.items():
+        if 'entries' in stats:
+            samples.append(('aidm_cache_entries', {'cache': cache}, stats['entries']))
+        if 'size_bytes' in stats:
+            samples.append(('aidm_cache_bytes', {'cache': cache}, stats['size_bytes']))
+    for pool in (IMAGE_PIPELINE.pool, COMPRESS_POOL):
+        samples.append(('aidm_pool_jobs_in_flight', {'pool': pool.name}, pool.stats()['running_or_queued']))
+    admission = ADMISSION.stats()
+    samples.append(('aidm_admission_streams', {'state': 'in_flight'}, admission['in_flight']))
+    samples.append(('aidm_admission_streams', {'state': 'queued'}, admission['queued']))
+    jobs = JOB_SLOTS.stats()
+    for state in ('running', 'queued'):
+        for kind in JOBS_DEFAULT_SECONDS:
+            samples.append(('aidm_jobs', {'kind': kind, 'state': state}, jobs[state][kind]))
+    return samples
+
+METRICS.gauge('aidm_cache_entries', 'Entries held by a per-worker cache.', cache_gauges)
+METRICS.gauge('aidm_cache_bytes', 'Bytes held by a per-worker cache.')
+METRICS.gauge('aidm_pool_jobs_in_flight', 'Jobs queued or running in a worker process pool.')
+METRICS.gauge('aidm_admission_streams', "/stream turns this worker's admission controller holds upstream or queued.")
+METRICS.gauge('aidm_jobs', 'Slow jobs (/stream turns, image generation) running or queued for a slot in this worker.')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint != 'metrics':
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        METRICS.observe('aidm_http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method, status=str(response.status_code))
+        if response.status_code >= 500:
+            METRICS.inc('aidm_errors_total', type=f'http_{response.status_code}')
+    try:
+        METRICS.maybe_write_snapshot()
+    except OSError as e:
+        app.logger.warning(f"Could not write metrics snapshot: {str(e)}")
+    return response
+
+def count_request_exception(sender, exception, **extra):
+    METRICS.inc('aidm_errors_total', type=type(exception).__name__)
+
+got_request_exception.connect(count_request_exception, app)
+
+class RequestProfiler:
+    """
+    Profiles one request, streamed body included, into a file under PROFILE_DIR.
+    'sample' mode records the request thread's stack every few milliseconds as folded stacks
+    ("outer;inner count" lines for flamegraph.pl, inferno or speedscope); 'cprofile' mode writes a
+    deterministic pstats dump (snakeviz, flameprof). Work handed to other threads or processes
+    (image renders, compression pools) is not captured.
+    """
+    
+    def __init__(self, name, mode=PROFILE_MODE, interval=PROFILE_INTERVAL_MS / 1000):
+        self.mode = 'cprofile' if mode == 'cprofile' else 'sample'
+        self.name = f"{name}.{'prof' if self.mode == 'cprofile' else 'folded'}"
+        self.interval = interval
+        self._finished = False
+    
+    def start(self):
+        self.thread_id = threading.get_ident()
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stacks = Counter()
+            self._stop = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+            self._sampler.start()
+    
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+    
+    def finish(self):
+        """Stop profiling, write the output file and prune the directory (safe to call twice)"""
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            file_path = os.path.join(PROFILE_DIR, self.name)
+            if self.mode == 'cprofile':
+                self._profile.disable()
+                fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=PROFILE_DIR)
+                os.close(fd)
+                self._profile.dump_stats(tmp_path)
+                os.replace(tmp_path, file_path)
+            else:
+                self._stop.set()
+                self._sampler.join()
+                folded = ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+                write_file_atomic(file_path, folded.encode('utf-8'))
+            prune_profiles()
+        except Exception as e:
+            app.logger.error(f"Could not write request profile {self.name}: {str(e)}")
+        finally:
+            PROFILE_SLOTS.release()
+
+PROFILE_SLOTS = threading.BoundedSemaphore(PROFILE_MAX_CONCURRENT)
+PROFILE_NAME_RE = re.compile(r'^(\d+)_(\d+)_(\w+)_(header|sampled)\.(folded|prof)$')
+
+def prune_profiles():
+    """Delete the oldest profiles until PROFILE_DIR is within PROFILE_MAX_FILES and PROFILE_MAX_BYTES"""
+    profiles = sorted((entry for entry in os.scandir(PROFILE_DIR) if PROFILE_NAME_RE.match(entry.name)),
+                      key=lambda entry: entry.name)  # Names start with a millisecond timestamp
+    total_bytes = sum(entry.stat().st_size for entry in profiles)
+    while profiles and (len(profiles) > PROFILE_MAX_FILES or total_bytes > PROFILE_MAX_BYTES):
+        oldest = profiles.pop(0)
+        total_bytes -= oldest.stat().st_size
+        try:
+            os.remove(oldest.path)
+        except OSError:
+            pass
+
+def is_admin_request(token=None):
+    """True when AIDM_ADMIN_TOKEN is set and matches `token` (default: the Authorization bearer token)"""
+    if not ADMIN_TOKEN:
+        return False
+    if token is None:
+        authorization = request.headers.get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else ''
+    return secrets.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))  # str compare raises on non-ASCII
+
+@app.before_request
+def start_request_profile():
+    if request.endpoint in (None, 'static', 'metrics', 'list_profiles', 'get_profile'):
+        return
+    header = request.headers.get('X-AIDM-Profile')
+    if header and is_admin_request(header):
+        trigger = 'header'
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        trigger = 'sampled'
+    else:
+        return
+    if not PROFILE_SLOTS.acquire(blocking=False):
+        app.logger.info(f"Skipped profiling {request.endpoint}: {PROFILE_MAX_CONCURRENT} profiles already running")
+        return
+    profiler = RequestProfiler(f"{int(time.time() * 1000)}_{os.getpid()}_{request.endpoint}_{trigger}")
+    profiler.start()
+    g.profiler = profiler
+
+@app.after_request
+def attach_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-AIDM-Profile-Id'] = profiler.name
+        # Runs once the body is fully sent, so streamed responses are profiled to the end
+        response.call_on_close(profiler.finish)
+    return response
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    # Only still set when after_request never ran
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.finish()
+
+class IncrementalJSONReader:
+    """
+    Pulls JSON values one at a time from a byte stream, so a huge request body
+    is never held in memory at once - only the value currently being decoded.
+    """
+    
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+    
+    def _fill(self, size):
+        if self._eof:
+            return False
+        # Drop what has already been consumed before growing the buffer
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        chunk = self._stream.read(size)
+        if not chunk:
+            self._eof = True
+            self._buf += self._utf8.decode(b'', final=True)
+            return False
+        self._buf += self._utf8.decode(chunk)
+        return True
+    
+    def peek(self):
+        """Next non-whitespace character, or '' at end of input"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill(self._chunk_size):
+                return ''
+    
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self._pos}")
+        self._pos += 1
+    
+    def read_value(self):
+        """Decode the next complete JSON value, reading more input until it is whole"""
+        self.peek()
+        read_size = self._chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number running up to the buffer edge (e.g. "1." of "1.5e3") may continue in the next chunk
+                if self._eof or not isinstance(value, (int, float)) or self._buf[end:].strip('0123456789.eE+-'):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill(read_size)
+            read_size *= 2  # Large values (inline images) need fewer retries
+    
+    def iter_object_keys(self):
+        """Yield each key of an object; the caller must consume its value before resuming"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("Object keys must be strings")
+            self.expect(':')
+            yield key
+            separator = self.peek()
+            self._pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or '}}' at offset {self._pos - 1}")
+    
+    def iter_array(self):
+        """Yield the items of an array one at a time"""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.read_value()
+            separator = self.peek()
+            self._pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or ']' at offset {self._pos - 1}")
+
+class HistoryImportWriter:
+    """
+    Streams history messages into a temp file in the configured at-rest format,
+    then atomically moves it into place under the game lock on commit.
+    """
+    
+    def __init__(self):
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=CHAT_DIR)
+        self._raw = os.fdopen(fd, 'wb')
+        level = HISTORY_COMPRESSION_LEVEL
+        if HISTORY_COMPRESSION == 'zstd' and zstandard is not None:
+            self._out = zstandard.ZstdCompressor(level=level if level is not None else 3).stream_writer(self._raw, closefd=False)
+        elif HISTORY_COMPRESSION in ('gzip', 'zstd'):
+            self._out = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=level if level is not None else 6, mtime=0)
+        else:
+            self._out = None
+        self.count = 0
+        self._write(b'[')
+    
+    def _write(self, data):
+        (self._out or self._raw).write(data)
+    
+    def write_message(self, msg):
+        self._write((', ' if self.count else '').encode('utf-8') + json.dumps(msg).encode('utf-8'))
+        self.count += 1
+    
+    def commit(self, user_id, game_id):
+        self._write(b']')
+        if self._out is not None:
+            self._out.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        file_path = get_chat_file_path(user_id, game_id)
+        with chat_history_lock(user_id, game_id):
+            os.replace(self.tmp_path, file_path)
+            HISTORY_CACHE.invalidate(file_path)
+        GAME_UPDATES.publish(file_path, None)
+    
+    def abort(self):
+        try:
+            if self._out is not None:
+                self._out.close()
+            self._raw.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
 
 def format_message_content(content):
     """Format AI responses with markdown-like syntax for the frontend"""
@@ -280,68 +1376,71 @@ def generate_and_save_image(prompt, user_id, game_id):
             "seed": 0
         }
         
-        # Make request to Venice AI
-        response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
-        
-        if response.status_code != 200:
-            app.logger.error(f"Venice AI image generation failed: {response.status_code} - {response.text}")
-            raise Exception(f"Image generation failed: {response.text}")
-        
-        # Log the raw response for debugging
-        app.logger.debug(f"Raw response text (first 500 chars): {response.text[:500]}")
-        
-        try:
-            result = response.json()
-        except Exception as json_error:
-            app.logger.error(f"Failed to parse JSON response: {json_error}")
-            app.logger.error(f"Raw response: {response.text}")
-            raise Exception("Invalid JSON response from image API")
-        app.logger.debug(f"Venice AI full response: {result}")
-        app.logger.debug(f"Venice AI response keys: {list(result.keys()) if isinstance(result, dict) else 'Not a dict'}")
-          # Check if we have the expected data structure
-        if not result:
-            app.logger.error(f"Empty response from Venice AI")
-            raise Exception("Empty response from image API")
+        if IMAGE_BINARY_TRANSFER:
+            # Raw bytes stream straight into the image store; only the reference URL goes further
+            image_id = secrets.token_hex(6)
+            with METRICS.time('aidm_image_generation_seconds', model=selected_model, phase='full'):
+                image_url = fetch_image_binary(payload, user_id, image_id)
+        else:
+            # Make request to Venice AI
+            with METRICS.time('aidm_image_generation_seconds', model=selected_model, phase='full'):
+                response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
+            
+            if response.status_code != 200:
+                app.logger.error(f"Venice AI image generation failed: {response.status_code} - {response.text}")
+                METRICS.inc('aidm_errors_total', type=f'image_upstream_status_{response.status_code}')
+                raise Exception(f"Image generation failed: {response.text}")
             
-        if not isinstance(result, dict):
-            app.logger.error(f"Response is not a dictionary: {type(result)}")
-            raise Exception("Invalid response format from image API")
+            try:
+                result = response.json()
+            except Exception as json_error:
+                app.logger.error(f"Failed to parse JSON response: {json_error}")
+                app.logger.error(f"Raw response: {response.text}")
+                raise Exception("Invalid JSON response from image API")
+            # Sampled and lazy: the reply carries a base64 image, so only its shape is logged
+            log_event(logging.DEBUG, 'image_response', bytes=len(response.content),
+                      keys=lambda: list(result.keys()) if isinstance(result, dict) else type(result).__name__)
+              # Check if we have the expected data structure
+            if not result:
+                app.logger.error(f"Empty response from Venice AI")
+                raise Exception("Empty response from image API")
+                
+            if not isinstance(result, dict):
+                app.logger.error(f"Response is not a dictionary: {type(result)}")
+                raise Exception("Invalid response format from image API")
+                
+            # Venice AI returns images in 'images' field, not 'data'
+            if 'images' not in result:
+                app.logger.error(f"Missing 'images' field in response. Available keys: {list(result.keys())}")
+                raise Exception("Invalid response from image API - missing images field")
+                
+            if not result['images']:
+                app.logger.error(f"Empty 'images' field in response: {result['images']}")
+                raise Exception("Invalid response from image API - empty images field")
+    
+            # Extract the base64 image data from the 'images' field
+            images_field = result['images']
+            app.logger.debug(f"Images field type: {type(images_field)}, is_list: {isinstance(images_field, list)}")
             
-        # Venice AI returns images in 'images' field, not 'data'
-        if 'images' not in result:
-            app.logger.error(f"Missing 'images' field in response. Available keys: {list(result.keys())}")
-            raise Exception("Invalid response from image API - missing images field")
+            if isinstance(images_field, list) and len(images_field) > 0:
+                # Venice AI returns a list with base64 string as first element
+                image_data = images_field[0]
+                app.logger.debug(f"Extracted image data from list, length: {len(image_data) if isinstance(image_data, str) else 'Not a string'}")
+            elif isinstance(images_field, str):
+                # Sometimes might return directly as string
+                image_data = images_field
+                app.logger.debug(f"Using direct string data, length: {len(image_data)}")
+            else:
+                app.logger.error(f"Unexpected images format. Type: {type(images_field)}, Value preview: {str(images_field)[:100]}")
+                raise Exception("Invalid response from image API")
             
-        if not result['images']:
-            app.logger.error(f"Empty 'images' field in response: {result['images']}")
-            raise Exception("Invalid response from image API - empty images field")
-
-        # Extract the base64 image data from the 'images' field
-        images_field = result['images']
-        app.logger.debug(f"Images field type: {type(images_field)}, is_list: {isinstance(images_field, list)}")
-        
-        if isinstance(images_field, list) and len(images_field) > 0:
-            # Venice AI returns a list with base64 string as first element
-            image_data = images_field[0]
-            app.logger.debug(f"Extracted image data from list, length: {len(image_data) if isinstance(image_data, str) else 'Not a string'}")
-        elif isinstance(images_field, str):
-            # Sometimes might return directly as string
-            image_data = images_field
-            app.logger.debug(f"Using direct string data, length: {len(image_data)}")
-        else:
-            app.logger.error(f"Unexpected images format. Type: {type(images_field)}, Value preview: {str(images_field)[:100]}")
-            raise Exception("Invalid response from image API")
-        
-        # Validate the base64 data
-        if not isinstance(image_data, str) or len(image_data) < 100:
-            app.logger.error(f"Invalid base64 data. Type: {type(image_data)}, Length: {len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
-            raise Exception("Invalid response from image API")
-          # Create data URL from base64 image data
-        image_url = f"data:image/png;base64,{image_data}"
-        app.logger.debug(f"Created image URL with length: {len(image_url)}")
-        
-        # Load chat history and add image message
-        chat_history = load_chat_history(user_id, game_id)
+            # Validate the base64 data
+            if not isinstance(image_data, str) or len(image_data) < 100:
+                app.logger.error(f"Invalid base64 data. Type: {type(image_data)}, Length: {len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
+                raise Exception("Invalid response from image API")
+              # Create data URL from base64 image data
+            image_url = f"data:image/png;base64,{image_data}"
+            app.logger.debug(f"Created image URL with length: {len(image_url)}")
         
         # Add image message to history
         image_message = {
@@ -354,8 +1453,7 @@ def generate_and_save_image(prompt, user_id, game_id):
             "image_model": selected_model
         }
         
-        chat_history.append(image_message)
-        save_chat_history(user_id, chat_history, game_id)
+        append_chat_message(user_id, image_message, game_id)
         
         app.logger.debug(f"Generated and saved image for prompt: {prompt[:50]}...")
         
@@ -389,11 +1487,361 @@ def index():
     response = make_response(render_template('index.html', chat_history=chat_history))
     response.set_cookie('user_id', user_id, max_age=60*60*24*365)  # Expire in 1 year
     response.set_cookie('game_id', game_id, max_age=60*60*24*365)
+    # Ask browsers to send image width hints so /get_image can pick a smaller variant
+    response.headers['Accept-CH'] = 'Sec-CH-Width, Sec-CH-Viewport-Width, Sec-CH-DPR'
     return response
 
-# Ephemeral in-memory context cache for client-only mode
-# Maps opaque token -> list of messages used for AI context; not persisted to disk
-CLIENT_CONTEXT_CACHE = {}
+IMAGE_ALT_RE = re.compile(r'<img\b[^>]*?\balt="([^"]*)"', re.IGNORECASE)
+
+def context_content(msg, content):
+    """
+    Message text as the AI should see it. Image messages (and anything carrying an
+    inline data: URL) collapse to a short "[image: prompt]" reference, so multi-MB
+    base64 payloads are never cached, token-counted or tag-stripped per turn.
+    """
+    if not isinstance(content, str):
+        return ""
+    if msg.get("message_type") != "image" and 'data:image/' not in content:
+        return content
+    prompt = msg.get("image_prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        alt = IMAGE_ALT_RE.search(content)
+        prompt = alt.group(1) if alt else ""
+    prompt = prompt.strip()[:200]
+    return f"[image: {prompt}]" if prompt else "[image]"
+
+class ContextMessage:
+    """
+    Compact server-side view of one chat message, parsed once at ingest.
+    Everything the per-turn loops need (API text without HTML, player label, token
+    estimate, stored size) is computed here instead of re-derived from dicts every turn.
+    Only the HTML-stripped text is kept; the raw content is not needed after ingest.
+    """
+    
+    __slots__ = ('role', 'player', 'player_label', 'api_text', 'token_count',
+                 'size', 'message_type', 'invisible')
+    
+    def __init__(self, role, content, player=None, message_type=None, invisible=False, size=None):
+        self.role = role
+        self.player = player
+        # "player2" -> "2"; renamed players keep their name, as the old .replace("player", "") did
+        self.player_label = player.replace("player", "") if isinstance(player, str) else None
+        self.api_text = strip_html_tags(content)
+        self.token_count = estimate_tokens(content)  # Raw length, so truncation decisions are unchanged
+        self.size = size if size is not None else len(content) + 64
+        self.message_type = message_type
+        self.invisible = invisible
+    
+    @classmethod
+    def from_dict(cls, msg):
+        """Parse a stored/client message dict"""
+        return cls(
+            msg.get("role"),
+            context_content(msg, msg.get("content", "")),
+            player=msg.get("player"),
+            message_type=msg.get("message_type"),
+            invisible=bool(msg.get("invisible", False))
+        )
+    
+    @property
+    def is_system_notice(self):
+        # System notifications such as players joining or leaving
+        return self.role == "system" and self.player == "system"
+    
+    def to_dict(self):
+        entry = {"role": self.role, "content": self.api_text}
+        if self.player:
+            entry["player"] = self.player
+        if self.message_type:
+            entry["message_type"] = self.message_type
+        if self.invisible:
+            entry["invisible"] = True
+        return entry
+    
+    def to_state(self):
+        """All fields as a JSON-friendly list, so shared stores can rebuild without re-parsing"""
+        return [getattr(self, name) for name in self.__slots__]
+    
+    @classmethod
+    def from_state(cls, state):
+        msg = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, state):
+            setattr(msg, name, value)
+        return msg
+
+def as_context_messages(chat_history):
+    """Parse message dicts into ContextMessage (already-parsed entries pass through)"""
+    return [msg if isinstance(msg, ContextMessage) else ContextMessage.from_dict(msg) for msg in chat_history]
+
+def estimate_context_bytes(messages):
+    """Approximate memory held by a list of ContextMessage (string payloads plus per-object overhead)"""
+    total = 0
+    for msg in messages:
+        total += 160 + len(msg.api_text)
+    return total
+
+class ClientContextCache:
+    """
+    Thread-safe, bounded store for the context /chat hands to /stream.
+    Tokens expire after a TTL (closed tabs and failed EventSource connections never
+    consume theirs) and the least recently stored tokens are evicted once the entry
+    or estimated byte budget is exceeded.
+    """
+    
+    def __init__(self, ttl_seconds, max_entries, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token -> (expires_at, messages, size in bytes)
+        self._bytes = 0
+        self.stored = 0
+        self.consumed = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def put(self, token, messages):
+        size_bytes = estimate_context_bytes(messages)
+        with self._lock:
+            self._expire(time.time())
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (time.time() + self.ttl_seconds, messages, size_bytes)
+            self._bytes += size_bytes
+            self.stored += 1
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def pop(self, token):
+        """Take a token's context (one-time use); None if unknown, evicted or expired"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            self._remove(token)
+            if entry[0] < time.time():
+                self.expirations += 1
+                return None
+            self.consumed += 1
+            return entry[1]
+    
+    def _expire(self, now):
+        # Entries share one TTL and are never refreshed, so the oldest are always at the front
+        while self._entries:
+            token, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at >= now:
+                break
+            self._remove(token)
+            self.expirations += 1
+    
+    def _remove(self, token):
+        _, _, size_bytes = self._entries.pop(token)
+        self._bytes -= size_bytes
+    
+    def stats(self):
+        with self._lock:
+            self._expire(time.time())
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "size_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "stored": self.stored,
+                "consumed": self.consumed,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+class SQLiteContextStore:
+    """
+    Context handoff shared by every worker on one host via a SQLite file in WAL mode.
+    Same put/pop/stats interface and TTL/budget rules as ClientContextCache.
+    """
+    
+    def __init__(self, path, ttl_seconds, max_entries, max_bytes):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self.stored = 0
+        self.consumed = 0
+        self.evictions = 0
+        self.expirations = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS client_context ("
+                "token TEXT PRIMARY KEY, expires_at REAL NOT NULL, size_bytes INTEGER NOT NULL, payload BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS client_context_expires ON client_context (expires_at)")
+    
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads, so keep one per thread (and per process)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def put(self, token, messages):
+        payload = json.dumps([msg.to_state() for msg in messages]).encode('utf-8')
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.expirations += conn.execute("DELETE FROM client_context WHERE expires_at < ?", (now,)).rowcount
+            conn.execute(
+                "INSERT OR REPLACE INTO client_context (token, expires_at, size_bytes, payload) VALUES (?, ?, ?, ?)",
+                (token, now + self.ttl_seconds, len(payload), payload)
+            )
+            entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM client_context").fetchone()
+            if entries > self.max_entries or total_bytes > self.max_bytes:
+                # Walk oldest-first and drop until back within budget (never the token just stored)
+                for old_token, size_bytes in conn.execute(
+                        "SELECT token, size_bytes FROM client_context WHERE token != ? ORDER BY expires_at", (token,)).fetchall():
+                    if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM client_context WHERE token = ?", (old_token,))
+                    entries -= 1
+                    total_bytes -= size_bytes
+                    self.evictions += 1
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.stored += 1
+    
+    def pop(self, token):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT expires_at, payload FROM client_context WHERE token = ?", (token,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM client_context WHERE token = ?", (token,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        if row[0] < time.time():
+            self.expirations += 1
+            return None
+        self.consumed += 1
+        return [ContextMessage.from_state(state) for state in json.loads(row[1])]
+    
+    def stats(self):
+        entries, total_bytes = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM client_context").fetchone()
+        return {
+            "backend": "sqlite",
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "size_bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "stored": self.stored,
+            "consumed": self.consumed,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+class RedisContextStore:
+    """
+    Context handoff shared across hosts through any Redis-compatible server.
+    Redis handles TTL expiry itself; configure maxmemory-policy volatile-ttl for the byte budget.
+    Pass `client` to use a stand-in (e.g. fakeredis) instead of connecting to `url`.
+    """
+    
+    KEY_PREFIX = 'aidm:context:'
+    
+    def __init__(self, url, ttl_seconds, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("CLIENT_CONTEXT_STORE is 'redis' but the redis package is not installed")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.stored = 0
+        self.consumed = 0
+        self.misses = 0
+    
+    def put(self, token, messages):
+        payload = json.dumps([msg.to_state() for msg in messages]).encode('utf-8')
+        self.client.set(self.KEY_PREFIX + token, payload, ex=self.ttl_seconds)
+        self.stored += 1
+    
+    def pop(self, token):
+        # GET and DELETE in one MULTI so two workers can never both consume a token
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.KEY_PREFIX + token)
+        pipe.delete(self.KEY_PREFIX + token)
+        payload, _ = pipe.execute()
+        if payload is None:
+            self.misses += 1
+            return None
+        self.consumed += 1
+        return [ContextMessage.from_state(state) for state in json.loads(payload)]
+    
+    def stats(self):
+        return {
+            "backend": "redis",
+            "ttl_seconds": self.ttl_seconds,
+            "stored": self.stored,
+            "consumed": self.consumed,
+            "misses": self.misses
+        }
+
+def create_context_store(backend=CLIENT_CONTEXT_STORE, ttl_seconds=CLIENT_CONTEXT_TTL_SECONDS):
+    """Build the context store selected by CLIENT_CONTEXT_STORE"""
+    if backend == 'sqlite':
+        return SQLiteContextStore(CLIENT_CONTEXT_SQLITE_PATH, ttl_seconds,
+                                  CLIENT_CONTEXT_MAX_ENTRIES, CLIENT_CONTEXT_MAX_BYTES)
+    if backend == 'redis':
+        return RedisContextStore(CLIENT_CONTEXT_REDIS_URL, ttl_seconds)
+    if backend != 'memory':
+        app.logger.warning(f"Unknown CLIENT_CONTEXT_STORE '{backend}', using in-memory store")
+    return ClientContextCache(ttl_seconds, CLIENT_CONTEXT_MAX_ENTRIES, CLIENT_CONTEXT_MAX_BYTES)
+
+# Ephemeral context store for client-only mode
+# Maps opaque token -> list of messages used for AI context; never written to chat history files
+CLIENT_CONTEXT_CACHE = create_context_store()
+
+# Per-game rolling context for incremental /chat sync, keyed by "<user>:<game>:<chain hash>".
+# A client that sends the hash it was last given only needs to upload the messages added since.
+ROLLING_CONTEXTS = create_context_store(ttl_seconds=ROLLING_CONTEXT_TTL_SECONDS)
+
+def sanitize_client_history(client_history):
+    """
+    Basic validation of client-sent messages: only keep role/content/player fields, parsed into ContextMessage.
+    Image payloads are replaced by "[image: prompt]" references before anything is cached.
+    """
+    history = []
+    for msg in client_history:
+        if not isinstance(msg, dict):
+            continue
+        role = msg.get('role')
+        content = msg.get('content') or msg.get('text') or ''
+        if role in ('user', 'assistant', 'system') and isinstance(content, str):
+            history.append(ContextMessage(role, context_content(msg, content), player=msg.get('player') or None))
+    return history
+
+def extend_context_hash(context_hash, messages):
+    """Extend a hash chain over sanitized messages; the chain fingerprints everything synced so far"""
+    for msg in messages:
+        digest = hashlib.sha256(context_hash.encode('utf-8'))
+        digest.update(json.dumps([msg.role, msg.player, msg.api_text]).encode('utf-8'))
+        context_hash = digest.hexdigest()[:32]
+    return context_hash
+
+def rolling_context_key(user_id, game_id, context_hash):
+    return f"{user_id}:{game_id}:{context_hash}"
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -409,42 +1857,46 @@ def chat():
         is_system = data.get('is_system', False)
         invisible_to_players = data.get('invisible_to_players', False)  # New flag
         client_history = data.get('client_history')  # Client-sent history for client-only mode
+        base_hash = data.get('base_hash')  # Incremental sync: hash returned by the previous /chat
+        client_history_delta = data.get('client_history_delta')  # ...plus only the messages added since
         storage_mode = session.get('storage_mode', 'client-only')
         # Client-only: build history from client, store ephemerally, do not persist
         if storage_mode == 'client-only':
             history = []
-            if isinstance(client_history, list):
-                # Basic validation: only keep role/content/player fields
-                for msg in client_history[-200:]:  # cap to last 200 messages
-                    role = msg.get('role')
-                    content = msg.get('content') or msg.get('text') or ''
-                    if role in ('user', 'assistant', 'system') and isinstance(content, str):
-                        entry = { 'role': role, 'content': content }
-                        if msg.get('player'):
-                            entry['player'] = msg['player']
-                        history.append(entry)
+            context_hash = None
+            if isinstance(base_hash, str) and isinstance(client_history_delta, list):
+                synced = ROLLING_CONTEXTS.pop(rolling_context_key(user_id, game_id, base_hash))
+                if synced is None:
+                    # Expired, evicted or diverged - the client must resend its full history
+                    return jsonify({"resync": True, "error": True, "response": "Context out of sync."}), 409
+                delta = sanitize_client_history(client_history_delta)
+                history = (synced + delta)[-CLIENT_CONTEXT_MAX_MESSAGES:]
+                context_hash = extend_context_hash(base_hash, delta)
+            elif isinstance(client_history, list):
+                history = sanitize_client_history(client_history[-CLIENT_CONTEXT_MAX_MESSAGES:])
+                context_hash = extend_context_hash('', history)
+            if context_hash is not None and game_id:
+                ROLLING_CONTEXTS.put(rolling_context_key(user_id, game_id, context_hash), history)
+                history = list(history)
             # Append this user/system message
-            entry = {
-                'role': 'user' if not is_system else 'system',
-                'content': user_input
-            }
-            if not is_system:
-                entry['player'] = f'player{player_number}'
-            if invisible_to_players:
-                entry['invisible'] = True
-            history.append(entry)
+            history.append(ContextMessage(
+                'user' if not is_system else 'system',
+                user_input if isinstance(user_input, str) else str(user_input),
+                player=f'player{player_number}' if not is_system else None,
+                invisible=bool(invisible_to_players)
+            ))
             # Create opaque token and store ephemerally
             token = secrets.token_urlsafe(16)
-            CLIENT_CONTEXT_CACHE[token] = history
+            CLIENT_CONTEXT_CACHE.put(token, history)
             return jsonify({
                 'message_id': token,
                 'streaming': True,
                 'player_number': player_number,
-                'invisible': invisible_to_players
+                'invisible': invisible_to_players,
+                'context_hash': context_hash if game_id else None
             })
         else:
             # Hybrid/server mode (not used now): maintain server history as before
-            chat_history = load_chat_history(user_id, game_id)
             message_entry = {
                 "role": "user" if not is_system else "system",
                 "content": user_input,
@@ -452,10 +1904,14 @@ def chat():
             }
             if invisible_to_players:
                 message_entry["invisible"] = True
-            chat_history.append(message_entry)
-            save_chat_history(user_id, chat_history, game_id)
+            
+            def append_entry(chat_history):
+                chat_history.append(message_entry)
+                return len(chat_history)
+            
+            history_length = update_chat_history(user_id, append_entry, game_id)
             return jsonify({
-                "message_id": len(chat_history),
+                "message_id": history_length,
                 "streaming": True,
                 "player_number": player_number,
                 "invisible": invisible_to_players
@@ -485,6 +1941,569 @@ def get_model_capabilities(model_id):
         'supportsParallelToolCalls': False
     }
 
+class TurnSpans:
+    """
+    Wall-clock spans for the stages of one /stream turn, so a slow turn shows where the time went.
+    Offsets and durations are in milliseconds from the moment the request arrived.
+    """
+    
+    def __init__(self, turn_id):
+        self.turn_id = turn_id
+        self.started = time.perf_counter()
+        self.spans = []
+    
+    def record(self, name, started, **attrs):
+        """Add a span that began at perf_counter() value `started` and ends now"""
+        now = time.perf_counter()
+        self.spans.append(dict(name=name, start_ms=round((started - self.started) * 1000, 1),
+                               ms=round((now - started) * 1000, 1), **attrs))
+    
+    @contextmanager
+    def span(self, name, **attrs):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, **attrs)
+    
+    def summary(self):
+        return {'turn_id': self.turn_id, 'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'spans': self.spans}
+
+MODEL_PRICING = {model['id']: model.get('pricing', {}) for model in AVAILABLE_MODELS}
+
+def estimate_cost(model_id, input_tokens, output_tokens):
+    """USD cost of a turn from the model's pricing (per million tokens); unpriced models cost nothing"""
+    pricing = MODEL_PRICING.get(model_id, {})
+    return (input_tokens * pricing.get('input', 0) + output_tokens * pricing.get('output', 0)) / 1_000_000
+
+class UsageLedger:
+    """
+    Per-user and global token and cost totals in one-minute buckets, so a budget check over an
+    hour or a day sums at most one bucket per minute. In-memory, so each worker counts only its own streams.
+    """
+    
+    def __init__(self, retention_seconds):
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # minute -> {user_id or None (global): [tokens, cost]}, oldest first
+    
+    def record(self, user_id, tokens, cost):
+        minute = int(time.time() // 60)
+        with self._lock:
+            bucket = self._buckets.get(minute)
+            if bucket is None:
+                bucket = self._buckets[minute] = {}
+                oldest = minute - self.retention_seconds // 60
+                while next(iter(self._buckets)) < oldest:
+                    self._buckets.popitem(last=False)
+            for key in (user_id, None):
+                totals = bucket.setdefault(key, [0, 0.0])
+                totals[0] += tokens
+                totals[1] += cost
+    
+    def totals(self, window_seconds, user_id=None):
+        """(tokens, cost) recorded for user_id, or everyone, in the buckets overlapping the last window_seconds"""
+        since = int((time.time() - window_seconds) // 60)
+        tokens, cost = 0, 0.0
+        with self._lock:
+            for minute in reversed(self._buckets):
+                if minute < since:
+                    break
+                totals = self._buckets[minute].get(user_id)
+                if totals:
+                    tokens += totals[0]
+                    cost += totals[1]
+        return tokens, cost
+    
+    def stats(self):
+        with self._lock:
+            users = {user_id for bucket in self._buckets.values() for user_id in bucket if user_id is not None}
+            buckets = len(self._buckets)
+        return {'backend': 'memory', 'buckets': buckets, 'users': len(users)}
+
+class SQLiteUsageLedger:
+    """
+    UsageLedger shared by every worker on one host via a SQLite file in WAL mode.
+    Same record/totals/stats interface; the global row of each minute is stored under user_id ''.
+    """
+    
+    def __init__(self, path, retention_seconds):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._pruned_minute = None
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage_minute ("
+                "minute INTEGER NOT NULL, user_id TEXT NOT NULL, tokens INTEGER NOT NULL, cost REAL NOT NULL, "
+                "PRIMARY KEY (user_id, minute))"
+            )
+    
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads, so keep one per thread (and per process)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def record(self, user_id, tokens, cost):
+        minute = int(time.time() // 60)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key in (user_id, ''):
+                conn.execute(
+                    "INSERT INTO usage_minute (minute, user_id, tokens, cost) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user_id, minute) DO UPDATE SET tokens = tokens + excluded.tokens, cost = cost + excluded.cost",
+                    (minute, key, tokens, cost)
+                )
+            if self._pruned_minute != minute:
+                # Once per minute per worker is plenty; rows only age out a minute at a time
+                conn.execute("DELETE FROM usage_minute WHERE minute < ?", (minute - self.retention_seconds // 60,))
+                self._pruned_minute = minute
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def totals(self, window_seconds, user_id=None):
+        since = int((time.time() - window_seconds) // 60)
+        tokens, cost = self._connect().execute(
+            "SELECT COALESCE(SUM(tokens), 0), COALESCE(SUM(cost), 0) FROM usage_minute WHERE user_id = ? AND minute >= ?",
+            ('' if user_id is None else user_id, since)
+        ).fetchone()
+        return tokens, cost
+    
+    def stats(self):
+        buckets, users = self._connect().execute(
+            "SELECT COUNT(DISTINCT minute), COUNT(DISTINCT user_id) - 1 FROM usage_minute").fetchone()
+        return {'backend': 'sqlite', 'buckets': buckets, 'users': max(0, users)}
+
+def create_usage_ledger(backend=USAGE_STORE):
+    """Build the usage ledger selected by USAGE_STORE"""
+    if backend == 'sqlite':
+        return SQLiteUsageLedger(USAGE_SQLITE_PATH, USAGE_RETENTION_SECONDS)
+    if backend != 'memory':
+        app.logger.warning(f"Unknown USAGE_STORE '{backend}', using in-memory ledger")
+    return UsageLedger(USAGE_RETENTION_SECONDS)
+
+class FairQueue:
+    """
+    Weighted fair queue across users. An entry starts at max(virtual clock, the user's previous
+    finish tag) and finishes at start + cost / weight; the smallest finish tag is served next, so a
+    user with many entries queued takes turns with everyone else instead of going first. Serving an
+    entry moves the virtual clock to its start tag, so a user who was idle rejoins at the current
+    round rather than with banked credit. Not thread-safe; callers hold their own lock.
+    """
+    
+    def __init__(self):
+        self._entries = []  # (finish_tag, seq, start_tag, user_id, item), in serving order
+        self._last_finish = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, item):
+        return any(entry[4] is item for entry in self._entries)
+    
+    def push(self, item, user_id, cost=1.0, weight=1.0):
+        start = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish = start + cost / weight
+        self._last_finish[user_id] = finish
+        bisect.insort(self._entries, (finish, next(self._seq), start, user_id, item))
+    
+    def items(self):
+        """Queued items in serving order"""
+        return [entry[4] for entry in self._entries]
+    
+    def first(self, eligible=None):
+        """Next item to serve, skipping those eligible() rejects; None if there is none"""
+        for entry in self._entries:
+            if eligible is None or eligible(entry[4]):
+                return entry[4]
+        return None
+    
+    def position(self, item):
+        """1-based place in serving order, or 0"""
+        for index, entry in enumerate(self._entries):
+            if entry[4] is item:
+                return index + 1
+        return 0
+    
+    def remove(self, item, served=False):
+        for index, entry in enumerate(self._entries):
+            if entry[4] is item:
+                del self._entries[index]
+                if served:
+                    self._virtual_time = max(self._virtual_time, entry[2])
+                if not self._entries:
+                    # Idle: earlier shares no longer matter, and the tag table must not grow forever
+                    self._last_finish.clear()
+                    self._virtual_time = 0.0
+                return True
+        return False
+
+class AdmissionTicket:
+    """One /stream's claim on the budgets: 'admitted', 'queued' or 'shed', then 'finished'"""
+    
+    def __init__(self, user_id, model, input_tokens, output_estimate):
+        self.user_id = user_id
+        self.model = model
+        self.input_tokens = input_tokens
+        self.reserved_tokens = input_tokens + output_estimate
+        self.reserved_cost = estimate_cost(model, input_tokens, output_estimate)
+        self.state = 'new'
+        self.reason = None
+        self.queued_at = None
+        self.admitted_at = None
+        self.waited = 0.0
+
+class AdmissionController:
+    """
+    Decides whether a new /stream may call upstream now, must wait, or is shed.
+    
+    Budgets (per-user tokens per hour and cost per day, global cost per day) shed a stream at
+    once, since waiting would not help. Upstream limits (concurrent streams, tokens per minute)
+    queue it, taking turns across users, for up to max_wait_seconds, so overload turns into a short wait or
+    a clear "busy" message instead of upstream timeouts for everyone. Admitted streams reserve
+    their estimated input plus output_estimate tokens until finish() records the counted usage.
+    """
+    
+    def __init__(self, ledger, user_tokens_per_hour=0, user_cost_per_day=0, global_cost_per_day=0,
+                 max_streams=0, tokens_per_minute=0, output_estimate=ADMISSION_OUTPUT_TOKEN_ESTIMATE,
+                 max_wait_seconds=ADMISSION_MAX_WAIT_SECONDS, max_queued=ADMISSION_MAX_QUEUED):
+        self.ledger = ledger
+        self.user_tokens_per_hour = user_tokens_per_hour
+        self.user_cost_per_day = user_cost_per_day
+        self.global_cost_per_day = global_cost_per_day
+        self.max_streams = max_streams
+        self.tokens_per_minute = tokens_per_minute
+        self.output_estimate = output_estimate
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._admitted = set()
+        self._queue = FairQueue()
+        self._hold_seconds = 10.0  # Typical time an admitted stream holds upstream, for ETAs
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.shed = Counter()
+    
+    def _reserved(self, user_id=None):
+        tickets = [t for t in self._admitted if user_id is None or t.user_id == user_id]
+        return sum(t.reserved_tokens for t in tickets), sum(t.reserved_cost for t in tickets)
+    
+    def _over_budget(self, ticket):
+        """Name of the first budget this stream would exceed, or None"""
+        if self.user_tokens_per_hour or self.user_cost_per_day:
+            reserved_tokens, reserved_cost = self._reserved(ticket.user_id)
+            if self.user_tokens_per_hour:
+                used, _ = self.ledger.totals(3600, ticket.user_id)
+                if used + reserved_tokens + ticket.reserved_tokens > self.user_tokens_per_hour:
+                    return 'user_token_budget'
+            if self.user_cost_per_day:
+                _, spent = self.ledger.totals(86400, ticket.user_id)
+                if spent + reserved_cost + ticket.reserved_cost > self.user_cost_per_day:
+                    return 'user_cost_budget'
+        if self.global_cost_per_day:
+            _, spent = self.ledger.totals(86400)
+            if spent + self._reserved()[1] + ticket.reserved_cost > self.global_cost_per_day:
+                return 'global_cost_budget'
+        return None
+    
+    def _upstream_busy(self, ticket):
+        if self.max_streams and len(self._admitted) >= self.max_streams:
+            return True
+        if self.tokens_per_minute:
+            used = self.ledger.totals(60)[0] + self._reserved()[0]
+            # A prompt larger than the whole per-minute allowance still runs once upstream is idle
+            if used and used + ticket.reserved_tokens > self.tokens_per_minute:
+                return True
+        return False
+    
+    def _admit(self, ticket):
+        ticket.state = 'admitted'
+        ticket.admitted_at = time.monotonic()
+        self._admitted.add(ticket)
+        self.admitted_total += 1
+        return ticket
+    
+    def _shed(self, ticket, reason):
+        ticket.state = 'shed'
+        ticket.reason = reason
+        self.shed[reason] += 1
+        METRICS.inc('aidm_admission_shed_total', stage='upstream', reason=reason)
+        return ticket
+    
+    def admit(self, user_id, model, input_tokens):
+        """Ask to stream one turn; returns a ticket that is 'admitted', 'queued' (call wait()) or 'shed'"""
+        ticket = AdmissionTicket(user_id, model, input_tokens, self.output_estimate)
+        with self._cond:
+            reason = self._over_budget(ticket)
+            if reason:
+                return self._shed(ticket, reason)
+            if not self._queue and not self._upstream_busy(ticket):
+                return self._admit(ticket)
+            if len(self._queue) >= self.max_queued:
+                return self._shed(ticket, 'queue_full')
+            ticket.state = 'queued'
+            ticket.queued_at = time.monotonic()
+            self._queue.push(ticket, user_id)
+            self.queued_total += 1
+            return ticket
+    
+    def wait(self, ticket, timeout):
+        """Wait up to timeout seconds for a queued ticket's turn; returns its state, still 'queued' on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while ticket.state == 'queued':
+                now = time.monotonic()
+                ticket.waited = now - ticket.queued_at
+                if self._queue.first() is ticket and not self._upstream_busy(ticket):
+                    self._queue.remove(ticket, served=True)
+                    self._admit(ticket)
+                    self._cond.notify_all()
+                elif ticket.waited >= self.max_wait_seconds:
+                    self._queue.remove(ticket)
+                    self._shed(ticket, 'queue_timeout')
+                    self._cond.notify_all()
+                elif now >= deadline:
+                    break
+                else:
+                    # Token windows free up as time passes, without anyone to notify
+                    self._cond.wait(min(deadline - now, 1.0))
+        return ticket.state
+    
+    def position(self, ticket):
+        """1-based place of a queued ticket, or 0"""
+        with self._cond:
+            return self._queue.position(ticket)
+    
+    def eta(self, ticket):
+        """Rough seconds until a queued ticket is admitted, from the typical upstream hold time"""
+        with self._cond:
+            slots = self.max_streams or max(1, len(self._admitted))
+            return round(self._queue.position(ticket) * self._hold_seconds / slots, 1)
+    
+    def finish(self, ticket, output_tokens=None, input_tokens=None):
+        """
+        Release a ticket; records its usage when output_tokens is given, with input_tokens (the upstream's
+        count) replacing the admission estimate when known. Safe to call more than once
+        """
+        with self._cond:
+            if ticket.state == 'queued':
+                self._queue.remove(ticket)
+            elif ticket.state == 'admitted':
+                self._admitted.discard(ticket)
+                self._hold_seconds = self._hold_seconds * 0.8 + (time.monotonic() - ticket.admitted_at) * 0.2
+            else:
+                return
+            was_admitted = ticket.state == 'admitted'
+            ticket.state = 'finished'
+            self._cond.notify_all()
+        if was_admitted and output_tokens is not None:
+            if input_tokens is not None:
+                ticket.input_tokens = input_tokens
+            cost = estimate_cost(ticket.model, ticket.input_tokens, output_tokens)
+            self.ledger.record(ticket.user_id, ticket.input_tokens + output_tokens, cost)
+            METRICS.inc('aidm_usage_tokens_total', ticket.input_tokens, model=ticket.model, direction='input')
+            METRICS.inc('aidm_usage_tokens_total', output_tokens, model=ticket.model, direction='output')
+            METRICS.inc('aidm_usage_cost_dollars_total', cost, model=ticket.model)
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': len(self._admitted),
+                'queued': len(self._queue),
+                'admitted_total': self.admitted_total,
+                'queued_total': self.queued_total,
+                'shed': dict(self.shed),
+                'reserved_tokens': self._reserved()[0]
+            }
+
+def reply_token_usage(upstream_usage, reply_text):
+    """(output_tokens, input_tokens) to charge for a reply: the upstream's usage block when it sent one, else an estimate"""
+    if isinstance(upstream_usage, dict) and isinstance(upstream_usage.get('completion_tokens'), int):
+        prompt_tokens = upstream_usage.get('prompt_tokens')
+        return upstream_usage['completion_tokens'], prompt_tokens if isinstance(prompt_tokens, int) else None
+    return (estimate_tokens(reply_text) if reply_text else None), None
+
+USAGE_LEDGER = create_usage_ledger()
+ADMISSION = AdmissionController(
+    USAGE_LEDGER, user_tokens_per_hour=USER_TOKEN_BUDGET_PER_HOUR, user_cost_per_day=USER_COST_BUDGET_PER_DAY,
+    global_cost_per_day=GLOBAL_COST_BUDGET_PER_DAY, max_streams=UPSTREAM_MAX_STREAMS,
+    tokens_per_minute=UPSTREAM_TOKENS_PER_MINUTE
+)
+
+class JobTicket:
+    """One slow job's claim on a JobSlots slot: 'running', 'queued' or 'shed', then 'finished'"""
+    
+    def __init__(self, kind, user_id, game_id):
+        self.kind = kind
+        self.user_id = user_id
+        self.game_id = game_id or None
+        self.state = 'new'
+        self.reason = None
+        self.queued_at = None
+        self.started_at = None
+        self.waited = 0.0
+
+class JobSlots:
+    """
+    Per-worker concurrency caps for slow work (/stream turns and image generation): at most
+    max_active jobs overall, max_per_user per user and max_per_game per game. Jobs over a cap
+    wait in a FairQueue weighted by their kind's typical duration, so users take turns by the
+    time they use rather than by how many requests they send; a waiting job can ask for its
+    place in line and an ETA from the durations observed so far.
+    """
+    
+    def __init__(self, max_active, max_per_user, max_per_game, max_queued, max_queued_per_user,
+                 max_wait_seconds, default_seconds):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.max_per_game = max_per_game
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait_seconds = max_wait_seconds
+        self._durations = dict(default_seconds)  # kind -> moving average of seconds per job
+        self._cond = threading.Condition()
+        self._running = []
+        self._queue = FairQueue()
+        self.started_total = 0
+        self.queued_total = 0
+        self.shed = Counter()
+    
+    def _has_room(self, ticket):
+        if self.max_active and len(self._running) >= self.max_active:
+            return False
+        if self.max_per_user and sum(job.user_id == ticket.user_id for job in self._running) >= self.max_per_user:
+            return False
+        if self.max_per_game and ticket.game_id and \
+                sum(job.game_id == ticket.game_id for job in self._running) >= self.max_per_game:
+            return False
+        return True
+    
+    def _start(self, ticket):
+        ticket.state = 'running'
+        ticket.started_at = time.monotonic()
+        self._running.append(ticket)
+        self.started_total += 1
+        return ticket
+    
+    def _shed(self, ticket, reason):
+        ticket.state = 'shed'
+        ticket.reason = reason
+        self.shed[reason] += 1
+        METRICS.inc('aidm_admission_shed_total', stage='jobs', reason=reason)
+        return ticket
+    
+    def acquire(self, kind, user_id, game_id=None):
+        """Ask to start a job; returns a ticket that is 'running', 'queued' (call wait()) or 'shed'"""
+        ticket = JobTicket(kind, user_id, game_id)
+        with self._cond:
+            # Start at once only if no queued job could take the free slot first
+            if self._has_room(ticket) and self._queue.first(self._has_room) is None:
+                return self._start(ticket)
+            if len(self._queue) >= self.max_queued:
+                return self._shed(ticket, 'queue_full')
+            if sum(job.user_id == user_id for job in self._queue.items()) >= self.max_queued_per_user:
+                return self._shed(ticket, 'user_queue_full')
+            ticket.state = 'queued'
+            ticket.queued_at = time.monotonic()
+            self._queue.push(ticket, user_id, cost=self._durations.get(kind, 1.0))
+            self.queued_total += 1
+            return ticket
+    
+    def wait(self, ticket, timeout):
+        """Wait up to timeout seconds for a queued ticket's turn; returns its state, still 'queued' on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while ticket.state == 'queued':
+                now = time.monotonic()
+                ticket.waited = now - ticket.queued_at
+                if self._queue.first(self._has_room) is ticket:
+                    self._queue.remove(ticket, served=True)
+                    self._start(ticket)
+                    self._cond.notify_all()
+                elif ticket.waited >= self.max_wait_seconds:
+                    self._queue.remove(ticket)
+                    self._shed(ticket, 'queue_timeout')
+                    self._cond.notify_all()
+                elif now >= deadline:
+                    break
+                else:
+                    self._cond.wait(min(deadline, ticket.queued_at + self.max_wait_seconds) - now)
+        return ticket.state
+    
+    def position(self, ticket):
+        """1-based place of a queued ticket in serving order, or 0"""
+        with self._cond:
+            return self._queue.position(ticket)
+    
+    def eta(self, ticket):
+        """Rough seconds until a queued ticket starts: the soonest blocking job's remaining time plus the work queued ahead"""
+        with self._cond:
+            now = time.monotonic()
+            full = self.max_active and len(self._running) >= self.max_active
+            blocking = [job for job in self._running
+                        if full or job.user_id == ticket.user_id or (ticket.game_id and job.game_id == ticket.game_id)]
+            soonest = min((max(0.0, self._durations.get(job.kind, 0) - (now - job.started_at)) for job in blocking),
+                          default=0.0)
+            ahead = self._queue.items()[:max(0, self._queue.position(ticket) - 1)]
+            work_ahead = sum(self._durations.get(job.kind, 0) for job in ahead)
+            return round(soonest + work_ahead / max(1, self.max_active or len(self._running)), 1)
+    
+    def release(self, ticket):
+        """Free a job's slot, or take it out of the queue. Safe to call more than once"""
+        with self._cond:
+            if ticket.state == 'queued':
+                self._queue.remove(ticket)
+            elif ticket.state == 'running':
+                self._running.remove(ticket)
+                elapsed = time.monotonic() - ticket.started_at
+                self._durations[ticket.kind] = self._durations.get(ticket.kind, elapsed) * 0.8 + elapsed * 0.2
+            else:
+                return
+            ticket.state = 'finished'
+            self._cond.notify_all()
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'running': Counter(job.kind for job in self._running),
+                'queued': Counter(job.kind for job in self._queue.items()),
+                'typical_seconds': {kind: round(seconds, 1) for kind, seconds in self._durations.items()},
+                'started_total': self.started_total,
+                'queued_total': self.queued_total,
+                'shed': dict(self.shed)
+            }
+
+JOB_SLOTS = JobSlots(JOBS_MAX_ACTIVE, JOBS_MAX_PER_USER, JOBS_MAX_PER_GAME, JOBS_MAX_QUEUED,
+                     JOBS_MAX_QUEUED_PER_USER, JOBS_MAX_WAIT_SECONDS, JOBS_DEFAULT_SECONDS)
+
+@app.teardown_request
+def release_job_slot(error=None):
+    # Non-streaming routes park their ticket on g; /stream releases its own when the stream ends
+    job = g.pop('job_ticket', None)
+    if job is not None:
+        JOB_SLOTS.release(job)
+
+ADMISSION_SHED_MESSAGES = {
+    'user_token_budget': "⏳ You've reached your hourly usage limit. Please take a short break and try again later.",
+    'user_cost_budget': "⏳ You've reached your daily usage limit. Please come back tomorrow.",
+    'global_cost_budget': "⏳ The Dungeon Master has reached today's usage limit. Please try again later.",
+    'queue_full': "🚦 The AI service is very busy right now. Please try again in a moment.",
+    'queue_timeout': "🚦 The AI service is very busy right now. Please try again in a moment.",
+    'user_queue_full': "✋ You already have several requests waiting. Please let them finish first.",
+}
+
 @app.route('/stream', methods=['POST', 'GET'])
 def stream_response():
     """Stream response for AI messages"""
@@ -508,50 +2527,89 @@ def stream_response():
         if model_id:
             session['selected_model'] = get_valid_model(model_id)
 
+    spans = TurnSpans(message_id)
+    include_timing = STREAM_TIMING_IN_DONE or request.args.get('timing') == '1'
+    
     # Determine storage mode and choose history source
     storage_mode = session.get('storage_mode', 'client-only')
-    if isinstance(message_id, str) and message_id in CLIENT_CONTEXT_CACHE:
-        chat_history = CLIENT_CONTEXT_CACHE.get(message_id, [])
-        # One-time use: delete to avoid lingering
-        try:
-            del CLIENT_CONTEXT_CACHE[message_id]
-        except KeyError:
-            pass
-    else:
-        chat_history = load_chat_history(user_id, game_id)
+    with spans.span('history_load'):
+        # One-time use: pop removes the context so it doesn't linger
+        chat_history = CLIENT_CONTEXT_CACHE.pop(message_id) if isinstance(message_id, str) else None
+        if chat_history is None:
+            chat_history = load_chat_history(user_id, game_id)
     # Print debug info
     app.logger.debug(f"Starting stream: game_id={game_id}, msg_id={message_id}, model={session.get('selected_model')}")
 
+    def done_event():
+        """Final SSE event of the turn; logs the turn's spans and attaches them when requested"""
+        timing = spans.summary()
+        log_event(logging.INFO, 'stream_turn_timing', **timing)
+        return f"event: done\ndata: {json.dumps({'timing': timing} if include_timing else {})}\n\n"
+    
+    def queued_event(stage, position, eta, waited):
+        """SSE event sent while the turn waits for a job slot ('jobs') or for upstream capacity ('upstream')"""
+        return f"event: queued\ndata: {json.dumps({'stage': stage, 'position': position, 'eta': eta, 'waited': round(waited, 1)})}\n\n"
+    
+    def shed_events(reason):
+        shed_message = ADMISSION_SHED_MESSAGES[reason]
+        yield f"data: {json.dumps({'content': shed_message, 'full': shed_message, 'error': True, 'admission': reason})}\n\n"
+        yield done_event()
+    
     def generate():
+        # Per-user and per-game caps: wait for a job slot, taking turns fairly with other users
+        queue_started = time.perf_counter()
+        job = JOB_SLOTS.acquire('stream', user_id, game_id)
+        try:
+            while job.state == 'queued':
+                yield queued_event('jobs', JOB_SLOTS.position(job), JOB_SLOTS.eta(job), job.waited)
+                JOB_SLOTS.wait(job, ADMISSION_HEARTBEAT_SECONDS)
+            spans.record('job_queue', queue_started, outcome=job.state, reason=job.reason)
+            if job.state == 'shed':
+                app.logger.warning(f"Stream for user {user_id} refused by job slots: {job.reason}")
+                yield from shed_events(job.reason)
+                return
+            if job.queued_at is not None:
+                METRICS.observe('aidm_job_queue_wait_seconds', job.waited, kind='stream')
+            yield from run_turn()
+        finally:
+            JOB_SLOTS.release(job)
+    
+    def run_turn():
         try:
             app.logger.debug("Starting generate() function")
             
-            # Check if there are multiple players in the session and gather names
-            player_counts = {}
-            
-            # Look for player names in the chat history
-            for msg in chat_history:
-                if msg.get("role") == "user" and msg.get("player"):
-                    player = msg.get("player")
-                    player_counts[player] = player_counts.get(player, 0) + 1
+            with spans.span('player_count'):
+                # Parse once; client-only contexts arrive already parsed from /chat
+                context_messages = as_context_messages(chat_history)
+                
+                # Check if there are multiple players in the session and gather names
+                player_counts = {}
+                
+                # Look for player names in the chat history
+                for msg in context_messages:
+                    if msg.role == "user" and msg.player:
+                        player_counts[msg.player] = player_counts.get(msg.player, 0) + 1
             
             # Check if multiple players are active
             is_multiplayer = len(player_counts) > 1
-            app.logger.debug(f"Is multiplayer: {is_multiplayer}, Player counts: {player_counts}")
             
             # Build the full system prompt based on game type
-            system_prompt = build_system_prompt(is_multiplayer)
+            with spans.span('system_prompt'):
+                system_prompt = build_system_prompt(is_multiplayer)
             app.logger.debug(f"System prompt built, length: {len(system_prompt)} characters")
             
             # Truncate chat history to prevent token limit issues
-            truncated_history = truncate_chat_history(chat_history, system_prompt)
-            app.logger.debug(f"Chat history truncated from {len(chat_history)} to {len(truncated_history)} messages")
+            with spans.span('truncation'):
+                truncated_history = truncate_chat_history(context_messages, system_prompt)
+            app.logger.debug(f"Chat history truncated from {len(context_messages)} to {len(truncated_history)} messages")
         except Exception as setup_error:
             error_details = f"Setup error: {str(setup_error)} (Type: {type(setup_error).__name__})"
             app.logger.error(f"Error in generate() setup: {error_details}")
             yield f"data: {json.dumps({'content': '🚨 Error preparing request. Please try again.', 'full': '🚨 Error preparing request. Please try again.', 'error': True, 'debug': error_details})}\n\n"
-            yield f"event: done\ndata: {{}}\n\n"
+            yield done_event()
             return
+        
+        payload_started = time.perf_counter()
           # Prepare messages for the API using full prompt
         api_messages = [
             {"role": "system", "content": system_prompt}
@@ -560,38 +2618,34 @@ def stream_response():
         
         # Include conversation history but format it properly for the API
         for msg in truncated_history:
-            if msg.get("role") == "system" and msg.get("player") == "system":
+            if msg.is_system_notice:
                 # This is a system notification (like player joining)
                 api_messages.append({
                     "role": "system", 
-                    "content": msg["content"]
+                    "content": msg.api_text
                 })
-            elif msg.get("role") == "user":
+            elif msg.role == "user":
                 # Format user messages with player labels if in multiplayer
                 prefix = ""
-                if is_multiplayer and msg.get("player"):
-                    player_num = msg.get("player").replace("player", "")
-                    prefix = f"Player {player_num}: "
+                if is_multiplayer and msg.player_label:
+                    prefix = f"Player {msg.player_label}: "
                 
-                # Strip HTML from user content before sending to API
-                clean_content = strip_html_tags(msg["content"])
+                # HTML was stripped from user content once, at ingest
                 api_messages.append({
                     "role": "user", 
-                    "content": prefix + clean_content
+                    "content": prefix + msg.api_text
                 })
             else:
-                # Assistant (DM) messages - strip HTML from content
-                clean_content = strip_html_tags(msg.get("content", ""))
+                # Assistant (DM) messages - HTML stripped at ingest
                 api_messages.append({
-                    "role": msg.get("role", "assistant"),
-                    "content": clean_content
+                    "role": msg.role or "assistant",
+                    "content": msg.api_text
                 })
         
-        # Log token usage for debugging
+        # Estimated tokens being sent (also decides the emergency truncation below)
         total_tokens = sum(estimate_tokens(msg.get("content", "")) for msg in api_messages)
-        app.logger.debug(f"Total estimated tokens being sent to API: {total_tokens}")
-        app.logger.debug(f"Number of messages being sent: {len(api_messages)}")
-        app.logger.debug(f"Full system prompt length: {len(system_prompt)} chars")
+        log_event(logging.DEBUG, 'stream_context', multiplayer=is_multiplayer, players=player_counts,
+                  messages=len(api_messages), estimated_tokens=total_tokens, system_prompt_chars=len(system_prompt))
         
         # Final safety check - if still too many tokens, further truncate
         if total_tokens > 45000:  # Increased from 30000 to 45000 to preserve more context
@@ -602,29 +2656,28 @@ def stream_response():
                 {"role": "system", "content": system_prompt}
             ]
             for msg in emergency_history:
-                if msg.get("role") == "system" and msg.get("player") == "system":
+                if msg.is_system_notice:
                     api_messages.append({
                         "role": "system", 
-                        "content": msg["content"]
+                        "content": msg.api_text
                     })
-                elif msg.get("role") == "user":
+                elif msg.role == "user":
                     prefix = ""
-                    if is_multiplayer and msg.get("player"):
-                        player_num = msg.get("player").replace("player", "")
-                        prefix = f"Player {player_num}: "
+                    if is_multiplayer and msg.player_label:
+                        prefix = f"Player {msg.player_label}: "
                     
                     api_messages.append({
                         "role": "user", 
-                        "content": prefix + msg["content"]
+                        "content": prefix + msg.api_text
                     })
                 else:
                     api_messages.append({
-                        "role": msg.get("role", "assistant"),
-                        "content": msg.get("content", "")
+                        "role": msg.role or "assistant",
+                        "content": msg.api_text
                     })
             
-            final_tokens = sum(estimate_tokens(msg.get("content", "")) for msg in api_messages)
-            app.logger.debug(f"After emergency truncation: {final_tokens} tokens, {len(api_messages)} messages")
+            total_tokens = sum(estimate_tokens(msg.get("content", "")) for msg in api_messages)
+            app.logger.debug(f"After emergency truncation: {total_tokens} tokens, {len(api_messages)} messages")
         
         # Get selected model from session, default to DEFAULT_MODEL_ID
         selected_model = get_valid_model(session.get('selected_model', DEFAULT_MODEL_ID))
@@ -632,9 +2685,11 @@ def stream_response():
         
         # Get model capabilities to determine which parameters to include
         capabilities = get_model_capabilities(selected_model)
-        app.logger.debug(f"Model capabilities: {capabilities}")        # Create structured payload for API
+        # Create structured payload for API
         payload = create_structured_api_payload(api_messages, selected_model, capabilities)
-        app.logger.debug(f"API payload created, size: {len(json.dumps(payload))} bytes")
+        spans.record('payload_build', payload_started)
+        log_event(logging.DEBUG, 'api_payload_built', model=selected_model, capabilities=capabilities,
+                  messages=len(payload['messages']), payload_bytes=lambda: len(json.dumps(payload)))
         
         headers = {
             "Authorization": f"Bearer {VENICE_API_KEY}",
@@ -643,7 +2698,25 @@ def stream_response():
         
         app.logger.debug(f"About to make API request to {VENICE_URL}")
         
+        # Admission control: an exhausted budget sheds the turn, a busy upstream queues it
+        admission_started = time.perf_counter()
+        ticket = ADMISSION.admit(user_id, selected_model, total_tokens)
+        full_response = ""
+        upstream_usage = None  # The upstream's own token counts, when it reports them
         try:
+            while ticket.state == 'queued':
+                yield queued_event('upstream', ADMISSION.position(ticket), ADMISSION.eta(ticket), ticket.waited)
+                ADMISSION.wait(ticket, ADMISSION_HEARTBEAT_SECONDS)
+            spans.record('admission', admission_started, outcome=ticket.state, reason=ticket.reason)
+            if ticket.state == 'shed':
+                app.logger.warning(f"Stream for user {user_id} shed by admission control: {ticket.reason}")
+                yield from shed_events(ticket.reason)
+                return
+            if ticket.queued_at is not None:
+                METRICS.observe('aidm_admission_wait_seconds', ticket.waited)
+            
+            upstream_started = time.perf_counter()
+            first_token_at = None
             with requests.post(
                 VENICE_URL,
                 json=payload,
@@ -652,15 +2725,18 @@ def stream_response():
                 timeout=60,
                 verify=True  # Re-enable SSL verification
             ) as response:
+                connected_at = time.perf_counter()
+                spans.record('upstream_connect', upstream_started, status=response.status_code)
                 full_response = ""
-                app.logger.debug(f"Venice API response status: {response.status_code}")
-                app.logger.debug(f"Venice API response headers: {response.headers}")
+                log_event(logging.DEBUG, 'upstream_response', status=response.status_code,
+                          headers=lambda: dict(response.headers))
                 
                 # Check if the response is successful
                 if response.status_code != 200:
                     app.logger.error(f"Venice API error: {response.status_code} - {response.text}")
+                    METRICS.inc('aidm_errors_total', type=f'upstream_status_{response.status_code}')
                     yield f"data: {json.dumps({'content': f'API Error: {response.status_code}', 'full': f'API Error: {response.status_code}', 'error': True})}\n\n"
-                    yield f"event: done\ndata: {{}}\n\n"
+                    yield done_event()
                     return
                 
                 # Check content type to determine if streaming or not
@@ -679,10 +2755,17 @@ def stream_response():
                                     if data_json.strip() == '[DONE]':
                                         break
                                     data = json.loads(data_json)
+                                    if data.get('usage'):
+                                        upstream_usage = data['usage']  # Final chunk with stream_options.include_usage
                                     if 'choices' in data and len(data['choices']) > 0:
                                         delta = data['choices'][0].get('delta', {})
                                         content = delta.get('content', '')
                                         if content:
+                                            if first_token_at is None:
+                                                spans.record('upstream_first_byte', connected_at)
+                                                first_token_at = time.perf_counter()
+                                                METRICS.observe('aidm_stream_time_to_first_token_seconds',
+                                                                first_token_at - upstream_started, model=selected_model)
                                             full_response += content
                                             yield f"data: {json.dumps({'content': content, 'full': full_response})}\n\n"
                                 except Exception as e:
@@ -693,12 +2776,16 @@ def stream_response():
                     app.logger.debug("Processing as non-streaming JSON response")
                     try:
                         response_data = response.json()
-                        app.logger.debug(f"Non-streaming response data: {response_data}")
+                        log_event(logging.DEBUG, 'upstream_body', body=lambda: response_data)
+                        upstream_usage = response_data.get('usage')
                         
                         if 'choices' in response_data and len(response_data['choices']) > 0:
                             choice = response_data['choices'][0]
                             if 'message' in choice and 'content' in choice['message']:
                                 full_response = choice['message']['content']
+                                spans.record('upstream_first_byte', connected_at)
+                                METRICS.observe('aidm_stream_time_to_first_token_seconds',
+                                                time.perf_counter() - upstream_started, model=selected_model)
                                 app.logger.debug(f"Extracted content length: {len(full_response)}")                                # Send the full response at once
                                 yield f"data: {json.dumps({'content': full_response, 'full': full_response})}\n\n"
                             else:
@@ -716,30 +2803,41 @@ def stream_response():
                         app.logger.error(f"Raw response: {response.text}")
                         yield f"data: {json.dumps({'content': 'Error parsing AI response', 'full': 'Error parsing AI response', 'error': True})}\n\n"
                 
+                spans.record('upstream_last_byte', first_token_at or connected_at)
+                # Upstream is done with this turn: record its usage and free the slot before any images
+                output_tokens, input_tokens = reply_token_usage(upstream_usage, full_response)
+                ADMISSION.finish(ticket, output_tokens, input_tokens)
+                
                 # Store the complete response in chat history (skipped in client-only save)
                 if full_response:
+                    METRICS.inc('aidm_stream_output_tokens_total', output_tokens, model=selected_model)
+                    # A non-streamed reply arrives in one piece, so its rate spans the whole request
+                    generation_seconds = time.perf_counter() - (first_token_at or upstream_started)
+                    if generation_seconds > 0:
+                        METRICS.observe('aidm_stream_tokens_per_second', output_tokens / generation_seconds, model=selected_model)
+                    
                     # Process image generation requests first
-                    processed_response, image_requests = process_image_requests(full_response)
+                    with spans.span('image_tags'):
+                        processed_response, image_requests = process_image_requests(full_response)
                     
                     # Always format the content before storing
-                    formatted_content = format_message_content(processed_response)
-                    chat_history.append({"role": "assistant", "content": formatted_content})
+                    with spans.span('formatting'):
+                        formatted_content = format_message_content(processed_response)
+                    assistant_message = {"role": "assistant", "content": formatted_content}
                     # Will no-op in client-only mode
-                    save_chat_history(user_id, chat_history, game_id)
+                    with spans.span('history_save'):
+                        append_chat_message(user_id, assistant_message, game_id)
                     app.logger.debug(f"Saved formatted response to chat history, length: {len(formatted_content)}")                    # Generate images if requested and yield them to the client
                     if image_requests:
                         app.logger.debug(f"Found {len(image_requests)} image requests to generate")
+                        image_owner = image_store_owner(user_id)
                         for i, prompt in enumerate(image_requests):
                             app.logger.debug(f"Generating image {i+1}/{len(image_requests)}: {prompt[:50]}..." )
+                            image_started = time.perf_counter()
                             try:
                                 # Generate the image and get the data
                                 selected_model = session.get('selected_image_model', DEFAULT_IMAGE_MODEL_ID)
                                 
-                                headers = {
-                                    "Authorization": f"Bearer {VENICE_API_KEY}",
-                                    "Content-Type": "application/json"
-                                }
-                                
                                 payload = {
                                     "model": selected_model,
                                     "prompt": prompt,
@@ -755,84 +2853,110 @@ def stream_response():
                                     "seed": 0
                                 }
                                 
-                                response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
+                                # Generate unique image ID for mobile-friendly storage
+                                import hashlib
+                                image_id = hashlib.md5(f"{prompt}{time.time()}".encode()).hexdigest()[:12]
+                                preview_payload = image_preview_payload(payload)
                                 
-                                if response.status_code == 200:
-                                    result = response.json()
-                                    
-                                    if 'images' in result and result['images']:
-                                        image_data = result['images'][0] if isinstance(result['images'], list) else result['images']
-                                        
-                                        # Validate the image data
-                                        if not isinstance(image_data, str) or len(image_data) < 100:
-                                            app.logger.error(f"Invalid image data received for prompt '{prompt}': length={len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
-                                            continue
-                                        
-                                        image_url = f"data:image/png;base64,{image_data}"
-                                        app.logger.debug(f"Generated image URL length: {len(image_url)} for prompt: {prompt[:30]}...")
-                                          # Generate unique image ID for mobile-friendly storage
-                                        import hashlib
-                                        image_id = hashlib.md5(f"{prompt}{time.time()}".encode()).hexdigest()[:12]
-                                        
-                                        # Create image message with better formatting - mobile-friendly storage
-                                        image_message = {
-                                            "role": "assistant",
-                                            "content": f'<div class="image-message"><img src="/get_image/{image_id}" alt="{prompt}" style="max-width: 100%; border-radius: 8px; margin: 10px 0; display: block;"><div class="image-caption"><em>Generated image: {prompt}</em></div></div>',
-                                            "text": prompt,  # Add text field for compatibility
-                                            "timestamp": time.time(),
-                                            "message_type": "image",
-                                            "image_url": image_url,  # Keep full URL for server storage
-                                            "image_reference": image_id,  # Reference for efficient client storage
-                                            "image_prompt": prompt,
-                                            "image_model": selected_model,
-                                            "sender": "assistant",  # Changed from "DM" to "assistant" for consistency
-                                            "type": "dm",
-                                            "images": [f"/get_image/{image_id}"],  # Use reference for localStorage
-                                            "storage_optimized": True
-                                        }
-                                        
-                                        # Add to chat history (no-op save in client-only mode)
-                                        chat_history.append(image_message)
-                                        save_chat_history(user_id, chat_history, game_id)
-                                        
-                                        # Send the image data to the client via the stream
-                                        yield f"data: {json.dumps({'image_generated': True, 'image_message': image_message})}\n\n"
-                                        
-                                        app.logger.debug(f"Successfully generated and streamed image for prompt: {prompt[:50]}...")
+                                if preview_payload:
+                                    # Full render runs alongside the quick preview, which is pushed as soon as it arrives
+                                    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-render') as render_pool:
+                                        full_render = render_pool.submit(request_image, payload, image_owner, image_id)
+                                        try:
+                                            with spans.span('image_preview', index=i):
+                                                preview_url = request_image(preview_payload, None, image_id, phase='preview')
+                                        except Exception as preview_error:
+                                            preview_url = None
+                                            app.logger.warning(f"Image preview failed for prompt '{prompt[:50]}': {str(preview_error)}")
+                                        if preview_url and not full_render.done():
+                                            yield f"data: {json.dumps({'image_preview': True, 'image_id': image_id, 'image_prompt': prompt, 'preview_url': preview_url})}\n\n"
+                                        image_url = full_render.result()
                                 else:
-                                    app.logger.error(f"Image generation failed for prompt '{prompt}': {response.status_code}")
+                                    image_url = request_image(payload, image_owner, image_id)
+                                spans.record('image', image_started, index=i, ok=bool(image_url))
+                                
+                                if image_url:
+                                    # Variants and the placeholder only exist for images kept in the image store
+                                    variant_attrs = ''
+                                    image_style = 'max-width: 100%; border-radius: 8px; margin: 10px 0; display: block;'
+                                    if image_owner:
+                                        variant_attrs = f' srcset="{image_srcset(image_id)}" sizes="(max-width: 600px) 100vw, 600px"'
+                                        image_style += f' background: center / cover no-repeat url(/get_image/{image_id}?size=placeholder);'
+                                    
+                                    # Create image message with better formatting - mobile-friendly storage
+                                    image_message = {
+                                        "role": "assistant",
+                                        "content": f'<div class="image-message"><img src="/get_image/{image_id}"{variant_attrs} alt="{prompt}" style="{image_style}"><div class="image-caption"><em>Generated image: {prompt}</em></div></div>',
+                                        "text": prompt,  # Add text field for compatibility
+                                        "timestamp": time.time(),
+                                        "message_type": "image",
+                                        "image_url": image_url,  # Full data URL, or the /get_image reference in binary mode
+                                        "image_reference": image_id,  # Reference for efficient client storage
+                                        "image_prompt": prompt,
+                                        "image_model": selected_model,
+                                        "sender": "assistant",  # Changed from "DM" to "assistant" for consistency
+                                        "type": "dm",
+                                        "images": [f"/get_image/{image_id}"],  # Use reference for localStorage
+                                        "storage_optimized": True
+                                    }
+                                    
+                                    duplicate_of = None
+                                    if image_owner:
+                                        image_message["image_srcset"] = image_srcset(image_id)
+                                        image_message["image_placeholder"] = f"/get_image/{image_id}?size=placeholder"
+                                        duplicate_of = stored_image_duplicate_of(image_owner, image_id)
+                                        if duplicate_of:
+                                            image_message["image_duplicate_of"] = duplicate_of
+                                    
+                                    # Add to chat history (no-op save in client-only mode); near-duplicates
+                                    # share the stored blob, so history only keeps the reference
+                                    stored_message = dict(image_message, image_url=f"/get_image/{image_id}") if duplicate_of else image_message
+                                    append_chat_message(user_id, stored_message, game_id)
+                                    
+                                    # Send the image data to the client via the stream
+                                    yield f"data: {json.dumps({'image_generated': True, 'image_message': image_message})}\n\n"
+                                    
+                                    app.logger.debug(f"Successfully generated and streamed image for prompt: {prompt[:50]}...")
                                     
                             except Exception as e:
                                 app.logger.error(f"Error generating image for prompt '{prompt}': {str(e)}")
+                                METRICS.inc('aidm_errors_total', type='image_generation')
+                                spans.record('image', image_started, index=i, ok=False)
                                 # Add error message to chat
                                 error_msg = {"role": "assistant", "content": f"<div class='system-message'><em>Error generating image: {prompt[:50]}...</em></div>", "message_type": "system"}
-                                chat_history.append(error_msg)
-                                save_chat_history(user_id, chat_history, game_id)
+                                append_chat_message(user_id, error_msg, game_id)
                     else:
                         app.logger.debug("No image requests found in response")
                   
                 # Send done event to signal completion
-                yield f"event: done\ndata: {{}}\n\n"
+                yield done_event()
         except requests.exceptions.SSLError as ssl_error:
             error_details = f"SSL Error: {str(ssl_error)}"
             app.logger.error(f"SSL Error connecting to Venice AI: {error_details}")
+            METRICS.inc('aidm_errors_total', type='upstream_ssl')
             yield f"data: {json.dumps({'content': '🚨 Connection error with AI service. Please try again in a moment.', 'full': '🚨 Connection error with AI service. Please try again in a moment.', 'error': True, 'debug': error_details})}\n\n"
-            yield f"event: done\ndata: {{}}\n\n"
+            yield done_event()
         except requests.exceptions.ConnectionError as conn_error:
             error_details = f"Connection Error: {str(conn_error)}"
             app.logger.error(f"Connection Error to Venice AI: {error_details}")
+            METRICS.inc('aidm_errors_total', type='upstream_connection')
             yield f"data: {json.dumps({'content': '🚨 Unable to connect to AI service. Please check your internet connection and try again.', 'full': '🚨 Unable to connect to AI service. Please check your internet connection and try again.', 'error': True, 'debug': error_details})}\n\n"
-            yield f"event: done\ndata: {{}}\n\n"
+            yield done_event()
         except requests.exceptions.Timeout as timeout_error:
             error_details = f"Timeout Error: {str(timeout_error)}"
             app.logger.error(f"Timeout Error connecting to Venice AI: {error_details}")
+            METRICS.inc('aidm_errors_total', type='upstream_timeout')
             yield f"data: {json.dumps({'content': '🚨 Request timed out. Please try again.', 'full': '🚨 Request timed out. Please try again.', 'error': True, 'debug': error_details})}\n\n"
-            yield f"event: done\ndata: {{}}\n\n"
+            yield done_event()
         except Exception as e:
             error_details = f"Unexpected error: {str(e)} (Type: {type(e).__name__})"
             app.logger.error(f"Error in API request: {error_details}")
+            METRICS.inc('aidm_errors_total', type=type(e).__name__)
             yield f"data: {json.dumps({'content': f'🚨 Unexpected error: Please try again.', 'full': f'🚨 Unexpected error: Please try again.', 'error': True, 'debug': error_details})}\n\n"
-            yield f"event: done\ndata: {{}}\n\n"
+            yield done_event()
+        finally:
+            # Errors and disconnected clients still leave the queue and pay for any partial reply
+            ADMISSION.finish(ticket, *reply_token_usage(upstream_usage, full_response))
     
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
@@ -850,29 +2974,11 @@ def new_game():
         random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=9))
         new_game_id = f"game_{timestamp}_{random_str}"
         
-        deleted_files = 0
-        
         # Handle cleanup based on storage mode
         if storage_mode == 'hybrid':
-            # PRIVACY: Completely erase all previous chat history files for this user
-            try:
-                chat_files = os.listdir(CHAT_DIR)
-                user_files = [f for f in chat_files if f.startswith(f"chat_history_{user_id}_")]
-                
-                for file_name in user_files:
-                    file_path = os.path.join(CHAT_DIR, file_name)
-                    try:
-                        os.remove(file_path)
-                        deleted_files += 1
-                        app.logger.info(f"Privacy cleanup: Deleted {file_name}")
-                    except Exception as e:
-                        app.logger.error(f"Error deleting {file_name}: {str(e)}")
-                
-                app.logger.info(f"Privacy cleanup: Deleted {deleted_files} chat history files for user {user_id}")
-                
-            except Exception as e:
-                app.logger.error(f"Error during privacy cleanup: {str(e)}")
-                # Continue even if cleanup fails
+            # PRIVACY: Erase all previous chat history files for this user in the background
+            new_game_file = os.path.basename(get_chat_file_path(user_id, new_game_id))
+            RETENTION_SWEEPER.schedule_purge(user_id, keep_files=[new_game_file])
         
         # Create empty chat history for new game (only in hybrid mode)
         chat_history = []
@@ -884,9 +2990,9 @@ def new_game():
             "success": True,
             "storage_mode": storage_mode,
             "privacy_cleanup": storage_mode == 'hybrid',
-            "server_files_deleted": deleted_files,
+            "privacy_cleanup_scheduled": storage_mode == 'hybrid',
             "message": f"New game created in {storage_mode} mode. " + 
-                      (f"All previous server histories deleted for privacy." if storage_mode == 'hybrid' and deleted_files > 0 
+                      (f"Previous server histories are being deleted for privacy." if storage_mode == 'hybrid'
                        else "No server storage - maximum privacy mode." if storage_mode == 'client-only'
                        else "Ready to start.")
         }
@@ -943,8 +3049,7 @@ def get_updates():
     
     try:
         # Read the full chat history
-        with open(file_path, 'r') as file:
-            chat_history = json.load(file)
+        chat_history = read_history_cached(file_path)
         
         result = {
             "success": True,
@@ -956,12 +3061,9 @@ def get_updates():
             new_messages = chat_history[last_message_count:]
             result["has_updates"] = True
             result["new_messages"] = new_messages
-            app.logger.debug(f"get_updates: Found {len(new_messages)} new messages for game {game_id}")
-            
-            # Log message types for debugging
-            for i, msg in enumerate(new_messages):
-                msg_type = msg.get('message_type', 'text')
-                app.logger.debug(f"get_updates: Message {i}: type={msg_type}, role={msg.get('role', 'unknown')}")
+            log_event(logging.DEBUG, 'update_messages', game_id=game_id, count=len(new_messages),
+                      messages=lambda: [{'type': msg.get('message_type', 'text'), 'role': msg.get('role', 'unknown')}
+                                        for msg in new_messages])
         else:
             result["has_updates"] = False
             result["new_messages"] = []
@@ -973,6 +3075,96 @@ def get_updates():
         app.logger.error(f"Error checking for updates: {str(e)}")
         return jsonify({"success": False, "error": str(e)})
 
+@app.route('/subscribe_updates', methods=['GET'])
+def subscribe_updates():
+    """
+    Push new chat messages for a game over SSE instead of polling /get_updates.
+    The client's cursor is its message count; it is sent back as the SSE event id so
+    EventSource resumes from the right place (via Last-Event-ID) after a reconnect.
+    """
+    user_id = get_user_id()
+    game_id = request.args.get('game_id')
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor', 0)
+    try:
+        cursor = max(0, int(cursor))
+    except (TypeError, ValueError):
+        cursor = 0
+    
+    if not game_id:
+        return jsonify({"success": False, "error": "No game ID provided"}), 400
+    
+    file_path = get_chat_file_path(user_id, game_id)
+    
+    def load_snapshot():
+        # Returns (history, stat signature) - only called on connect or when another worker wrote the file
+        try:
+            stat = os.stat(file_path)
+            return read_history_cached(file_path), (stat.st_mtime_ns, stat.st_size)
+        except (OSError, ValueError):
+            return [], None
+    
+    def generate():
+        nonlocal cursor
+        state = GAME_UPDATES.subscribe(file_path)
+        try:
+            chat_history, file_signature = load_snapshot()
+            seen_version = state['version']
+            started = time.time()
+            
+            while True:
+                if len(chat_history) > cursor:
+                    new_messages = chat_history[cursor:]
+                    cursor = len(chat_history)
+                    yield f"id: {cursor}\ndata: {json.dumps({'new_messages': new_messages, 'message_count': cursor})}\n\n"
+                elif len(chat_history) < cursor:
+                    # History shrank (undo/cleanup) - the client has to reload it
+                    cursor = len(chat_history)
+                    yield f"id: {cursor}\nevent: reset\ndata: {json.dumps({'message_count': cursor})}\n\n"
+                
+                remaining = UPDATE_STREAM_MAX_SECONDS - (time.time() - started)
+                if remaining <= 0:
+                    break
+                
+                with state['condition']:
+                    if state['version'] == seen_version:
+                        state['condition'].wait(timeout=min(UPDATE_STREAM_KEEPALIVE_SECONDS, remaining))
+                    woken = state['version'] != seen_version
+                    seen_version = state['version']
+                    if woken:
+                        chat_history = state['history']
+                
+                if DRAINING.is_set():
+                    break  # EventSource reconnects (with Last-Event-ID) to a worker that is staying up
+                
+                if woken and chat_history is None:
+                    chat_history, file_signature = load_snapshot()
+                    continue
+                if woken:
+                    try:
+                        stat = os.stat(file_path)
+                        file_signature = (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        file_signature = None
+                    continue
+                
+                # Timed out: another worker may have written the file, so check its stat before reparsing
+                try:
+                    stat = os.stat(file_path)
+                    current_signature = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    current_signature = None
+                if current_signature != file_signature:
+                    chat_history, file_signature = load_snapshot()
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            GAME_UPDATES.unsubscribe(file_path)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/set_player_name', methods=['POST'])
 def set_player_name():
     try:
@@ -985,14 +3177,16 @@ def set_player_name():
         if not (game_id and new_name):
             return jsonify({"success": False, "error": "Missing game_id or new_name"}), 400
 
-        # Load the chat history for the specified game
-        chat_history = load_chat_history(user_id, game_id)
         # Update every message from this player with the new name
-        for msg in chat_history:
-            if msg.get("role") == "user" and msg.get("player") == f"player{player_number}":
-                msg["player"] = new_name
-        # Save the updated chat history
-        save_chat_history(user_id, chat_history, game_id)
+        def rename_player(chat_history):
+            renamed = 0
+            for msg in chat_history:
+                if msg.get("role") == "user" and msg.get("player") == f"player{player_number}":
+                    msg["player"] = new_name
+                    renamed += 1
+            return renamed or None  # Nothing to rewrite when the player has no messages yet
+        
+        update_chat_history(user_id, rename_player, game_id)
         return jsonify({"success": True})
     except Exception as e:
         app.logger.error(f"Error in /set_player_name: {str(e)}")
@@ -1062,6 +3256,13 @@ def generate_image():
         if not game_id:
             return jsonify({"success": False, "error": "Missing game_id"}), 400
         
+        # Image calls take a job slot too, waiting their fair turn behind other users' work
+        job = g.job_ticket = JOB_SLOTS.acquire('image', user_id, game_id)
+        if JOB_SLOTS.wait(job, JOBS_MAX_WAIT_SECONDS) != 'running':
+            return jsonify({"success": False, "error": ADMISSION_SHED_MESSAGES[job.reason], "admission": job.reason}), 429
+        if job.queued_at is not None:
+            METRICS.observe('aidm_job_queue_wait_seconds', job.waited, kind='image')
+        
         # Get selected image model from session or use default
         selected_model = session.get('selected_image_model', DEFAULT_IMAGE_MODEL_ID)
         
@@ -1085,43 +3286,48 @@ def generate_image():
             "hide_watermark": True
         }
         
-        # Make request to Venice AI
-        response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
-        
-        if response.status_code != 200:
-            app.logger.error(f"Venice AI image generation failed: {response.status_code} - {response.text}")
-            return jsonify({"success": False, "error": f"Image generation failed: {response.text}"}), 500
-        
-        result = response.json()
-        
-        # Check if we have the expected data structure (Venice AI uses 'images' field with base64 data)
-        if 'images' not in result or not result['images']:
-            app.logger.error(f"Invalid response from Venice AI: {result}")
-            return jsonify({"success": False, "error": "Invalid response from image API"}), 500
-
-        # Extract the base64 image data from the 'images' field
-        images_field = result['images']
-        
-        if isinstance(images_field, list) and len(images_field) > 0:
-            # Venice AI returns a list with base64 string as first element
-            image_data = images_field[0]
-        elif isinstance(images_field, str):
-            # Sometimes might return directly as string
-            image_data = images_field
+        if IMAGE_BINARY_TRANSFER:
+            # Raw bytes stream straight into the image store; only the reference URL goes further
+            image_id = secrets.token_hex(6)
+            with METRICS.time('aidm_image_generation_seconds', model=selected_model, phase='full'):
+                image_url = fetch_image_binary(payload, user_id, image_id)
         else:
-            app.logger.error(f"Unexpected images format: {type(images_field)}")
-            return jsonify({"success": False, "error": "Invalid response from image API"}), 500
-        
-        # Validate the base64 data
-        if not isinstance(image_data, str) or len(image_data) < 100:
-            app.logger.error(f"Invalid base64 data. Type: {type(image_data)}, Length: {len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
-            return jsonify({"success": False, "error": "Invalid response from image API"}), 500
-        
-        # Create data URL from base64 image data
-        image_url = f"data:image/png;base64,{image_data}"
-        
-        # Save the image message to chat history
-        chat_history = load_chat_history(user_id, game_id)
+            # Make request to Venice AI
+            with METRICS.time('aidm_image_generation_seconds', model=selected_model, phase='full'):
+                response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
+            
+            if response.status_code != 200:
+                app.logger.error(f"Venice AI image generation failed: {response.status_code} - {response.text}")
+                METRICS.inc('aidm_errors_total', type=f'image_upstream_status_{response.status_code}')
+                return jsonify({"success": False, "error": f"Image generation failed: {response.text}"}), 500
+            
+            result = response.json()
+            
+            # Check if we have the expected data structure (Venice AI uses 'images' field with base64 data)
+            if 'images' not in result or not result['images']:
+                app.logger.error(f"Invalid response from Venice AI: {result}")
+                return jsonify({"success": False, "error": "Invalid response from image API"}), 500
+    
+            # Extract the base64 image data from the 'images' field
+            images_field = result['images']
+            
+            if isinstance(images_field, list) and len(images_field) > 0:
+                # Venice AI returns a list with base64 string as first element
+                image_data = images_field[0]
+            elif isinstance(images_field, str):
+                # Sometimes might return directly as string
+                image_data = images_field
+            else:
+                app.logger.error(f"Unexpected images format: {type(images_field)}")
+                return jsonify({"success": False, "error": "Invalid response from image API"}), 500
+            
+            # Validate the base64 data
+            if not isinstance(image_data, str) or len(image_data) < 100:
+                app.logger.error(f"Invalid base64 data. Type: {type(image_data)}, Length: {len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
+                return jsonify({"success": False, "error": "Invalid response from image API"}), 500
+            
+            # Create data URL from base64 image data
+            image_url = f"data:image/png;base64,{image_data}"
         
         # Add image message to history
         image_message = {
@@ -1134,8 +3340,7 @@ def generate_image():
             "image_model": selected_model
         }
         
-        chat_history.append(image_message)
-        save_chat_history(user_id, chat_history, game_id)
+        append_chat_message(user_id, image_message, game_id)
         
         return jsonify({
             "success": True,
@@ -1162,36 +3367,39 @@ def undo_messages():
         if not game_id:
             return jsonify({"success": False, "error": "No game ID provided"})
 
-        # Load current chat history
-        chat_history = load_chat_history(user_id, game_id)
+        def undo_last_exchange(chat_history):
+            if len(chat_history) <= 1:  # Don't undo if only welcome message exists
+                return None
 
-        if len(chat_history) <= 1:  # Don't undo if only welcome message exists
-            return jsonify({"success": False, "error": "Nothing to undo"})
+            # Work backwards to find the last user message
+            last_user_idx = None
+            for i in range(len(chat_history) - 1, -1, -1):
+                message = chat_history[i]
+                if message.get("role") == "user" and not message.get("is_system", False):
+                    last_user_idx = i
+                    break
 
-        # Work backwards to find the last user message
-        last_user_idx = None
-        for i in range(len(chat_history) - 1, -1, -1):
-            message = chat_history[i]
-            if message.get("role") == "user" and not message.get("is_system", False):
-                last_user_idx = i
-                break
+            if last_user_idx is None:
+                return None
 
-        if last_user_idx is None:
-            return jsonify({"success": False, "error": "No user message to undo"})
+            undone_messages = [chat_history[last_user_idx]]
+            # Remove the user message
+            del chat_history[last_user_idx]
 
-        undone_messages = [chat_history[last_user_idx]]
-        # Remove the user message
-        del chat_history[last_user_idx]
+            # If the next message (at the same index, since we just deleted) is an assistant, remove it too
+            if last_user_idx < len(chat_history):
+                next_msg = chat_history[last_user_idx]
+                if next_msg.get("role") == "assistant":
+                    undone_messages.append(next_msg)
+                    del chat_history[last_user_idx]
 
-        # If the next message (at the same index, since we just deleted) is an assistant, remove it too
-        if last_user_idx < len(chat_history):
-            next_msg = chat_history[last_user_idx]
-            if next_msg.get("role") == "assistant":
-                undone_messages.append(next_msg)
-                del chat_history[last_user_idx]
+            return undone_messages, chat_history
 
-        # Save the updated chat history
-        save_chat_history(user_id, chat_history, game_id)
+        # Load, trim and save the history under the per-game lock (None: nothing was removed or saved)
+        undo_result = update_chat_history(user_id, undo_last_exchange, game_id)
+        if undo_result is None:
+            return jsonify({"success": False, "error": "No user message to undo"})
+        undone_messages, chat_history = undo_result
 
         app.logger.debug(f"Undo operation: Removed {len(undone_messages)} messages from server history")
 
@@ -1219,9 +3427,11 @@ def truncate_chat_history(chat_history, system_prompt, max_tokens=45000):  # Inc
     """
     Truncate chat history to stay within token limits while preserving recent context.
     Keeps the most recent messages and important system messages.
+    Returns ContextMessage entries (message dicts are parsed first).
     """
     if not chat_history:
         return []
+    chat_history = as_context_messages(chat_history)
     
     # Estimate system prompt tokens
     system_tokens = estimate_tokens(system_prompt)
@@ -1241,15 +3451,14 @@ def truncate_chat_history(chat_history, system_prompt, max_tokens=45000):  # Inc
     
     # Reverse iteration to prioritize recent messages
     for i, msg in enumerate(reversed(chat_history)):
-        msg_content = msg.get("content", "")
-        msg_tokens = estimate_tokens(msg_content)
+        msg_tokens = msg.token_count
         
         # Force inclusion of the last few messages regardless of token count
         if i < min_messages_to_keep:
             truncated_history.insert(0, msg)
             current_tokens += msg_tokens
         # Always include very short messages or important system messages
-        elif msg_tokens < 50 or (msg.get("role") == "system" and msg.get("player") == "system"):
+        elif msg_tokens < 50 or msg.is_system_notice:
             truncated_history.insert(0, msg)
             current_tokens += msg_tokens
         elif current_tokens + msg_tokens <= available_tokens:
@@ -1292,6 +3501,7 @@ def create_structured_api_payload(api_messages, selected_model, capabilities):
         "top_p": 0.95,
         "n": 1,
         "stream": True,
+        "stream_options": {"include_usage": True},  # Final chunk reports the real token counts for the usage ledger
         "presence_penalty": 0.2,
         "frequency_penalty": 0.1
     }
@@ -1326,6 +3536,97 @@ def debug_env():
     except Exception as e:
         return jsonify({'error': str(e)})
 
+@app.route('/debug/caches', methods=['GET'])
+def debug_caches():
+    """Debug endpoint to check this worker's in-memory cache sizes, hit rates and evictions, and its job slot queues"""
+    return jsonify({
+        'pid': os.getpid(),
+        'history_cache': HISTORY_CACHE.stats(),
+        'client_context_cache': CLIENT_CONTEXT_CACHE.stats(),
+        'rolling_contexts': ROLLING_CONTEXTS.stats(),
+        'image_pipeline': IMAGE_PIPELINE.stats(),
+        'compress_pool': COMPRESS_POOL.stats(),
+        'job_slots': JOB_SLOTS.stats(),
+        'debug': True
+    })
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Load balancer health check; 503 once this worker is draining for shutdown"""
+    draining = DRAINING.is_set()
+    return jsonify({"success": not draining, "pid": os.getpid(), "draining": draining}), 503 if draining else 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint covering every live worker on this host"""
+    if not METRICS_ENABLED:
+        return jsonify({"success": False, "error": "Metrics are disabled"}), 404
+    if METRICS_TOKEN:
+        if not secrets.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                      f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+            return jsonify({"success": False, "error": "Unauthorized"}), 401
+    elif not METRICS_PUBLIC and (request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers):
+        # No token: a scraper on this host only. A local reverse proxy would make everyone look local.
+        return jsonify({"success": False, "error": "Not found"}), 404
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """Admin: stored request profiles, newest first"""
+    if not is_admin_request():
+        return jsonify({"success": False, "error": "Not found"}), 404
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for entry in os.scandir(PROFILE_DIR):
+            match = PROFILE_NAME_RE.match(entry.name)
+            if match:
+                profiles.append({
+                    "id": entry.name,
+                    "created": int(match.group(1)) / 1000,
+                    "pid": int(match.group(2)),
+                    "endpoint": match.group(3),
+                    "trigger": match.group(4),
+                    "format": match.group(5),
+                    "size_bytes": entry.stat().st_size
+                })
+    profiles.sort(key=lambda profile: profile["created"], reverse=True)
+    return jsonify({"success": True, "profiles": profiles, "mode": PROFILE_MODE, "sample_rate": PROFILE_SAMPLE_RATE})
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Admin: download one profile (folded stacks as text, pstats as binary)"""
+    if not is_admin_request() or not PROFILE_NAME_RE.match(profile_id):
+        return jsonify({"success": False, "error": "Not found"}), 404
+    mimetype = 'text/plain' if profile_id.endswith('.folded') else 'application/octet-stream'
+    return send_from_directory(os.path.abspath(PROFILE_DIR), profile_id, mimetype=mimetype, as_attachment=True)
+
+@app.route('/admin/usage', methods=['GET'])
+def get_usage():
+    """Admin: token and cost totals for the budget windows, globally or for ?user_id=, plus admission state"""
+    if not is_admin_request():
+        return jsonify({"success": False, "error": "Not found"}), 404
+    user_id = request.args.get('user_id')
+    windows = {'last_minute': 60, 'last_hour': 3600, 'last_day': 86400}
+    usage = {}
+    for name, seconds in windows.items():
+        tokens, cost = USAGE_LEDGER.totals(seconds, user_id)
+        usage[name] = {'tokens': tokens, 'cost_usd': round(cost, 6)}
+    return jsonify({
+        "success": True,
+        "user_id": user_id,
+        "usage": usage,
+        "budgets": {
+            "user_tokens_per_hour": USER_TOKEN_BUDGET_PER_HOUR,
+            "user_cost_per_day": USER_COST_BUDGET_PER_DAY,
+            "global_cost_per_day": GLOBAL_COST_BUDGET_PER_DAY,
+            "upstream_max_streams": UPSTREAM_MAX_STREAMS,
+            "upstream_tokens_per_minute": UPSTREAM_TOKENS_PER_MINUTE
+        },
+        "ledger": USAGE_LEDGER.stats(),
+        "admission": ADMISSION.stats(),
+        "pid": os.getpid()
+    })
+
 @app.route('/debug/venice', methods=['GET'])
 def debug_venice():
     """Debug endpoint to test Venice API directly"""
@@ -1362,11 +3663,500 @@ def debug_venice():
         app.logger.error(f"Debug Venice API test failed: {str(e)}")
         return jsonify({'error': str(e), 'error_type': type(e).__name__})
 
+SAFE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+IMAGE_MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif', 'png': 'image/png', 'jpg': 'image/jpeg'}
+# Image-store file name: the image's prefix, then a variant width or placeholder marker, then the extension
+IMAGE_FILE_RE = re.compile(r'^(?P<prefix>.+?)(?P<variant>_w\d+|_placeholder)?\.(?P<ext>[a-z]+)$')
+
+def sniff_image_extension(image_bytes):
+    """File extension from the image's magic bytes (Venice labels everything png)"""
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'webp'
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if image_bytes[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if image_bytes[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'avif'
+    return None
+
+def image_store_prefix(user_id, image_id):
+    """Path prefix for an image's stored files; the user_id prefix keeps images private to their owner"""
+    if not SAFE_ID_RE.match(user_id or '') or not SAFE_ID_RE.match(image_id or ''):
+        return None
+    return os.path.join(IMAGE_DIR, f"{user_id}_{image_id}")
+
+def resolve_image_prefix(user_id, prefix):
+    """Follow a near-duplicate's alias to the image whose files it shares"""
+    try:
+        with open(f"{prefix}.alias") as f:
+            canonical_id = f.read().strip()
+    except OSError:
+        return prefix
+    return image_store_prefix(user_id, canonical_id) or prefix
+
+def image_file_group(file_path):
+    """
+    Prefix of the stored image a file belongs to: originals, variants, placeholder and .phash map to
+    their own image, a near-duplicate's .alias to the image it shares. Files of one group expire together.
+    """
+    match = IMAGE_FILE_RE.match(os.path.basename(file_path))
+    if match is None:
+        return file_path
+    prefix = os.path.join(os.path.dirname(file_path), match.group('prefix'))
+    if match.group('ext') == 'alias':
+        try:
+            with open(file_path) as f:
+                canonical_id = f.read().strip()
+        except OSError:
+            return prefix
+        # Stored image IDs are hex, so the owner is everything before the last underscore
+        return f"{prefix.rsplit('_', 1)[0]}_{canonical_id}"
+    return prefix
+
+def find_stored_original(prefix):
+    for ext in IMAGE_MIME_TYPES:
+        if os.path.exists(f"{prefix}.{ext}"):
+            return f"{prefix}.{ext}", IMAGE_MIME_TYPES[ext]
+    return None, None
+
+def supported_variant_formats():
+    """Configured variant formats this Pillow build can encode (AVIF needs a plugin)"""
+    from PIL import Image
+    Image.init()
+    return [image_format for image_format in IMAGE_VARIANT_FORMATS if image_format.upper() in Image.SAVE]
+
+class PoolBusy(Exception):
+    """Raised when a WorkerPool has no free slot within the caller's wait"""
+
+class WorkerPool:
+    """
+    Lazily started process pool with a cap on queued + running jobs, so CPU-heavy
+    image work never runs on (or piles up behind) request threads. Uses spawned
+    workers: forking a threaded server can copy held locks into the child.
+    """
+    
+    def __init__(self, name, workers, max_pending):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+    
+    def _get_executor(self):
+        # Like the sweeper thread, a pool doesn't survive a pre-fork server's fork
+        with self._lock:
+            if self._pid != os.getpid() or self._executor is None:
+                if self._pid != os.getpid():
+                    self._slots = threading.BoundedSemaphore(self.max_pending)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+    
+    def submit(self, fn, *args, wait=None):
+        """Run fn(*args) in the pool; waits up to `wait` seconds (None = forever) for a free slot"""
+        if self.workers <= 0:
+            # Pool disabled: run inline (development / single-core hosts)
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        executor = self._get_executor()
+        slots = self._slots
+        if not slots.acquire(timeout=wait):
+            raise PoolBusy(f"{self.name} pool is busy")
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            # A crashed worker breaks the whole pool; start a fresh one next time
+            with self._lock:
+                self._executor = None
+            self.failed += 1
+            raise
+        self.submitted += 1
+        future.add_done_callback(lambda done: self._finished(slots, done))
+        return future
+    
+    def _finished(self, slots, future):
+        slots.release()
+        if future.cancelled() or future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+    
+    def stats(self):
+        return {'workers': self.workers, 'max_pending': self.max_pending, 'submitted': self.submitted,
+                'completed': self.completed, 'failed': self.failed,
+                'running_or_queued': self.submitted - self.completed - self.failed}
+
+class ImageVariantPipeline:
+    """Queues variant rendering for stored originals on a WorkerPool, once per original"""
+    
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._pending = set()  # Originals being rendered, so a busy image isn't queued twice
+    
+    def submit(self, original_path):
+        """Queue variant rendering for a stored original (no-op when disabled, already queued or saturated)"""
+        if self.pool.workers <= 0:
+            return
+        with self._lock:
+            if original_path in self._pending:
+                return
+            self._pending.add(original_path)
+        try:
+            future = self.pool.submit(render_image_variants, original_path, IMAGE_VARIANT_WIDTHS,
+                                      supported_variant_formats(), IMAGE_VARIANT_QUALITY,
+                                      IMAGE_PLACEHOLDER_WIDTH, wait=0)
+        except Exception as e:
+            # Variants are an optimisation: the original is served until they exist
+            app.logger.warning(f"Skipped variants for {os.path.basename(original_path)}: {str(e) or type(e).__name__}")
+            with self._lock:
+                self._pending.discard(original_path)
+            return
+        future.add_done_callback(lambda done, path=original_path: self._finished(path, done))
+    
+    def _finished(self, original_path, future):
+        with self._lock:
+            self._pending.discard(original_path)
+        if not future.cancelled() and future.exception() is not None:
+            app.logger.error(f"Image variant rendering failed for {os.path.basename(original_path)}: {str(future.exception())}")
+    
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return dict(self.pool.stats(), pending=pending)
+
+IMAGE_PIPELINE = ImageVariantPipeline(WorkerPool('image-variants', IMAGE_PIPELINE_WORKERS, max_pending=64))
+COMPRESS_POOL = WorkerPool('image-compress', IMAGE_COMPRESS_WORKERS, max_pending=IMAGE_COMPRESS_MAX_PENDING)
+
+def image_dhash(image_file):
+    """64-bit perceptual difference hash: survives re-encoding and small changes, so near-identical renders match"""
+    from PIL import Image
+    
+    with Image.open(image_file) as image:
+        image.draft('L', (64, 64))  # Lets JPEG decode at reduced size
+        small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return bits
+
+def image_prompt_key(prompt):
+    """Short digest of an image prompt, kept in the .phash sidecar so only renders of the same prompt are matched"""
+    return hashlib.sha256(prompt.strip().lower().encode('utf-8')).hexdigest()[:16]
+
+def find_near_duplicate(user_id, image_hash, prompt_key):
+    """Closest of the user's stored images of the same prompt within IMAGE_DEDUP_MAX_DISTANCE bits, as an image ID"""
+    best_id, best_distance = None, IMAGE_DEDUP_MAX_DISTANCE + 1
+    prefix = f"{user_id}_"
+    with os.scandir(IMAGE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.startswith(prefix) or not entry.name.endswith('.phash'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    stored_hash, stored_prompt_key = (f.read().split() + [None])[:2]
+                if stored_prompt_key != prompt_key:
+                    continue
+                distance = bin(int(stored_hash, 16) ^ image_hash).count('1')
+            except (OSError, ValueError):
+                continue
+            if distance < best_distance:
+                best_id, best_distance = entry.name[len(prefix):-len('.phash')], distance
+    return best_id
+
+def store_image_alias(user_id, image_id, canonical_id):
+    """Record image_id as a near-duplicate of canonical_id, and keep the shared files from expiring first"""
+    prefix = image_store_prefix(user_id, image_id)
+    write_file_atomic(f"{prefix}.alias", canonical_id.encode('utf-8'))
+    canonical_prefix = image_store_prefix(user_id, canonical_id)
+    for file_name in os.listdir(IMAGE_DIR):
+        if file_name.startswith(os.path.basename(canonical_prefix)):
+            try:
+                os.utime(os.path.join(IMAGE_DIR, file_name))
+            except OSError:
+                pass
+
+def stored_image_duplicate_of(user_id, image_id):
+    """Image ID this one shares its blob with, or None"""
+    prefix = image_store_prefix(user_id, image_id)
+    if prefix is None:
+        return None
+    canonical_prefix = resolve_image_prefix(user_id, prefix)
+    return os.path.basename(canonical_prefix)[len(user_id) + 1:] if canonical_prefix != prefix else None
+
+def image_store_usage(user_id):
+    """Bytes in the user's image store, and how many bytes near-duplicate sharing avoided storing"""
+    prefix = f"{user_id}_"
+    usage = {"images": 0, "duplicates": 0, "stored_bytes": 0, "bytes_saved": 0}
+    aliases = []
+    with os.scandir(IMAGE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.startswith(prefix):
+                continue
+            usage["stored_bytes"] += entry.stat().st_size
+            match = IMAGE_FILE_RE.match(entry.name)
+            if entry.name.endswith('.alias'):
+                aliases.append(entry.path[:-len('.alias')])
+            elif match and match.group('ext') in IMAGE_MIME_TYPES and not match.group('variant'):
+                usage["images"] += 1
+    for alias_prefix in aliases:
+        original_path, _ = find_stored_original(resolve_image_prefix(user_id, alias_prefix))
+        if original_path:
+            usage["duplicates"] += 1
+            usage["bytes_saved"] += os.path.getsize(original_path)
+    return usage
+
+def store_image_stream(user_id, image_id, chunks, prompt=None):
+    """
+    Stream image bytes into the image store without holding them in memory, then queue its variants.
+    With IMAGE_DEDUP_ENABLED and a prompt, a near-duplicate of one of the user's stored renders of the
+    same prompt is dropped and aliased to it instead; either way the returned path is the original
+    that /get_image will serve.
+    """
+    prefix = image_store_prefix(user_id, image_id)
+    if prefix is None:
+        return None
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=IMAGE_DIR)
+    header = b''
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ValueError(f"Image larger than {IMAGE_MAX_BYTES} bytes")
+                if len(header) < 12:
+                    header += chunk[:12]
+                tmp_file.write(chunk)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if not size:
+            raise ValueError("Empty image body")
+        extension = sniff_image_extension(header)
+        if extension is None:
+            raise ValueError(f"Not an image (starts {header[:12]!r})")
+        
+        image_hash = None
+        if IMAGE_DEDUP_ENABLED and prompt:
+            prompt_key = image_prompt_key(prompt)
+            try:
+                image_hash = image_dhash(tmp_path)
+            except Exception as e:
+                app.logger.warning(f"Could not hash image {image_id}: {str(e)}")
+            duplicate_of = find_near_duplicate(user_id, image_hash, prompt_key) if image_hash is not None else None
+            if duplicate_of:
+                original_path, _ = find_stored_original(image_store_prefix(user_id, duplicate_of))
+                if original_path:
+                    os.remove(tmp_path)
+                    store_image_alias(user_id, image_id, duplicate_of)
+                    app.logger.info(f"Image {image_id} is a near-duplicate of {duplicate_of}; sharing its blob ({size} bytes saved)")
+                    return original_path
+        
+        file_path = f"{prefix}.{extension}"
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if image_hash is not None:
+        write_file_atomic(f"{prefix}.phash", f"{image_hash:016x} {prompt_key}".encode('utf-8'))
+    IMAGE_PIPELINE.submit(file_path)
+    return file_path
+
+def store_generated_image(user_id, image_id, image_data, prompt=None):
+    """Write a generated image (base64 or bytes) to the image store and queue its variants"""
+    if isinstance(image_data, str):
+        image_data = base64.b64decode(image_data)
+    return store_image_stream(user_id, image_id, [image_data], prompt)
+
+def fetch_image_binary(payload, user_id, image_id):
+    """
+    Binary image mode: request raw bytes from Venice (return_binary) and stream them
+    straight into the image store. Returns the /get_image reference for the message.
+    """
+    headers = {
+        "Authorization": f"Bearer {VENICE_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    with requests.post(VENICE_IMAGE_URL, json=dict(payload, return_binary=True), headers=headers,
+                       timeout=60, stream=True) as response:
+        if response.status_code != 200:
+            app.logger.error(f"Venice AI image generation failed: {response.status_code} - {response.text[:500]}")
+            raise Exception(f"Image generation failed: {response.status_code}")
+        
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            # Upstream sent base64 JSON anyway (e.g. an older API version)
+            images_field = response.json().get('images')
+            image_data = images_field[0] if isinstance(images_field, list) and images_field else images_field
+            if not isinstance(image_data, str) or len(image_data) < 100:
+                raise Exception("Invalid response from image API")
+            file_path = store_generated_image(user_id, image_id, image_data, payload.get('prompt'))
+        else:
+            file_path = store_image_stream(user_id, image_id, response.iter_content(chunk_size=64 * 1024),
+                                           payload.get('prompt'))
+    
+    if file_path is None:
+        raise Exception("Could not store generated image")
+    app.logger.debug(f"Stored binary image {image_id} ({os.path.getsize(file_path)} bytes)")
+    return f"/get_image/{image_id}"
+
+def image_store_owner(user_id):
+    """
+    User ID to keep this request's generated images under, or None to keep them off the server:
+    hybrid mode stores them, and so does binary mode, whose messages only carry the /get_image reference
+    """
+    if IMAGE_BINARY_TRANSFER or session.get('storage_mode', 'client-only') == 'hybrid':
+        return user_id
+    return None
+
+def request_image(payload, user_id, image_id, phase='full'):
+    """
+    Run one image generation and return the URL messages should use: the base64 data URL,
+    or the /get_image reference in binary mode. With a user_id (see image_store_owner) the
+    original also lands in the image store. Returns None (after logging) when Venice sends no usable image.
+    """
+    if IMAGE_BINARY_TRANSFER and phase == 'full':
+        with METRICS.time('aidm_image_generation_seconds', model=payload.get('model'), phase=phase):
+            return fetch_image_binary(payload, user_id, image_id)
+    
+    headers = {
+        "Authorization": f"Bearer {VENICE_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    with METRICS.time('aidm_image_generation_seconds', model=payload.get('model'), phase=phase):
+        response = requests.post(VENICE_IMAGE_URL, json=payload, headers=headers, timeout=60)
+    if response.status_code != 200:
+        app.logger.error(f"Image generation failed for prompt '{payload.get('prompt')}': {response.status_code}")
+        METRICS.inc('aidm_errors_total', type=f'image_upstream_status_{response.status_code}')
+        return None
+    
+    result = response.json()
+    images_field = result.get('images') if isinstance(result, dict) else None
+    image_data = images_field[0] if isinstance(images_field, list) and images_field else images_field
+    
+    # Validate the image data
+    if not isinstance(image_data, str) or len(image_data) < 100:
+        app.logger.error(f"Invalid image data received for prompt '{payload.get('prompt')}': length={len(image_data) if hasattr(image_data, '__len__') else 'N/A'}")
+        return None
+    
+    if user_id:
+        # Store the original; smaller variants and a placeholder render in the background
+        try:
+            store_generated_image(user_id, image_id, image_data, payload.get('prompt'))
+        except Exception as store_error:
+            app.logger.error(f"Could not store image {image_id}: {str(store_error)}")
+    return f"data:image/png;base64,{image_data}"
+
+def image_preview_payload(payload):
+    """Low-step, smaller version of an image request, kept within the model's constraints; None if not configured"""
+    settings = IMAGE_PREVIEW_SETTINGS.get(payload.get('model'))
+    if not IMAGE_PREVIEW_ENABLED or not settings:
+        return None
+    constraints = next((model.get('constraints', {}) for model in AVAILABLE_IMAGE_MODELS
+                        if model['id'] == payload.get('model')), {})
+    max_steps = constraints.get('steps', {}).get('max', settings['steps'])
+    divisor = constraints.get('widthHeightDivisor', 8)
+    size = max(divisor, settings['size'] // divisor * divisor)
+    prompt_limit = constraints.get('promptCharacterLimit')
+    return dict(payload,
+                prompt=payload['prompt'][:prompt_limit] if prompt_limit else payload['prompt'],
+                steps=max(1, min(settings['steps'], max_steps)),
+                width=min(size, payload.get('width', size)),
+                height=min(size, payload.get('height', size)),
+                return_binary=False)  # Small enough to send inline; never stored
+
+def image_srcset(image_id):
+    """srcset for a stored image: the rendered widths, then the full-size original"""
+    return ", ".join([f"/get_image/{image_id}?size={width} {width}w" for width in IMAGE_VARIANT_WIDTHS] +
+                     [f"/get_image/{image_id} 1024w"])
+
+def requested_image_width():
+    """Wanted width in physical pixels from ?size= or client hints; None means the original"""
+    size = request.args.get('size')
+    if size:
+        try:
+            return int(size)
+        except ValueError:
+            return None
+    try:
+        for header in ('Sec-CH-Width', 'Width'):
+            if request.headers.get(header):
+                return int(float(request.headers[header]))
+        viewport = request.headers.get('Sec-CH-Viewport-Width') or request.headers.get('Viewport-Width')
+        if viewport:
+            dpr = float(request.headers.get('Sec-CH-DPR') or request.headers.get('DPR') or 1)
+            return int(float(viewport) * dpr)
+    except ValueError:
+        pass
+    return None
+
+def pick_image_variant(prefix, width, accept):
+    """Smallest rendered variant at least `width` wide, in a format the client accepts"""
+    if width is None:
+        return None
+    for variant_width in sorted(w for w in IMAGE_VARIANT_WIDTHS if w >= width):
+        for image_format in IMAGE_VARIANT_FORMATS:
+            variant_path = f"{prefix}_w{variant_width}.{image_format}"
+            if f"image/{image_format}" in accept and os.path.exists(variant_path):
+                return variant_path, IMAGE_MIME_TYPES[image_format]
+    return None  # Not rendered yet, or wider than every variant: the original is the best fit
+
+def image_response(image_data, content_type):
+    """Image response with privacy headers; varies on the headers used to pick the variant"""
+    response = Response(image_data, mimetype=content_type)
+    response.headers['Cache-Control'] = 'private, no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    response.headers['Vary'] = 'Accept, Sec-CH-Width, Width, Sec-CH-Viewport-Width, Sec-CH-DPR'
+    response.headers['Accept-CH'] = 'Sec-CH-Width, Sec-CH-Viewport-Width, Sec-CH-DPR'
+    return response
+
+def read_image_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
 @app.route('/get_image/<image_id>', methods=['GET'])
 def get_image(image_id):
-    """Serve images by ID with privacy controls"""
+    """
+    Serve images by ID with privacy controls.
+    ?size=<px> or client hints pick the smallest rendered variant that fits;
+    ?size=placeholder returns the tiny blurred preview.
+    """
     try:
         user_id = get_user_id()
+        prefix = image_store_prefix(user_id, image_id)
+        
+        # Image store first: file names are prefixed with the owner's user ID
+        if prefix is not None:
+            prefix = resolve_image_prefix(user_id, prefix)
+            if request.args.get('size') == 'placeholder':
+                placeholder_path = f"{prefix}_placeholder.webp"
+                if os.path.exists(placeholder_path):
+                    return image_response(read_image_file(placeholder_path), 'image/webp')
+                return jsonify({"error": "Image not found or access denied"}), 404
+            
+            original_path, content_type = find_stored_original(prefix)
+            if original_path:
+                variant = pick_image_variant(prefix, requested_image_width(), request.headers.get('Accept', ''))
+                if variant:
+                    original_path, content_type = variant
+                return image_response(read_image_file(original_path), content_type)
         
         # Privacy check: Only serve images to the user who created them
         chat_files = os.listdir(CHAT_DIR)
@@ -1374,43 +4164,41 @@ def get_image(image_id):
         
         for file_name in user_files:
             file_path = os.path.join(CHAT_DIR, file_name)
-            with open(file_path, 'r') as file:
-                chat_history = json.load(file)
-                
-                for msg in chat_history:
-                    # Check if this message contains the requested image
-                    if (msg.get('message_type') == 'image' and 
-                        msg.get('image_url') and 
-                        (image_id in msg.get('image_url', '') or 
-                         image_id == msg.get('image_reference', ''))):
-                        
-                        # Extract base64 data from the data URL
-                        image_url = msg.get('image_url', '')
-                        if image_url.startswith('data:image/'):
-                            format_and_data = image_url.split(',', 1)
-                            if len(format_and_data) == 2:
-                                try:
-                                    image_data = base64.b64decode(format_and_data[1])
-                                    
-                                    # Determine content type
-                                    if 'png' in format_and_data[0]:
-                                        content_type = 'image/png'
-                                    elif 'webp' in format_and_data[0]:
-                                        content_type = 'image/webp'
-                                    else:
-                                        content_type = 'image/jpeg'
-                                    
-                                    # Add privacy headers
-                                    response = Response(image_data, mimetype=content_type)
-                                    response.headers['Cache-Control'] = 'private, no-cache, no-store, must-revalidate'
-                                    response.headers['Pragma'] = 'no-cache'
-                                    response.headers['Expires'] = '0'
-                                    return response
-                                    
-                                except Exception as decode_error:
-                                    app.logger.error(f"Error decoding image {image_id}: {str(decode_error)}")
-                                    break
-        
+            chat_history = read_history_cached(file_path)
+            
+            for msg in chat_history:
+                # Check if this message contains the requested image
+                if (msg.get('message_type') == 'image' and 
+                    msg.get('image_url') and 
+                    (image_id in msg.get('image_url', '') or 
+                     image_id == msg.get('image_reference', ''))):
+                    
+                    # Extract base64 data from the data URL
+                    image_url = msg.get('image_url', '')
+                    if image_url.startswith('data:image/'):
+                        format_and_data = image_url.split(',', 1)
+                        if len(format_and_data) == 2:
+                            try:
+                                image_data = base64.b64decode(format_and_data[1])
+                                
+                                # Determine content type
+                                if 'png' in format_and_data[0]:
+                                    content_type = 'image/png'
+                                elif 'webp' in format_and_data[0]:
+                                    content_type = 'image/webp'
+                                else:
+                                    content_type = 'image/jpeg'
+                                
+                                # Move it into the image store so variants exist next time
+                                if prefix is not None:
+                                    store_generated_image(user_id, image_id, image_data)
+                                
+                                return image_response(image_data, content_type)
+                                
+                            except Exception as decode_error:
+                                app.logger.error(f"Error decoding image {image_id}: {str(decode_error)}")
+                                break
+    
         # Log access attempt for security
         app.logger.warning(f"Image access denied or not found: {image_id} for user {user_id}")
         return jsonify({"error": "Image not found or access denied"}), 404
@@ -1430,40 +4218,48 @@ def optimize_storage():
         if not game_id:
             return jsonify({"success": False, "error": "No game ID provided"})
         
-        # Load chat history
-        chat_history = load_chat_history(user_id, game_id)
-        optimized_history = []
-        images_optimized = 0
-        
-        for msg in chat_history:
-            if (msg.get('message_type') == 'image' and 
-                msg.get('image_url') and 
-                msg['image_url'].startswith('data:image/')):
-                
-                # Generate a unique image ID
-                import hashlib
-                image_id = hashlib.md5(msg['image_url'].encode()).hexdigest()[:12]
-                
-                # Create optimized version with image reference
-                optimized_msg = msg.copy()
-                optimized_msg['image_reference'] = image_id
-                optimized_msg['image_url_original'] = msg['image_url']  # Keep original for server
-                optimized_msg['image_url'] = f'/get_image/{image_id}'  # Client will use this
-                optimized_msg['optimized'] = True
-                
-                optimized_history.append(optimized_msg)
-                images_optimized += 1
-            else:
-                optimized_history.append(msg)
+        def optimize_images(chat_history):
+            optimized_history = []
+            images_optimized = 0
+            
+            for msg in chat_history:
+                if (msg.get('message_type') == 'image' and 
+                    msg.get('image_url') and 
+                    msg['image_url'].startswith('data:image/')):
+                    
+                    # Generate a unique image ID
+                    image_id = hashlib.md5(msg['image_url'].encode()).hexdigest()[:12]
+                    
+                    # Create optimized version with image reference
+                    optimized_msg = msg.copy()
+                    optimized_msg['image_reference'] = image_id
+                    optimized_msg['image_url_original'] = msg['image_url']  # Keep original for server
+                    optimized_msg['image_url'] = f'/get_image/{image_id}'  # Client will use this
+                    optimized_msg['optimized'] = True
+                    
+                    optimized_history.append(optimized_msg)
+                    images_optimized += 1
+                else:
+                    optimized_history.append(msg)
+            
+            if not images_optimized:
+                return None
+            
+            original_size = len(chat_history)
+            chat_history[:] = optimized_history
+            return images_optimized, original_size
         
-        # Save optimized history
-        save_chat_history(user_id, optimized_history, game_id)
+        # Load, optimize and save under the per-game lock (None: nothing to optimize, nothing saved)
+        optimize_result = update_chat_history(user_id, optimize_images, game_id)
+        if optimize_result is None:
+            optimize_result = 0, len(load_chat_history(user_id, game_id))
+        images_optimized, original_size = optimize_result
         
         return jsonify({
             "success": True,
             "images_optimized": images_optimized,
-            "original_size": len(chat_history),
-            "optimized_size": len(optimized_history)
+            "original_size": original_size,
+            "optimized_size": original_size
         })
         
     except Exception as e:
@@ -1482,58 +4278,65 @@ def cleanup_storage():
         if not game_id:
             return jsonify({"success": False, "error": "No game ID provided"})
         
-        # Load current chat history
-        chat_history = load_chat_history(user_id, game_id)
+        def trim_history(chat_history):
+            if len(chat_history) <= max_messages:
+                return None
+            
+            # Keep the most recent messages and important system messages
+            important_messages = []
+            recent_messages = []
+            
+            # First pass: collect important messages (welcome, system notifications)
+            for i, msg in enumerate(chat_history):
+                if (msg.get('message_type') == 'system' or 
+                    (msg.get('role') == 'assistant' and 'welcome' in msg.get('content', '').lower()) or
+                    msg.get('important', False)):
+                    important_messages.append((i, msg))
+            
+            # Second pass: collect recent messages
+            start_index = max(0, len(chat_history) - max_messages)
+            recent_messages = chat_history[start_index:]
+            
+            # Combine important and recent messages, avoiding duplicates
+            final_history = []
+            important_indices = {i for i, _ in important_messages}
+            
+            # Add important messages first
+            for _, msg in important_messages:
+                final_history.append(msg)
+            
+            # Add recent messages that aren't already included
+            for i, msg in enumerate(recent_messages, start=start_index):
+                if i not in important_indices:
+                    final_history.append(msg)
+            
+            # Sort by original order (approximate)
+            # This is a simple approach - you might want more sophisticated ordering
+            
+            original_size = len(chat_history)
+            chat_history[:] = final_history
+            return {
+                "original_size": original_size,
+                "new_size": len(final_history),
+                "messages_removed": original_size - len(final_history),
+                "important_messages_kept": len(important_messages)
+            }
         
-        if len(chat_history) <= max_messages:
+        # Load, trim and save cleaned history under the per-game lock (None: short enough, nothing saved)
+        cleanup_result = update_chat_history(user_id, trim_history, game_id)
+        
+        if cleanup_result is None:
             return jsonify({
                 "success": True,
                 "cleaned": False,
                 "message": "No cleanup needed",
-                "current_size": len(chat_history)
+                "current_size": len(load_chat_history(user_id, game_id))
             })
         
-        # Keep the most recent messages and important system messages
-        important_messages = []
-        recent_messages = []
-        
-        # First pass: collect important messages (welcome, system notifications)
-        for i, msg in enumerate(chat_history):
-            if (msg.get('message_type') == 'system' or 
-                (msg.get('role') == 'assistant' and 'welcome' in msg.get('content', '').lower()) or
-                msg.get('important', False)):
-                important_messages.append((i, msg))
-        
-        # Second pass: collect recent messages
-        start_index = max(0, len(chat_history) - max_messages)
-        recent_messages = chat_history[start_index:]
-        
-        # Combine important and recent messages, avoiding duplicates
-        final_history = []
-        important_indices = {i for i, _ in important_messages}
-        
-        # Add important messages first
-        for _, msg in important_messages:
-            final_history.append(msg)
-        
-        # Add recent messages that aren't already included
-        for i, msg in enumerate(recent_messages, start=start_index):
-            if i not in important_indices:
-                final_history.append(msg)
-        
-        # Sort by original order (approximate)
-        # This is a simple approach - you might want more sophisticated ordering
-        
-        # Save cleaned history
-        save_chat_history(user_id, final_history, game_id)
-        
         return jsonify({
             "success": True,
             "cleaned": True,
-            "original_size": len(chat_history),
-            "new_size": len(final_history),
-            "messages_removed": len(chat_history) - len(final_history),
-            "important_messages_kept": len(important_messages)
+            **cleanup_result
         })
         
     except Exception as e:
@@ -1554,23 +4357,25 @@ def get_storage_info():
         # Load chat history
         chat_history = load_chat_history(user_id, game_id)
         
-        # Calculate storage metrics
+        # Calculate storage metrics straight from the stored dicts (nothing here needs a parsed message)
         total_messages = len(chat_history)
-        image_messages = sum(1 for msg in chat_history if msg.get('message_type') == 'image')
-        text_messages = total_messages - image_messages
+        image_messages = 0
         
-        # Estimate localStorage usage (rough calculation)
+        # Estimate localStorage usage from each message's UTF-8 JSON size
         estimated_size = 0
         large_messages = 0
         
         for msg in chat_history:
-            msg_str = json.dumps(msg)
-            msg_size = len(msg_str.encode('utf-8'))
+            if msg.get('message_type') == 'image':
+                image_messages += 1
+            msg_size = len(json.dumps(msg, ensure_ascii=False).encode('utf-8'))
             estimated_size += msg_size
             
             if msg_size > 10000:  # Messages larger than 10KB
                 large_messages += 1
         
+        text_messages = total_messages - image_messages
+        
         # Convert to MB for readability
         estimated_size_mb = estimated_size / (1024 * 1024)
         
@@ -1583,6 +4388,7 @@ def get_storage_info():
             "estimated_size_mb": round(estimated_size_mb, 2),
             "large_messages": large_messages,
             "needs_cleanup": estimated_size_mb > 5,  # Suggest cleanup if over 5MB
+            "image_store": image_store_usage(user_id),
             "game_id": game_id
         })
         
@@ -1599,7 +4405,7 @@ def privacy_settings():
             "current_settings": {
                 "server_storage_enabled": True,  # Currently always enabled
                 "auto_delete_on_new_game": True,
-                "max_retention_hours": 24,  # Delete after 24 hours
+                "max_retention_hours": HISTORY_RETENTION_HOURS,  # Enforced by the background retention sweeper
                 "encryption_enabled": False  # Could be implemented later
             },
             "privacy_info": {
@@ -1630,13 +4436,14 @@ def emergency_delete():
         # Delete all files for this user
         try:
             chat_files = os.listdir(CHAT_DIR)
-            user_files = [f for f in chat_files if f.startswith(f"chat_history_{user_id}_")]
+            user_files = [os.path.join(CHAT_DIR, f) for f in chat_files if f.startswith(f"chat_history_{user_id}_")]
+            user_files += [os.path.join(IMAGE_DIR, f) for f in os.listdir(IMAGE_DIR) if f.startswith(f"{user_id}_")]
             
             deleted_files = 0
-            for file_name in user_files:
-                file_path = os.path.join(CHAT_DIR, file_name)
+            for file_path in user_files:
+                file_name = os.path.basename(file_path)
                 try:
-                    os.remove(file_path)
+                    remove_chat_file(file_path)
                     deleted_files += 1
                 except Exception as e:
                     app.logger.error(f"Error deleting {file_name}: {str(e)}")
@@ -1661,6 +4468,11 @@ def emergency_delete():
         app.logger.error(f"Error in emergency delete: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+# What the privacy endpoints say about generated images, matching image_store_owner
+IMAGE_STORAGE_NOTE = ("Generated images are kept on the server in every mode, because binary image transfer serves them by reference"
+                      if IMAGE_BINARY_TRANSFER else
+                      "Generated images are kept on the server in hybrid mode only")
+
 @app.route('/privacy_status', methods=['GET'])
 def privacy_status():
     """Get current privacy status and data stored for user"""
@@ -1692,15 +4504,32 @@ def privacy_status():
                         "game_id": file_name.replace(f"chat_history_{user_id}_", "").replace(".json", "")
                     })
             
+            # Generated images (with their variants and sidecars) live in the image store, not the histories
+            image_files = [f for f in os.listdir(IMAGE_DIR) if f.startswith(f"{user_id}_")]
+            image_details = []
+            for file_name in image_files:
+                try:
+                    file_stat = os.stat(os.path.join(IMAGE_DIR, file_name))
+                except OSError:
+                    continue
+                total_size += file_stat.st_size
+                image_details.append({
+                    "filename": file_name,
+                    "size_bytes": file_stat.st_size,
+                    "last_modified": file_stat.st_mtime
+                })
+            
             return jsonify({
                 "success": True,
                 "user_id": user_id,
-                "total_files": len(user_files),
+                "total_files": len(file_details) + len(image_details),
                 "total_size_bytes": total_size,
                 "total_size_mb": round(total_size / (1024 * 1024), 3),
                 "files": file_details,
+                "image_files": image_details,
                 "privacy_notes": [
                     "Files are stored on the server and could potentially be accessed by authorities",
+                    IMAGE_STORAGE_NOTE,
                     "Use 'New Game' to automatically delete previous histories",
                     "Use 'Emergency Delete' to remove all data immediately",
                     "Consider using incognito mode for maximum privacy"
@@ -1730,38 +4559,15 @@ def set_storage_mode():
         # Store in session
         session['storage_mode'] = storage_mode
         
-        # If switching to client-only, delete any existing server files for privacy
+        # If switching to client-only, delete any existing server files for privacy (in the background)
         if storage_mode == 'client-only':
-            user_id = get_user_id()
-            try:
-                chat_files = os.listdir(CHAT_DIR)
-                user_files = [f for f in chat_files if f.startswith(f"chat_history_{user_id}_")]
-                
-                deleted_files = 0
-                for file_name in user_files:
-                    file_path = os.path.join(CHAT_DIR, file_name)
-                    try:
-                        os.remove(file_path)
-                        deleted_files += 1
-                        app.logger.info(f"Client-only mode: Deleted server file {file_name}")
-                    except Exception as e:
-                        app.logger.error(f"Error deleting {file_name}: {str(e)}")
-                
-                return jsonify({
-                    "success": True,
-                    "storage_mode": storage_mode,
-                    "server_files_deleted": deleted_files,
-                    "message": f"Switched to client-only storage. {deleted_files} server files deleted for privacy."
-                })
-                
-            except Exception as e:
-                app.logger.error(f"Error cleaning up server files: {str(e)}")
-                return jsonify({
-                    "success": True,
-                    "storage_mode": storage_mode,
-                    "warning": "Mode switched but cleanup failed",
-                    "error": str(e)
-                })
+            RETENTION_SWEEPER.schedule_purge(get_user_id())
+            return jsonify({
+                "success": True,
+                "storage_mode": storage_mode,
+                "privacy_cleanup_scheduled": True,
+                "message": "Switched to client-only storage. Server files are being deleted for privacy."
+            })
         
         return jsonify({
             "success": True,
@@ -1782,8 +4588,9 @@ def get_storage_mode():
         "storage_mode": storage_mode,
         "modes": {
             "client-only": {
-                "description": "All data stored only in browser localStorage",
-                "privacy": "Maximum privacy - no server storage",
+                "description": "Chat histories stored only in browser localStorage",
+                "privacy": ("High privacy - chats stay in your browser; generated images are kept on the server until deleted or expired"
+                            if IMAGE_BINARY_TRANSFER else "Maximum privacy - no server storage"),
                 "limitations": "Limited storage space, data lost if browser cleared"
             },
             "hybrid": {
@@ -1807,67 +4614,75 @@ def client_storage_info():
             "backup_recommendation": "Periodically save important conversations externally"
         },
         "privacy_benefits": [
-            "No server storage - data never leaves your browser",
+            ("Chat histories never leave your browser; generated images are kept on the server until deleted or expired"
+             if IMAGE_BINARY_TRANSFER else "No server storage - data never leaves your browser"),
             "Complete control over your data",
             "Instantly delete by clearing browser data",
             "No risk of external access to chat histories"
         ]
     })
 
+COMPRESS_FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+def parse_compress_options(options):
+    """Validate format/quality/target_bytes/max_width shared by both compression endpoints"""
+    image_format = str(options.get('format', 'jpeg')).lower().replace('jpg', 'jpeg')
+    if image_format not in COMPRESS_FORMATS:
+        raise ValueError(f"Unsupported format: {image_format}")
+    quality = int(options.get('quality', 70))  # 70% quality by default
+    if not 1 <= quality <= 100:
+        raise ValueError("Quality must be between 1 and 100")
+    target_bytes = options.get('target_bytes')
+    target_bytes = int(target_bytes) if target_bytes else None
+    max_width = options.get('max_width')
+    max_width = int(max_width) if max_width else None
+    return image_format, quality, target_bytes, max_width
+
+def decode_data_url(image_data):
+    """Split a data:image/... URL into raw bytes; raises ValueError when it isn't one"""
+    if not isinstance(image_data, str) or not image_data.startswith('data:image/'):
+        raise ValueError("Invalid image data")
+    format_and_data = image_data.split(',', 1)
+    if len(format_and_data) != 2:
+        raise ValueError("Invalid image format")
+    return base64.b64decode(format_and_data[1])
+
+def compression_result(original_bytes, compressed_bytes, image_format, target_bytes):
+    # Sizes are base64 lengths, as before, since that's what localStorage pays for
+    compressed_b64 = base64.b64encode(compressed_bytes).decode('utf-8')
+    original_size = (len(original_bytes) + 2) // 3 * 4
+    compressed_size = len(compressed_b64)
+    compression_ratio = compressed_size / original_size
+    result = {
+        "success": True,
+        "compressed_image": f"data:{COMPRESS_FORMATS[image_format]};base64,{compressed_b64}",
+        "format": image_format,
+        "original_size_bytes": original_size,
+        "compressed_size_bytes": compressed_size,
+        "compression_ratio": round(compression_ratio, 3),
+        "size_reduction_percent": round((1 - compression_ratio) * 100, 1)
+    }
+    if target_bytes:
+        result["target_met"] = len(compressed_bytes) <= target_bytes
+    return result
+
 @app.route('/compress_image', methods=['POST'])
 def compress_image():
     """Compress base64 images for more efficient localStorage storage"""
     try:
         data = request.get_json()
-        image_data = data.get('image_data')
-        quality = data.get('quality', 70)  # 70% quality by default
-        
-        if not image_data or not image_data.startswith('data:image/'):
-            return jsonify({"success": False, "error": "Invalid image data"}), 400
-        
-        # Extract format and base64 data
-        format_and_data = image_data.split(',', 1)
-        if len(format_and_data) != 2:
-            return jsonify({"success": False, "error": "Invalid image format"}), 400
-        
-        from PIL import Image
+        try:
+            image_format, quality, target_bytes, max_width = parse_compress_options(data)
+            image_bytes = decode_data_url(data.get('image_data'))
+        except (ValueError, TypeError) as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
         try:
-            # Decode base64 to image
-            image_bytes = base64.b64decode(format_and_data[1])
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Compress image
-            output_buffer = io.BytesIO()
-            
-            # Convert to RGB if necessary (for JPEG compression)
-            if image.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                image = background
-            
-            # Save with compression
-            image.save(output_buffer, format='JPEG', quality=quality, optimize=True)
-            compressed_bytes = output_buffer.getvalue()
-            
-            # Encode back to base64
-            compressed_b64 = base64.b64encode(compressed_bytes).decode('utf-8')
-            compressed_data_url = f"data:image/jpeg;base64,{compressed_b64}"
-            
-            # Calculate compression ratio
-            original_size = len(format_and_data[1])
-            compressed_size = len(compressed_b64)
-            compression_ratio = compressed_size / original_size
-            
-            return jsonify({
-                "success": True,
-                "compressed_image": compressed_data_url,
-                "original_size_bytes": original_size,
-                "compressed_size_bytes": compressed_size,
-                "compression_ratio": round(compression_ratio, 3),
-                "size_reduction_percent": round((1 - compression_ratio) * 100, 1)
-            })
-            
+            future = COMPRESS_POOL.submit(compress_image_bytes, image_bytes, image_format, quality,
+                                          target_bytes, max_width, wait=IMAGE_COMPRESS_WAIT_SECONDS)
+            compressed_bytes = future.result()
+        except PoolBusy:
+            return jsonify({"success": False, "error": "Image compression is busy, try again shortly"}), 503
         except Exception as compression_error:
             return jsonify({
                 "success": False,
@@ -1875,22 +4690,126 @@ def compress_image():
                 "fallback": "Use original image"
             }), 500
         
+        return jsonify(compression_result(image_bytes, compressed_bytes, image_format, target_bytes))
+        
     except Exception as e:
         app.logger.error(f"Error in image compression: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/compress_images', methods=['POST'])
+def compress_images():
+    """
+    Batch compression: {"images": [{"id", "image_data"}, ...], "format", "quality", "target_bytes", "max_width"}.
+    Images are handed to the compression pool as they are parsed, and results stream back
+    as NDJSON lines in completion order, ending with a {"done": true} summary line.
+    Options must come before "images" in the body.
+    """
+    reader = IncrementalJSONReader(request.stream)
+    options = {}
+    jobs = {}  # future -> (id, original bytes)
+    errors = []
+    
+    try:
+        for key in reader.iter_object_keys():
+            if key != 'images':
+                options[key] = reader.read_value()
+                continue
+            image_format, quality, target_bytes, max_width = parse_compress_options(options)
+            for index, item in enumerate(reader.iter_array()):
+                if len(jobs) + len(errors) >= IMAGE_COMPRESS_BATCH_MAX_IMAGES:
+                    raise ValueError(f"At most {IMAGE_COMPRESS_BATCH_MAX_IMAGES} images per batch")
+                image_id = item.get('id', index) if isinstance(item, dict) else index
+                try:
+                    image_bytes = decode_data_url(item.get('image_data') if isinstance(item, dict) else None)
+                except (ValueError, TypeError) as e:
+                    errors.append({"id": image_id, "success": False, "error": str(e)})
+                    continue
+                # Blocks while the pool is saturated, which also throttles how fast we read the upload
+                future = COMPRESS_POOL.submit(compress_image_bytes, image_bytes, image_format, quality,
+                                              target_bytes, max_width, wait=IMAGE_COMPRESS_WAIT_SECONDS)
+                jobs[future] = (image_id, image_bytes)
+    except PoolBusy:
+        for future in jobs:
+            future.cancel()
+        return jsonify({"success": False, "error": "Image compression is busy, try again shortly"}), 503
+    except (ValueError, TypeError) as e:
+        for future in jobs:
+            future.cancel()
+        return jsonify({"success": False, "error": f"Invalid request: {str(e)}"}), 400
+    
+    if not jobs and not errors:
+        return jsonify({"success": False, "error": "No images provided"}), 400
+    
+    total = len(jobs) + len(errors)
+    
+    def generate():
+        failed = len(errors)
+        for error in errors:
+            yield json.dumps(error) + "\n"
+        for future in as_completed(jobs):
+            image_id, image_bytes = jobs.pop(future)
+            try:
+                result = compression_result(image_bytes, future.result(), image_format, target_bytes)
+            except Exception as e:
+                failed += 1
+                result = {"success": False, "error": f"Compression failed: {str(e)}", "fallback": "Use original image"}
+            result["id"] = image_id
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "count": total, "failed": failed}) + "\n"
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/import_history', methods=['POST'])
 def import_history():
-    """Import chat history from client and save it to server"""
+    """
+    Import chat history from client and save it to server.
+    The body is parsed incrementally and each message is validated and written
+    straight to storage, so large imports never sit in memory as a whole.
+    """
     user_id = get_user_id()
-    data = request.get_json()
-    game_id = data.get('game_id')
-    history = data.get('history')
-    if not game_id or history is None:
-        return jsonify({"success": False, "error": "Missing game_id or history"}), 400
-    # Save imported history to server storage
-    save_chat_history(user_id, history, game_id)
-    return jsonify({"success": True})
+    storage_mode = session.get('storage_mode', 'client-only')
+    reader = IncrementalJSONReader(request.stream)
+    # In client-only mode nothing is stored, but the body is still validated
+    writer = HistoryImportWriter() if storage_mode != 'client-only' else None
+    game_id = None
+    history_found = False
+    imported = 0
+    
+    try:
+        for key in reader.iter_object_keys():
+            if key == 'history' and reader.peek() == '[':
+                for msg in reader.iter_array():
+                    if not isinstance(msg, dict):
+                        raise ValueError(f"History entry {imported} is not an object")
+                    if writer is not None:
+                        writer.write_message(msg)
+                    imported += 1
+                history_found = True
+            elif key == 'game_id':
+                game_id = reader.read_value()
+            else:
+                reader.read_value()  # Skip fields we don't use
+        
+        if not game_id or not isinstance(game_id, str) or not history_found:
+            if writer is not None:
+                writer.abort()
+            return jsonify({"success": False, "error": "Missing game_id or history"}), 400
+        
+        # Save imported history to server storage
+        if writer is not None:
+            writer.commit(user_id, game_id)
+    except ValueError as e:
+        if writer is not None:
+            writer.abort()
+        app.logger.warning(f"Rejected history import: {str(e)}")
+        return jsonify({"success": False, "error": f"Invalid history data: {str(e)}"}), 400
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+    
+    return jsonify({"success": True, "imported_messages": imported})
 
 if __name__ == '__main__':
+    # Development server; production runs gunicorn -c gunicorn.conf.py wsgi:app
     app.run(debug=True)
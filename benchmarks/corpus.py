@@ -0,0 +1,101 @@
+"""
+Synthetic AIDM campaign data for the benchmark scripts.
+Messages mimic what the server stores: color-tagged DM narration, player turns
+with player{n} labels, system notices and image messages carrying base64 data URLs.
+"""
+import os
+import base64
+import random
+
+NARRATION_WORDS = [
+    "the", "tavern", "dragon", "fire", "ancient", "forest", "sword", "magic", "shadow", "gold",
+    "whispers", "door", "creaks", "open", "torch", "light", "flickers", "goblin", "attack", "heal",
+    "potion", "quest", "journey", "mountain", "cave", "steel", "blade", "moonlight", "spell", "arcane",
+    "you", "see", "a", "an", "and", "with", "into", "across", "beneath", "roll", "saving", "throw",
+]
+
+COLORS = ["red", "blue", "yellow", "green", "purple", "orange", "pink", "cyan", "lime", "teal", "brown", "silver", "wood"]
+
+def make_narration(rng, words):
+    """Plain DM narration of roughly `words` words with emojis and sentence breaks"""
+    out = []
+    for i in range(words):
+        out.append(rng.choice(NARRATION_WORDS))
+        if i % 14 == 13:
+            out[-1] += rng.choice([".", "!", "?"]) + " " + rng.choice(["✨", "🐉", "⚔️", "🔥", "🌲"])
+    return " ".join(out).capitalize() + "."
+
+def make_formatted_narration(rng, words):
+    """Narration as stored after format_message_content - [color:word] tags and HTML spans"""
+    out = []
+    for word in make_narration(rng, words).split(" "):
+        roll = rng.random()
+        if roll < 0.12:
+            out.append(f"[{rng.choice(COLORS)}:{word}]")
+        elif roll < 0.18:
+            out.append(f'<span class="{rng.choice(COLORS)}">{word}</span>')
+        else:
+            out.append(word)
+    return " ".join(out)
+
+def make_raw_reply(rng, words, image_tag=False):
+    """A reply as the model streams it, before format_message_content: no color tags yet,
+    occasional bold, dice results and, when asked, an [IMAGE: ...] tag or a malformed image line"""
+    paragraphs = []
+    remaining = words
+    while remaining > 0:
+        size = min(remaining, rng.randint(40, 90))
+        paragraph = make_narration(rng, size)
+        if rng.random() < 0.3:
+            paragraph += f" You rolled a {rng.randint(1, 20)} on your saving throw."
+        if rng.random() < 0.2:
+            paragraph = f"**{rng.choice(NARRATION_WORDS).title()}!** " + paragraph
+        paragraphs.append(paragraph)
+        remaining -= size
+    if image_tag:
+        description = make_narration(rng, 14).rstrip(".")
+        if rng.random() < 0.25:
+            paragraphs.append(f"Generated image: {description}.")  # The model ignoring the tag format
+        else:
+            paragraphs.append(f"[IMAGE: Studio Ghibli anime style, D&D fantasy art, cartoon illustration, {description}]")
+    return "\n\n".join(paragraphs)
+
+def make_image_message(rng, image_bytes=48 * 1024):
+    """Image message in the shape /stream stores it; payload is incompressible like real webp data"""
+    prompt = "Studio Ghibli anime style, D&D fantasy art, cartoon illustration, " + make_narration(rng, 12)
+    image_id = "%012x" % rng.getrandbits(48)
+    image_url = "data:image/png;base64," + base64.b64encode(os.urandom(image_bytes)).decode("ascii")
+    return {
+        "role": "assistant",
+        "content": f'<div class="image-message"><img src="/get_image/{image_id}" alt="{prompt}" style="max-width: 100%; border-radius: 8px; margin: 10px 0; display: block;"><div class="image-caption"><em>Generated image: {prompt}</em></div></div>',
+        "text": prompt,
+        "timestamp": 1700000000.0,
+        "message_type": "image",
+        "image_url": image_url,
+        "image_reference": image_id,
+        "image_prompt": prompt,
+        "image_model": "lustify-sdxl",
+        "sender": "assistant",
+        "type": "dm",
+        "images": [f"/get_image/{image_id}"],
+        "storage_optimized": True,
+    }
+
+def make_campaign(messages=500, players=3, image_every=25, narration_words=180, seed=1234, image_bytes=48 * 1024):
+    """A multiplayer campaign history with an image roughly every `image_every` messages"""
+    rng = random.Random(seed)
+    history = [{"role": "assistant", "content": make_formatted_narration(rng, 60)}]
+    turn = 0
+    while len(history) < messages:
+        turn += 1
+        if image_every and turn % image_every == 0:
+            history.append(make_image_message(rng, image_bytes))
+            continue
+        if turn % 40 == 0:
+            history.append({"role": "system", "content": f"Player {rng.randint(2, players)} has joined the game!", "player": "system"})
+            continue
+        if turn % 2:
+            history.append({"role": "user", "content": make_narration(rng, rng.randint(5, 30)), "player": f"player{rng.randint(1, players)}"})
+        else:
+            history.append({"role": "assistant", "content": make_formatted_narration(rng, narration_words)})
+    return history[:messages]
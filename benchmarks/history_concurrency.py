@@ -0,0 +1,113 @@
+"""
+Stress test for stored-history writes: many processes, each with many threads, append to one game at once.
+
+Every append goes through append_chat_message, so it exercises the striped thread locks within a
+process, the flock across processes and the atomic rename. At the end the stored history must hold
+every message exactly once, in each writer's own order. Exits with status 1 on a lost, duplicated or
+reordered append. --unlocked drops the per-game lock to show what the check catches without it.
+
+Usage: python -m benchmarks.history_concurrency [--processes 4] [--threads 8] [--appends 25] [--unlocked]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.load_sim import percentile
+
+USER_ID = "stress-user"
+GAME_ID = "stress-game"
+
+def run_writer(process_index, threads, appends, unlocked, start, results):
+    """One worker process: its threads append as fast as they can once every process is ready"""
+    import app as aidm
+
+    if unlocked:
+        aidm.chat_history_lock = lambda user_id, game_id=None: contextlib.nullcontext()
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def write(thread_index):
+        with aidm.app.test_request_context():
+            aidm.session["storage_mode"] = "hybrid"
+            for seq in range(appends):
+                message = {"role": "user", "content": f"p{process_index} t{thread_index} #{seq}",
+                           "writer": f"{process_index}-{thread_index}", "seq": seq}
+                started = time.perf_counter()
+                aidm.append_chat_message(USER_ID, message, GAME_ID)
+                with latencies_lock:
+                    latencies.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=write, args=(i,)) for i in range(threads)]
+    start.wait()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(latencies)
+
+def check_history(history, writers, appends):
+    """Problems found in the stored history: lost, duplicated or out-of-order appends per writer"""
+    by_writer = {}
+    for message in history:
+        by_writer.setdefault(message.get("writer"), []).append(message.get("seq"))
+    problems = []
+    for writer in writers:
+        seqs = by_writer.get(writer, [])
+        if seqs != list(range(appends)):
+            lost = appends - len(set(seqs))
+            problems.append(f"writer {writer}: {len(seqs)} stored, {lost} lost, "
+                            f"{len(seqs) - len(set(seqs))} duplicated, in order: {seqs == sorted(seqs)}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="writer threads per process")
+    parser.add_argument("--appends", type=int, default=25, help="messages each thread appends")
+    parser.add_argument("--unlocked", action="store_true", help="bypass chat_history_lock (expected to fail)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="aidm-history-stress-")
+    os.chdir(work_dir)  # chat_histories/ is relative to the working directory, which the writers inherit
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=run_writer, args=(i, args.threads, args.appends, args.unlocked, start, results))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)  # Let the writers import the app before the clock starts
+    started = time.perf_counter()
+    start.set()
+    latencies = [latency for _ in processes for latency in results.get(timeout=600)]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    import app as aidm
+
+    history = aidm.read_history_file(aidm.get_chat_file_path(USER_ID, GAME_ID))
+    writers = [f"{p}-{t}" for p in range(args.processes) for t in range(args.threads)]
+    expected = len(writers) * args.appends
+    problems = check_history(history, writers, args.appends)
+    print(f"{args.processes} processes x {args.threads} threads x {args.appends} appends to one game"
+          f"{' (unlocked)' if args.unlocked else ''} in {work_dir}")
+    print(f"  stored messages   {len(history):,} of {expected:,} in {elapsed:.2f}s ({len(latencies) / elapsed:,.0f} appends/s)")
+    print(f"  append latency    p50 {percentile(latencies, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+    for problem in problems[:10]:
+        print(f"    {problem}")
+    if problems or len(history) != expected:
+        print(f"FAILED: {expected - len(history)} appends lost, {len(problems)} writers affected")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compare stored-history formats: bytes on disk, save latency and load latency.
+
+Usage: python -m benchmarks.history_storage [--messages 500] [--repeat 5]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import encode_history, read_history_file, write_file_atomic, zstandard
+from benchmarks.corpus import make_campaign
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--image-every", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    history = make_campaign(messages=args.messages, image_every=args.image_every)
+    formats = [("json", "none", None), ("gzip", "gzip", 1), ("gzip", "gzip", 6), ("gzip", "gzip", 9)]
+    if zstandard is not None:
+        formats += [("zstd", "zstd", 3), ("zstd", "zstd", 10)]
+    else:
+        print("(zstandard not installed - skipping zstd)")
+
+    print(f"{'format':<10}{'level':>6}{'bytes':>14}{'ratio':>8}{'save ms':>10}{'load ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "chat_history_bench_game.json")
+        plain_size = None
+        for label, compression, level in formats:
+            save = lambda: write_file_atomic(file_path, encode_history(history, compression, level))
+            save_seconds = best_of(save, args.repeat)
+            size = os.path.getsize(file_path)
+            plain_size = plain_size or size
+            load_seconds = best_of(lambda: read_history_file(file_path), args.repeat)
+            print(f"{label:<10}{str(level or '-'):>6}{size:>14,}{size / plain_size:>8.3f}"
+                  f"{save_seconds * 1000:>10.1f}{load_seconds * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Micro-benchmarks for the text-processing hot paths of a /stream turn, with stored baselines.
+
+Each case times one pass of a function over a whole corpus: short replies, ~4k-token
+narrations or a 500-message campaign with images. Pass --history to add a recorded
+(stored or exported) history file as a fourth corpus. Results are compared to the saved baseline and any case slower
+by more than --threshold is flagged (exit status 1), so optimizations can be checked safely.
+
+Usage: python -m benchmarks.hot_paths [--save-baseline] [--threshold 0.15] [--only NAME] [--history FILE]
+"""
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (app, ContextMessage, build_system_prompt, create_structured_api_payload, estimate_tokens,
+                 format_message_content, get_model_capabilities, process_image_requests, read_history_file,
+                 strip_html_tags, truncate_chat_history)
+from benchmarks.corpus import make_campaign, make_formatted_narration, make_raw_reply
+from config import DEFAULT_MODEL_ID
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "hot_paths.json")
+
+def make_corpora(history_file=None, seed=4321):
+    """Named corpora; each is a dict of the shapes the cases need"""
+    rng = random.Random(seed)
+    short = [make_raw_reply(rng, rng.randint(20, 60), image_tag=i % 10 == 0) for i in range(200)]
+    long = [make_raw_reply(rng, 2400, image_tag=True) for _ in range(10)]  # ~4k tokens each
+    corpora = {
+        "short": {"raw": short, "html": [make_formatted_narration(rng, 40) for _ in range(200)]},
+        "narration_4k": {"raw": long, "html": [make_formatted_narration(rng, 2400) for _ in range(10)]},
+        "campaign_500": {"history": make_campaign(messages=500, image_every=25)},
+    }
+    if history_file:
+        corpora["recorded"] = {"history": read_history_file(history_file)}
+    for corpus in corpora.values():
+        if "history" in corpus:
+            # Stored messages: raw replies come from assistant turns, HTML from everything stored
+            corpus["html"] = [msg.get("content", "") for msg in corpus["history"]]
+            corpus["raw"] = [msg.get("content", "") for msg in corpus["history"] if msg.get("role") == "assistant"]
+    return corpora
+
+def api_messages_for(history, system_prompt):
+    """The api_messages list generate() builds from a truncated history"""
+    api_messages = [{"role": "system", "content": system_prompt}]
+    for msg in truncate_chat_history(history, system_prompt):
+        role = "system" if msg.is_system_notice else (msg.role or "assistant")
+        api_messages.append({"role": role, "content": msg.api_text})
+    return api_messages
+
+def make_cases(corpora):
+    """(name, fn) pairs; each fn processes one whole corpus"""
+    system_prompt = build_system_prompt(True)
+    capabilities = get_model_capabilities(DEFAULT_MODEL_ID)
+    cases = []
+    for corpus_name, corpus in corpora.items():
+        raw, html = corpus["raw"], corpus["html"]
+        cases.append((f"format_message_content/{corpus_name}", lambda raw=raw: [format_message_content(text) for text in raw]))
+        cases.append((f"process_image_requests/{corpus_name}", lambda raw=raw: [process_image_requests(text) for text in raw]))
+        cases.append((f"strip_html_tags/{corpus_name}", lambda html=html: [strip_html_tags(text) for text in html]))
+        cases.append((f"estimate_tokens/{corpus_name}", lambda html=html: [estimate_tokens(text) for text in html]))
+        if "history" in corpus:
+            history = corpus["history"]
+            parsed = [ContextMessage.from_dict(msg) for msg in history]
+            api_messages = api_messages_for(parsed, system_prompt)
+            # Dicts pay for parsing inside truncate_chat_history; parsed is the /chat -> /stream handoff path
+            cases.append((f"truncate_chat_history/{corpus_name}", lambda history=history: truncate_chat_history(history, system_prompt)))
+            cases.append((f"truncate_chat_history/{corpus_name}_parsed", lambda parsed=parsed: truncate_chat_history(parsed, system_prompt)))
+            cases.append((f"create_structured_api_payload/{corpus_name}",
+                          lambda api_messages=api_messages: create_structured_api_payload(api_messages, DEFAULT_MODEL_ID, capabilities)))
+    return cases
+
+def measure(fn, repeat, min_seconds):
+    """Best time for one pass over a corpus, in microseconds; passes are batched until a batch lasts min_seconds"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_seconds:
+        number *= 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+def load_baseline(path):
+    try:
+        with open(path) as baseline_file:
+            return json.load(baseline_file)
+    except FileNotFoundError:
+        return None
+
+def machine_info():
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "node": platform.node()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="minimum duration of one timed batch")
+    parser.add_argument("--threshold", type=float, default=0.15, help="slowdown vs baseline flagged as a regression")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write these results as the new baseline")
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--history", help="stored or exported history file to add as the 'recorded' corpus")
+    args = parser.parse_args()
+
+    app.logger.disabled = True
+    cases = make_cases(make_corpora(args.history))
+    if args.only:
+        cases = [(name, fn) for name, fn in cases if args.only in name]
+
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    if baseline and baseline.get("machine") != machine_info():
+        print(f"(baseline was recorded on {baseline.get('machine')} - comparisons may not be meaningful)")
+
+    print(f"{'case':<52}{'us/pass':>12}{'baseline':>12}{'change':>9}")
+    results, regressions = {}, []
+    for name, fn in cases:
+        micros = results[name] = measure(fn, args.repeat, args.min_seconds)
+        previous = (baseline or {}).get("results", {}).get(name)
+        if previous:
+            change = micros / previous - 1
+            flag = "  REGRESSION" if change > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print(f"{name:<52}{micros:>12.1f}{previous:>12.1f}{change:>+9.1%}{flag}")
+        else:
+            print(f"{name:<52}{micros:>12.1f}{'-':>12}{'-':>9}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": machine_info(),
+                       "results": results}, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved baseline for {len(results)} cases to {args.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {args.baseline} - run with --save-baseline to record one")
+
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
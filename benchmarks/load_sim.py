@@ -0,0 +1,404 @@
+"""
+Multiplayer table load simulator: replays hot-seat campaign sessions against a local server.
+
+Each table is one browser (one user_id cookie) whose players take turns: names are set with
+/set_player_name, then every turn is a /chat (client-history delta sync, like main.js) followed by
+a /stream read to the done event, with think time between turns. Load steps up through --tables
+levels; each level reports throughput and latency (the saturation curve), and the server-side
+stage timings from /stream?timing=1 are compared with client-observed latency to name the first
+resource to bottleneck. The server and an upstream stub (benchmarks.upstream_stub) are started
+locally unless --url points at a running server.
+
+Usage: python -m benchmarks.load_sim [--tables 1,2,4,8,16] [--duration 30] [--players 4] [--think 3]
+                                     [--server werkzeug|gunicorn] [--workers 2] [--threads 8]
+                                     [--storage client-only|hybrid] [--csv FILE] [--json FILE]
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.corpus import make_campaign, make_narration
+from benchmarks import upstream_stub
+
+# Server-side spans (TurnSpans in app.py) grouped into the resources they wait on
+SPAN_GROUPS = {
+    "cpu": ("player_count", "system_prompt", "truncation", "payload_build", "image_tags", "formatting"),
+    "history": ("history_load", "history_save"),
+    "upstream": ("upstream_connect", "upstream_first_byte", "upstream_last_byte"),
+    "images": ("image",),
+}
+RESOURCES = {
+    "queue": "server worker slots - turns wait for a free worker/thread before the handler runs",
+    "cpu": "server CPU - prompt building and formatting slow down (GIL contention or too few cores)",
+    "history": "history storage - file I/O and per-game lock waits",
+    "upstream": "upstream chat API, or the connection path to it",
+    "images": "image path - upstream renders, image store writes and the variant pool",
+}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def process_tree_cpu_seconds(pid):
+    """User+system CPU seconds of a process and its descendants, from /proc (None where unavailable)"""
+    total, pending, tick = 0.0, [pid], os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/stat") as stat_file:
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / tick
+            for task in os.listdir(f"/proc/{current}/task"):
+                try:
+                    with open(f"/proc/{current}/task/{task}/children") as children_file:
+                        pending.extend(int(child) for child in children_file.read().split())
+                except OSError:
+                    pass
+    except (OSError, ValueError, IndexError):
+        return None if current == pid else total
+    return total
+
+def start_stub(args):
+    command = [sys.executable, "-m", "benchmarks.upstream_stub", "--port", "0", "--ttft", str(args.ttft),
+               "--tokens-per-second", str(args.tokens_per_second), "--reply-tokens", str(args.reply_tokens),
+               "--image-rate", str(args.image_rate), "--image-seconds", str(args.image_seconds)]
+    process = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    match = re.search(r"http://\S+", line)
+    if not match:
+        process.kill()
+        raise RuntimeError(f"Upstream stub did not start: {line!r}")
+    return process, match.group(0)
+
+def start_server(args, stub_url, work_dir):
+    """Run the app against the stub, in a scratch directory so chat_histories/ stays out of the repo"""
+    port = free_port()
+    env = dict(os.environ, AIDM_VENICE_URL=f"{stub_url}/chat", AIDM_VENICE_IMAGE_URL=f"{stub_url}/image",
+               PYTHONPATH=REPO_DIR, VENICE_API_KEY=os.environ.get("VENICE_API_KEY") or "load-sim")
+    if args.server == "gunicorn":
+        if args.workers > 1:
+            # /chat and /stream may land on different workers, so the context handoff and usage ledger must be shared
+            env.setdefault("AIDM_CONTEXT_STORE", "sqlite")
+            env.setdefault("AIDM_USAGE_STORE", "sqlite")
+        # The production config (gunicorn.conf.py); the flags override its AIDM_* defaults
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_DIR, "gunicorn.conf.py"),
+                   "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers), "--worker-class", "gthread",
+                   "--threads", str(args.threads), "wsgi:app"]
+    else:
+        command = [sys.executable, "-c", "from app import app; app.run(host='127.0.0.1', port=%d, threaded=True)" % port]
+    process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL,
+                               stderr=open(os.path.join(work_dir, "server.log"), "w"))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup; see {work_dir}/server.log")
+        try:
+            requests.get(f"{url}/healthz", timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not answer within 30s")
+
+class Table:
+    """One hot-seat table: a browser session whose players take turns until the level ends"""
+
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.args = sim.args
+        self.rng = random.Random(index)
+        self.http = requests.Session()
+        self.http.cookies.set("user_id", f"loadsim-{index}-{uuid.uuid4().hex[:8]}")
+
+    def run(self, stop_at):
+        if self.args.storage == "hybrid":
+            self.http.post(f"{self.sim.url}/set_storage_mode", json={"storage_mode": "hybrid"}, timeout=30)
+        while time.time() < stop_at:
+            self.play_session(stop_at)
+
+    def play_session(self, stop_at):
+        game_id = f"game_{int(time.time() * 1000)}_{uuid.uuid4().hex[:9]}"
+        history = self.seed_history()
+        for player in range(1, self.args.players + 1):
+            self.http.post(f"{self.sim.url}/set_player_name", timeout=30,
+                           json={"game_id": game_id, "player_number": player, "new_name": f"Hero{player}"})
+        synced = None  # (context hash, messages covered) from the previous /chat
+        for turn in range(self.args.turns):
+            time.sleep(min(self.rng.expovariate(1 / self.args.think), self.args.think * 4) if self.args.think > 0 else 0)
+            if time.time() >= stop_at:
+                return
+            player = turn % self.args.players + 1
+            message = make_narration(self.rng, self.rng.randint(5, 30))
+            result, synced = self.play_turn(game_id, history, synced, player, message)
+            self.sim.record(result)
+            if result.get("error"):
+                time.sleep(1)  # Back off, then start a fresh session rather than replaying a broken one
+                return
+
+    def seed_history(self):
+        """Earlier campaign messages as main.js would send them (images collapsed to their prompts)"""
+        if not self.args.campaign_messages:
+            return []
+        history = make_campaign(messages=self.args.campaign_messages, players=self.args.players, image_bytes=0,
+                                seed=self.rng.randrange(1 << 30))
+        return [{"role": "assistant", "content": f"[image: {msg['image_prompt']}]"} if msg.get("message_type") == "image"
+                else {key: msg[key] for key in ("role", "content", "player") if key in msg} for msg in history]
+
+    def play_turn(self, game_id, history, synced, player, message):
+        result = {"started": time.time()}
+        payload = {"message": message, "game_id": game_id, "player_number": player}
+        if synced:
+            payload.update(base_hash=synced[0], client_history_delta=history[synced[1]:])
+        else:
+            payload["client_history"] = history
+        try:
+            started = time.perf_counter()
+            response = self.http.post(f"{self.sim.url}/chat", json=payload, timeout=60)
+            if response.status_code == 409:
+                payload = {"message": message, "game_id": game_id, "player_number": player, "client_history": history}
+                response = self.http.post(f"{self.sim.url}/chat", json=payload, timeout=60)
+            response.raise_for_status()
+            chat = response.json()
+            result["chat_ms"] = (time.perf_counter() - started) * 1000
+            synced = (chat["context_hash"], len(history)) if chat.get("context_hash") else None
+            history.append({"role": "user", "content": message, "player": f"player{player}"})
+
+            started = time.perf_counter()
+            reply = self.read_stream(chat["message_id"], game_id, result, started)
+            result["turn_ms"] = result["chat_ms"] + (time.perf_counter() - started) * 1000
+            history.append({"role": "assistant", "content": reply})
+            for prompt in result.pop("image_prompts", []):
+                history.append({"role": "assistant", "content": f"[image: {prompt}]"})
+        except (requests.RequestException, ValueError, KeyError) as e:
+            result["error"] = type(e).__name__
+        return result, synced
+
+    def read_stream(self, message_id, game_id, result, started):
+        reply, event = "", None
+        with self.http.get(f"{self.sim.url}/stream", params={"game_id": game_id, "message_id": message_id, "timing": "1"},
+                           stream=True, timeout=(10, 120)) as response:
+            response.raise_for_status()
+            # Image events carry base64 images; the default 512-byte reads would make the client the bottleneck
+            for line in response.iter_lines(chunk_size=64 * 1024, decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[5:].strip() or "{}")
+                if event == "done":
+                    result["server"] = data.get("timing")
+                    result["stream_ms"] = (time.perf_counter() - started) * 1000
+                    break
+                if data.get("error"):
+                    result["error"] = "stream_error"
+                elif data.get("image_generated"):
+                    result.setdefault("image_prompts", []).append(data["image_message"].get("image_prompt", ""))
+                    result.setdefault("image_ms", []).append((time.perf_counter() - started) * 1000)
+                elif data.get("content"):
+                    result.setdefault("ttft_ms", (time.perf_counter() - started) * 1000)
+                    reply = data.get("full", reply)
+        return reply
+
+class Simulator:
+    def __init__(self, args, url, server_pid=None, stub_url=None):
+        self.args = args
+        self.url = url
+        self.server_pid = server_pid
+        self.stub_url = stub_url
+        self._lock = threading.Lock()
+        self._results = []
+
+    def record(self, result):
+        with self._lock:
+            self._results.append(result)
+
+    def stub_stats(self, reset=False):
+        if not self.stub_url:
+            return {}
+        try:
+            return requests.get(f"{self.stub_url}/{'reset' if reset else 'stats'}", timeout=5).json()
+        except requests.RequestException:
+            return {}
+
+    def run_level(self, tables):
+        self._results = []
+        self.stub_stats(reset=True)
+        cpu_before, wall_before = process_tree_cpu_seconds(self.server_pid) if self.server_pid else None, time.time()
+        stop_at = time.time() + self.args.duration
+        threads = [threading.Thread(target=Table(self, index).run, args=(stop_at,), daemon=True)
+                   for index in range(tables)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(self.args.duration + 180)
+        wall = time.time() - wall_before
+        cpu_after = process_tree_cpu_seconds(self.server_pid) if self.server_pid else None
+        level = self.summarize(tables, self._results, wall)
+        level["server_cpu_cores"] = round((cpu_after - cpu_before) / wall, 2) if cpu_before is not None and cpu_after is not None else None
+        level["upstream_max_in_flight"] = self.stub_stats().get("max_in_flight")
+        return level
+
+    def summarize(self, tables, results, wall):
+        done = [result for result in results if "error" not in result and "turn_ms" in result]
+        components = {name: [] for name in ["queue"] + list(SPAN_GROUPS)}
+        for result in done:
+            server = result.get("server")
+            if not server:
+                continue
+            span_ms = {}
+            for span in server["spans"]:
+                span_ms[span["name"]] = span_ms.get(span["name"], 0) + span["ms"]
+            components["queue"].append(max(0.0, result["stream_ms"] - server["total_ms"]))
+            for group, names in SPAN_GROUPS.items():
+                components[group].append(sum(span_ms.get(name, 0) for name in names))
+        return {
+            "tables": tables,
+            "turns": len(done),
+            "errors": len(results) - len(done),
+            "turns_per_min": round(len(done) / wall * 60, 1),
+            "chat_p95_ms": percentile([r["chat_ms"] for r in done], 95),
+            "ttft_p50_ms": percentile([r["ttft_ms"] for r in done if "ttft_ms" in r], 50),
+            "ttft_p95_ms": percentile([r["ttft_ms"] for r in done if "ttft_ms" in r], 95),
+            "turn_p50_ms": percentile([r["turn_ms"] for r in done], 50),
+            "turn_p95_ms": percentile([r["turn_ms"] for r in done], 95),
+            "turn_p99_ms": percentile([r["turn_ms"] for r in done], 99),
+            "images": sum(len(r.get("image_ms", [])) for r in done),
+            "component_p95_ms": {name: percentile(values, 95) for name, values in components.items()},
+        }
+
+def find_bottleneck(levels, efficiency_floor=0.8, latency_factor=2.0):
+    """
+    First saturated level - throughput per table falls below efficiency_floor of the lightest
+    level, or turn p95 exceeds latency_factor times it - and the resource whose p95 grew most.
+    """
+    base = levels[0]
+    if not base["turns"]:
+        return None
+    per_table = base["turns_per_min"] / base["tables"]
+    for level in levels[1:]:
+        efficiency = level["turns_per_min"] / (per_table * level["tables"]) if per_table else 0
+        slow = level["turn_p95_ms"] and base["turn_p95_ms"] and level["turn_p95_ms"] > latency_factor * base["turn_p95_ms"]
+        if efficiency < efficiency_floor or slow or level["errors"] > base["errors"]:
+            growth = {name: (level["component_p95_ms"].get(name) or 0) - (base["component_p95_ms"].get(name) or 0)
+                      for name in RESOURCES}
+            resource = max(growth, key=growth.get)
+            return {"tables": level["tables"], "efficiency": round(efficiency, 2), "resource": resource,
+                    "description": RESOURCES[resource], "p95_growth_ms": {name: round(ms, 1) for name, ms in growth.items()}}
+    return None
+
+def bar(value, peak, width=30):
+    return "#" * int(round(width * value / peak)) if peak else ""
+
+def print_report(levels, bottleneck):
+    def ms(value):
+        return f"{value:.0f}" if value is not None else "-"
+    print(f"\n{'tables':>6}{'turns/min':>11}{'errors':>8}{'chat p95':>10}{'ttft p50':>10}{'ttft p95':>10}"
+          f"{'turn p50':>10}{'turn p95':>10}{'turn p99':>10}{'cpu cores':>11}{'upstream':>10}")
+    for level in levels:
+        print(f"{level['tables']:>6}{level['turns_per_min']:>11.1f}{level['errors']:>8}{ms(level['chat_p95_ms']):>10}"
+              f"{ms(level['ttft_p50_ms']):>10}{ms(level['ttft_p95_ms']):>10}{ms(level['turn_p50_ms']):>10}"
+              f"{ms(level['turn_p95_ms']):>10}{ms(level['turn_p99_ms']):>10}"
+              f"{level['server_cpu_cores'] if level['server_cpu_cores'] is not None else '-':>11}"
+              f"{level['upstream_max_in_flight'] if level['upstream_max_in_flight'] is not None else '-':>10}")
+
+    print("\nThroughput (turns/min)")
+    peak = max(level["turns_per_min"] for level in levels)
+    for level in levels:
+        print(f"{level['tables']:>6} |{bar(level['turns_per_min'], peak):<30} {level['turns_per_min']:.1f}")
+    print("\nTurn latency p95 (ms)")
+    peak = max(level["turn_p95_ms"] or 0 for level in levels)
+    for level in levels:
+        print(f"{level['tables']:>6} |{bar(level['turn_p95_ms'] or 0, peak):<30} {ms(level['turn_p95_ms'])}")
+
+    print("\nWhere turn time went (p95 ms): " + ", ".join(RESOURCES))
+    for level in levels:
+        print(f"{level['tables']:>6} | " + "  ".join(f"{name} {ms(value)}" for name, value in level["component_p95_ms"].items()))
+
+    if bottleneck:
+        print(f"\nSaturates at {bottleneck['tables']} tables (per-table throughput {bottleneck['efficiency']:.0%} of the lightest level).")
+        print(f"First bottleneck: {bottleneck['resource']} - {bottleneck['description']}")
+    else:
+        print("\nNo saturation within the tested levels - add larger --tables values.")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tables", default="1,2,4,8,16", help="comma-separated concurrent table counts, one level each")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level")
+    parser.add_argument("--players", type=int, default=4, help="players per table, taking turns")
+    parser.add_argument("--think", type=float, default=3.0, help="mean think time between turns (seconds)")
+    parser.add_argument("--turns", type=int, default=20, help="turns per session before the table starts a new game")
+    parser.add_argument("--campaign-messages", type=int, default=0, help="earlier messages each session starts with")
+    parser.add_argument("--storage", choices=["client-only", "hybrid"], default="client-only")
+    parser.add_argument("--server", choices=["werkzeug", "gunicorn"], default="werkzeug")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--url", help="use an already running server (point its AIDM_VENICE_* URLs at a stub yourself)")
+    parser.add_argument("--csv", help="write one row per level to this file")
+    parser.add_argument("--json", help="write levels and the bottleneck verdict to this file")
+    upstream_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    processes = []
+    work_dir = tempfile.mkdtemp(prefix="aidm-loadsim-")
+    try:
+        stub_url, server_pid = None, None
+        url = args.url
+        if not url:
+            stub_process, stub_url = start_stub(args)
+            processes.append(stub_process)
+            server_process, url = start_server(args, stub_url, work_dir)
+            processes.append(server_process)
+            server_pid = server_process.pid
+            print(f"Server {url} ({args.server}) in {work_dir}, upstream stub {stub_url}")
+
+        sim = Simulator(args, url, server_pid, stub_url)
+        levels = []
+        for tables in [int(value) for value in args.tables.split(",")]:
+            print(f"Level: {tables} tables x {args.players} players for {args.duration:.0f}s...", flush=True)
+            levels.append(sim.run_level(tables))
+        bottleneck = find_bottleneck(levels)
+        print_report(levels, bottleneck)
+
+        if args.csv:
+            columns = [key for key in levels[0] if key != "component_p95_ms"] + [f"{name}_p95_ms" for name in RESOURCES]
+            with open(args.csv, "w") as csv_file:
+                csv_file.write(",".join(columns) + "\n")
+                for level in levels:
+                    row = dict(level, **{f"{name}_p95_ms": value for name, value in level["component_p95_ms"].items()})
+                    csv_file.write(",".join("" if row[column] is None else str(row[column]) for column in columns) + "\n")
+        if args.json:
+            with open(args.json, "w") as json_file:
+                json.dump({"args": vars(args), "levels": levels, "bottleneck": bottleneck}, json_file, indent=2)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+if __name__ == "__main__":
+    main()
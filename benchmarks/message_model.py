@@ -0,0 +1,118 @@
+"""
+Per-turn cost of the /stream context loops: message dicts re-processed every turn
+(the previous approach) vs ContextMessage parsed once at ingest.
+
+Usage: python -m benchmarks.message_model [--messages 500] [--turns 50]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, ContextMessage, build_system_prompt, estimate_tokens, strip_html_tags, truncate_chat_history
+from benchmarks.corpus import make_campaign
+from config import MAX_HISTORY_SIZE
+
+def dict_turn(history, system_prompt):
+    """The dict-based player count, truncation and API formatting loops, as generate() used to run them"""
+    player_counts = {}
+    for msg in history:
+        if msg.get("role") == "user" and msg.get("player"):
+            player = msg.get("player")
+            player_counts[player] = player_counts.get(player, 0) + 1
+    is_multiplayer = len(player_counts) > 1
+
+    available_tokens = 45000 - estimate_tokens(system_prompt) - 3000
+    truncated, current_tokens = [], 0
+    min_messages_to_keep = min(15, len(history))
+    for i, msg in enumerate(reversed(history)):
+        msg_tokens = estimate_tokens(msg.get("content", ""))
+        if i < min_messages_to_keep or msg_tokens < 50 or (msg.get("role") == "system" and msg.get("player") == "system") \
+                or current_tokens + msg_tokens <= available_tokens:
+            truncated.insert(0, msg)
+            current_tokens += msg_tokens
+        else:
+            break
+    truncated = truncated[-MAX_HISTORY_SIZE:]
+
+    api_messages = [{"role": "system", "content": system_prompt}]
+    for msg in truncated:
+        if msg.get("role") == "system" and msg.get("player") == "system":
+            api_messages.append({"role": "system", "content": msg["content"]})
+        elif msg.get("role") == "user":
+            prefix = ""
+            if is_multiplayer and msg.get("player"):
+                prefix = f"Player {msg.get('player').replace('player', '')}: "
+            api_messages.append({"role": "user", "content": prefix + strip_html_tags(msg["content"])})
+        else:
+            api_messages.append({"role": msg.get("role", "assistant"), "content": strip_html_tags(msg.get("content", ""))})
+    return api_messages
+
+def model_turn(messages, system_prompt):
+    """The same loops over ContextMessage, as generate() runs them now"""
+    player_counts = {}
+    for msg in messages:
+        if msg.role == "user" and msg.player:
+            player_counts[msg.player] = player_counts.get(msg.player, 0) + 1
+    is_multiplayer = len(player_counts) > 1
+
+    api_messages = [{"role": "system", "content": system_prompt}]
+    for msg in truncate_chat_history(messages, system_prompt):
+        if msg.is_system_notice:
+            api_messages.append({"role": "system", "content": msg.api_text})
+        elif msg.role == "user":
+            prefix = f"Player {msg.player_label}: " if is_multiplayer and msg.player_label else ""
+            api_messages.append({"role": "user", "content": prefix + msg.api_text})
+        else:
+            api_messages.append({"role": msg.role or "assistant", "content": msg.api_text})
+    return api_messages
+
+def run_campaign(history, turns, per_turn_new, use_model):
+    """Replay `turns` turns; each turn adds `per_turn_new` messages to the rolling context"""
+    start_size = len(history) - turns * per_turn_new
+    system_prompt = build_system_prompt(True)
+    context = history[:start_size]
+    if use_model:
+        context = [ContextMessage.from_dict(msg) for msg in context]
+    elapsed = 0.0
+    for turn in range(turns):
+        new = history[start_size + turn * per_turn_new:start_size + (turn + 1) * per_turn_new]
+        started = time.perf_counter()
+        if use_model:
+            context = (context + [ContextMessage.from_dict(msg) for msg in new])[-200:]
+            model_turn(context, system_prompt)
+        else:
+            context = (context + list(new))[-200:]
+            dict_turn(context, system_prompt)
+        elapsed += time.perf_counter() - started
+    return elapsed / turns, context
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+
+    app.logger.disabled = True
+    history = make_campaign(messages=args.messages, image_every=0)
+
+    print(f"{'variant':<16}{'ms/turn':>10}{'bytes/msg':>11}")
+    payload = json.dumps(history[-200:])
+    for label, use_model in (("dicts", False), ("ContextMessage", True)):
+        per_turn, _ = run_campaign(history, args.turns, 2, use_model)
+
+        # Memory of a 200-message context as handed from /chat to /stream (parsed from JSON)
+        tracemalloc.start()
+        context = json.loads(payload)
+        if use_model:
+            context = [ContextMessage.from_dict(msg) for msg in context]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<16}{per_turn * 1000:>10.3f}{current / len(context):>11.0f}")
+
+if __name__ == "__main__":
+    main()
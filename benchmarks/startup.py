@@ -0,0 +1,227 @@
+"""
+Startup benchmark for the production entry point (gunicorn.conf.py + wsgi.py), against the upstream stub.
+
+Boots gunicorn the way production does and reports the time until every worker answers /healthz,
+worker memory (RSS, and PSS where /proc has it, so preloading shows up as shared pages) and a first
+round of turns. It then checks the two properties a multi-worker deploy depends on: a session set
+through one worker is honoured by all of them (shared secret key), and turns in flight when the
+server gets SIGTERM still reach their done event (graceful drain). Exits with status 1 if either fails.
+
+Usage: python -m benchmarks.startup [--workers 2] [--threads 8] [--worker-class gthread] [--no-preload]
+                                    [--turns 4] [--session-checks 20] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks import upstream_stub
+from benchmarks.load_sim import free_port, percentile, start_stub
+
+GUNICORN_CONF = os.path.join(REPO_DIR, "gunicorn.conf.py")
+
+def start_server(args, stub_url, work_dir):
+    """Launch gunicorn with the production config in a scratch directory; returns (process, url)"""
+    port = free_port()
+    env = dict(os.environ, AIDM_VENICE_URL=f"{stub_url}/chat", AIDM_VENICE_IMAGE_URL=f"{stub_url}/image",
+               PYTHONPATH=REPO_DIR, VENICE_API_KEY=os.environ.get("VENICE_API_KEY") or "startup-bench",
+               AIDM_BIND=f"127.0.0.1:{port}", AIDM_WORKERS=str(args.workers), AIDM_THREADS=str(args.threads),
+               AIDM_WORKER_CLASS=args.worker_class, AIDM_PRELOAD="0" if args.no_preload else "1",
+               AIDM_GRACEFUL_TIMEOUT=str(args.graceful_timeout))
+    env.pop("AIDM_SECRET_KEY", None)  # Exercise the generated, file-shared key
+    env.pop("AIDM_CONTEXT_STORE", None)  # And the multi-worker store defaults
+    env.pop("AIDM_USAGE_STORE", None)
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", GUNICORN_CONF, "wsgi:app"], cwd=work_dir,
+                               env=env, stdout=subprocess.DEVNULL, stderr=open(os.path.join(work_dir, "server.log"), "w"))
+    return process, f"http://127.0.0.1:{port}"
+
+def wait_until_ready(process, url, workers, timeout, work_dir):
+    """Poll /healthz on fresh connections until every worker has answered; returns (first_s, all_s, pids)"""
+    started = time.monotonic()
+    first, pids = None, set()
+    while time.monotonic() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup; see {work_dir}/server.log")
+        try:
+            response = requests.get(f"{url}/healthz", headers={"Connection": "close"}, timeout=2)
+        except requests.RequestException:
+            time.sleep(0.05)
+            continue
+        if response.status_code == 200:
+            first = first if first is not None else time.monotonic() - started
+            pids.add(response.json()["pid"])
+            if len(pids) >= workers:
+                return first, time.monotonic() - started, sorted(pids)
+    raise RuntimeError(f"Only {len(pids)} of {workers} workers answered within {timeout:.0f}s")
+
+def worker_memory(pid):
+    """(rss_kb, pss_kb) from /proc; None where unavailable"""
+    rss = pss = None
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            rss = next(int(line.split()[1]) for line in status_file if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/smaps_rollup") as smaps_file:
+            pss = next(int(line.split()[1]) for line in smaps_file if line.startswith("Pss:"))
+    except (OSError, StopIteration):
+        pass
+    return rss, pss
+
+def check_sessions(url, checks):
+    """Set a session value through one worker, then read it back on fresh connections (any worker)"""
+    http = requests.Session()
+    http.post(f"{url}/set_storage_mode", json={"storage_mode": "client-only"}, timeout=10).raise_for_status()
+    kept = 0
+    for _ in range(checks):
+        response = http.get(f"{url}/get_storage_mode", headers={"Connection": "close"}, timeout=10)
+        kept += response.json().get("storage_mode") == "client-only"
+    return kept
+
+def play_turn(url, index, first_token=None):
+    """One /chat + /stream turn in its own session; returns its timings and whether it completed"""
+    http = requests.Session()
+    http.cookies.set("user_id", f"startup-{index}")
+    game_id = f"startup-game-{index}"
+    result = {"done": False, "error": None}
+    started = time.perf_counter()
+    try:
+        chat = http.post(f"{url}/chat", json={"message": "I open the tavern door", "game_id": game_id,
+                                              "client_history": []}, timeout=30).json()
+        with http.get(f"{url}/stream", params={"game_id": game_id, "message_id": chat["message_id"]},
+                      stream=True, timeout=(10, 180)) as response:
+            event = None
+            for line in response.iter_lines(chunk_size=64 * 1024, decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[5:].strip() or "{}")
+                    if event == "done":
+                        result["done"] = True
+                        break
+                    if data.get("error"):
+                        result["error"] = data.get("content")
+                    elif data.get("content") and "ttft_ms" not in result:
+                        result["ttft_ms"] = (time.perf_counter() - started) * 1000
+                        if first_token is not None:
+                            first_token.release()
+    except (requests.RequestException, ValueError, KeyError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["total_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+def run_turns(url, count, first_token=None, on_started=None):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, play_turn(url, i, first_token)))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    if on_started:
+        on_started()
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize_turns(results):
+    completed = [result for result in results if result["done"] and not result["error"]]
+    ttft = [result["ttft_ms"] for result in completed if "ttft_ms" in result]
+    return {"turns": len(results), "completed": len(completed),
+            "ttft_p50_ms": percentile(ttft, 50), "total_p50_ms": percentile([r["total_ms"] for r in completed], 50),
+            "errors": sorted({result["error"] for result in results if result["error"]})}
+
+def drain_check(process, url, turns, graceful_timeout):
+    """Start turns, SIGTERM the master once each is streaming, and see whether they all finish"""
+    first_token = threading.Semaphore(0)
+    timing = {}
+
+    def stop_when_streaming():
+        deadline = time.monotonic() + 30
+        for _ in range(turns):
+            first_token.acquire(timeout=max(0, deadline - time.monotonic()))
+        timing["signalled"] = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+
+    results = run_turns(url, turns, first_token, on_started=lambda: threading.Thread(target=stop_when_streaming).start())
+    exit_code = process.wait(graceful_timeout + 30)
+    summary = summarize_turns(results)
+    summary["exit_seconds"] = round(time.monotonic() - timing.get("signalled", time.monotonic()), 2)
+    summary["exit_code"] = exit_code
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--no-preload", action="store_true", help="import the app in each worker instead of once")
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=4, help="concurrent turns for the warm-up and drain checks")
+    parser.add_argument("--session-checks", type=int, default=20, help="fresh-connection reads of one session")
+    parser.add_argument("--json", help="write the results to this file")
+    upstream_stub.add_arguments(parser)
+    parser.set_defaults(image_rate=0.0)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="aidm-startup-")
+    stub_process, stub_url = start_stub(args)
+    server = None
+    try:
+        launched = time.monotonic()
+        server, url = start_server(args, stub_url, work_dir)
+        first_s, ready_s, pids = wait_until_ready(server, url, args.workers, 60, work_dir)
+        memory = {pid: worker_memory(pid) for pid in pids}
+        master_memory = worker_memory(server.pid)
+        print(f"gunicorn {args.worker_class} x {args.workers} workers ({args.threads} threads, "
+              f"preload={'no' if args.no_preload else 'yes'}) in {work_dir}")
+        print(f"  first /healthz answer   {first_s:6.2f}s after launch")
+        print(f"  all workers answering   {ready_s:6.2f}s after launch")
+        for pid, (rss, pss) in [(server.pid, master_memory)] + list(memory.items()):
+            role = "master" if pid == server.pid else "worker"
+            print(f"  {role} {pid:<8} rss {rss or 0:>8,} kB   pss {pss if pss is not None else '-':>8} kB")
+
+        warm = summarize_turns(run_turns(url, args.turns))
+        print(f"  first turns             {warm['completed']}/{warm['turns']} completed, "
+              f"ttft p50 {warm['ttft_p50_ms'] or 0:.0f} ms, total p50 {warm['total_p50_ms'] or 0:.0f} ms")
+
+        kept = check_sessions(url, args.session_checks)
+        print(f"  shared session          {kept}/{args.session_checks} fresh-connection reads kept the session")
+
+        drain = drain_check(server, url, args.turns, args.graceful_timeout)
+        print(f"  drain on SIGTERM        {drain['completed']}/{drain['turns']} in-flight turns finished; "
+              f"server exited ({drain['exit_code']}) {drain['exit_seconds']:.2f}s after the signal")
+        for error in warm["errors"] + drain["errors"]:
+            print(f"    error: {error}")
+
+        failures = []
+        if kept < args.session_checks:
+            failures.append("sessions are not shared between workers")
+        if drain["completed"] < drain["turns"]:
+            failures.append("streams were dropped during shutdown")
+        if args.json:
+            with open(args.json, "w") as json_file:
+                json.dump({"args": vars(args), "first_ready_seconds": first_s, "all_ready_seconds": ready_s,
+                           "memory_kb": {str(pid): values for pid, values in memory.items()},
+                           "master_memory_kb": master_memory, "warm_turns": warm, "session_reads_kept": kept,
+                           "drain": drain, "failures": failures}, json_file, indent=2)
+        if failures:
+            print("FAILED: " + "; ".join(failures))
+            sys.exit(1)
+    finally:
+        for process in (server, stub_process):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Stand-in for the Venice chat and image APIs, for load tests that must not hit (or pay for) the real service.
+
+Chat requests stream SSE deltas after a configurable time-to-first-token at a fixed token rate;
+a share of replies ends with an [IMAGE: ...] tag so the server also generates images. Image
+requests wait, then return a real WebP (base64 JSON, or raw bytes when return_binary is set).
+GET /stats reports requests served and in-flight concurrency since the last reset.
+
+Usage: python -m benchmarks.upstream_stub [--port 0] [--ttft 0.4] [--tokens-per-second 60] [--image-rate 0.2]
+Point the app at it with AIDM_VENICE_URL=http://127.0.0.1:PORT/chat and AIDM_VENICE_IMAGE_URL=http://127.0.0.1:PORT/image
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.corpus import make_narration
+
+def make_webp(size=1024, seed=7):
+    """A noisy WebP, so stored sizes and decode costs resemble real generations"""
+    from PIL import Image
+    noise = Image.effect_noise((size, size), 48).convert("RGB")
+    tint = Image.new("RGB", (size, size), tuple(random.Random(seed).randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    Image.blend(noise, tint, 0.6).save(buffer, "WEBP", quality=80)
+    return buffer.getvalue()
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.chat_requests = 0
+            self.image_requests = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+    def begin(self, kind):
+        with self._lock:
+            setattr(self, f"{kind}_requests", getattr(self, f"{kind}_requests") + 1)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"chat_requests": self.chat_requests, "image_requests": self.image_requests,
+                    "in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+
+def make_handler(options, stats, webp):
+    rng = random.Random(options.seed)
+    rng_lock = threading.Lock()
+    image_b64 = base64.b64encode(webp).decode("ascii")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/stats"):
+                self._send(200, "application/json", json.dumps(stats.snapshot()).encode())
+            elif self.path.startswith("/reset"):
+                stats.reset()
+                self._send(200, "application/json", b"{}")
+            else:
+                self._send(404, "application/json", b"{}")
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            kind = "image" if self.path.startswith("/image") else "chat"
+            stats.begin(kind)
+            try:
+                if kind == "image":
+                    self._image(body)
+                else:
+                    self._chat(body)
+            finally:
+                stats.end()
+
+        def _image(self, body):
+            # Smaller renders (previews) come back proportionally faster
+            scale = (body.get("width", 1024) * body.get("height", 1024)) / (1024 * 1024)
+            time.sleep(options.image_seconds * max(0.1, scale))
+            if body.get("return_binary"):
+                self._send(200, "image/webp", webp)
+            else:
+                self._send(200, "application/json", json.dumps({"images": [image_b64]}).encode())
+
+        def _chat(self, body):
+            with rng_lock:
+                words = make_narration(rng, options.reply_tokens).split(" ")
+                if rng.random() < options.image_rate:
+                    words.append(f"[IMAGE: Studio Ghibli anime style, D&D fantasy art, {make_narration(rng, 10)}]")
+            time.sleep(options.ttft)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            interval = 1 / options.tokens_per_second if options.tokens_per_second > 0 else 0
+            for i, word in enumerate(words):
+                if i and interval:
+                    time.sleep(interval)
+                self._chunk(f"data: {json.dumps({'choices': [{'delta': {'content': word + ' '}}]})}\n\n")
+            if body.get("stream_options", {}).get("include_usage"):
+                prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                         "total_tokens": prompt_tokens + len(words)}
+                self._chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+            self._chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+def add_arguments(parser):
+    parser.add_argument("--ttft", type=float, default=0.4, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    parser.add_argument("--reply-tokens", type=int, default=180, help="words per DM reply")
+    parser.add_argument("--image-rate", type=float, default=0.2, help="share of replies carrying an [IMAGE:] tag")
+    parser.add_argument("--image-seconds", type=float, default=3.0, help="latency of a full 1024px render")
+    parser.add_argument("--seed", type=int, default=99)
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The app drops its upstream connection after [DONE]; resets are expected, not failures
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def serve(options, port=0):
+    """Start the stub on a background thread; returns (server, stats)"""
+    stats = StubStats()
+    server = StubServer(("127.0.0.1", port), make_handler(options, stats, make_webp()))
+    threading.Thread(target=server.serve_forever, name="upstream-stub", daemon=True).start()
+    return server, stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=0)
+    add_arguments(parser)
+    options = parser.parse_args()
+    server, _ = serve(options, options.port)
+    print(f"upstream stub listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
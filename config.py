@@ -7,8 +7,9 @@ load_dotenv(override=True)
 
 # Venice AI Configuration
 VENICE_API_KEY = os.getenv("VENICE_API_KEY")
-VENICE_URL = "https://api.venice.ai/api/v1/chat/completions"
-VENICE_IMAGE_URL = "https://api.venice.ai/api/v1/image/generate"
+# Overridable so load tests and local checks can point at a stub upstream
+VENICE_URL = os.getenv("AIDM_VENICE_URL", "https://api.venice.ai/api/v1/chat/completions")
+VENICE_IMAGE_URL = os.getenv("AIDM_VENICE_IMAGE_URL", "https://api.venice.ai/api/v1/image/generate")
 DEFAULT_MODEL_ID = "venice-uncensored"
 DEFAULT_IMAGE_MODEL_ID = "lustify-sdxl"  # NSFW-focused uncensored model
 
@@ -20,6 +21,160 @@ if not VENICE_API_KEY:
 CHAT_DIR = 'chat_histories'
 MAX_HISTORY_SIZE = 30  # Reduced from 50 to help with token limits
 
+# History storage format - files keep their .json names; the format is detected from the file's first bytes
+HISTORY_COMPRESSION = None  # None (plain JSON), 'gzip' or 'zstd' (needs the optional zstandard package)
+HISTORY_COMPRESSION_LEVEL = None  # None uses the codec default (gzip 6, zstd 3)
+
+# Per-worker cache of parsed history files (validated against file mtime/size on every read)
+HISTORY_CACHE_MAX_ENTRIES = 64
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Budget measured as uncompressed JSON bytes
+
+# Data retention - enforced by the background sweeper in app.py
+HISTORY_RETENTION_HOURS = 24  # Stored histories untouched for this long are deleted (None disables)
+RETENTION_SWEEP_INTERVAL_SECONDS = 300
+RETENTION_SWEEP_BATCH_SIZE = 200  # Files deleted per batch before briefly yielding to request threads
+
+# Ephemeral /chat -> /stream context handoff (client-only mode)
+CLIENT_CONTEXT_TTL_SECONDS = 300  # Tokens not consumed by /stream within this window are dropped
+CLIENT_CONTEXT_MAX_ENTRIES = 2000
+CLIENT_CONTEXT_MAX_BYTES = 64 * 1024 * 1024  # Estimated size budget; least recently stored tokens go first
+# 'memory' only works when /stream lands on the same worker as /chat; use 'sqlite' (one host)
+# or 'redis' (needs the optional redis package) to run several workers without sticky sessions
+CLIENT_CONTEXT_STORE = os.getenv("AIDM_CONTEXT_STORE", "memory")
+CLIENT_CONTEXT_SQLITE_PATH = os.getenv("AIDM_CONTEXT_SQLITE_PATH", os.path.join(CHAT_DIR, '.client_context.sqlite3'))
+CLIENT_CONTEXT_REDIS_URL = os.getenv("AIDM_CONTEXT_REDIS_URL", "redis://localhost:6379/0")
+CLIENT_CONTEXT_MAX_MESSAGES = 200  # Most recent client messages kept as AI context
+ROLLING_CONTEXT_TTL_SECONDS = 30 * 60  # How long a game's synced context waits for the next /chat delta
+
+# Request body limits (bytes). Each request is held to its route's entry, falling back to
+# MAX_REQUEST_BODY_BYTES, while its body is read - chunked bodies without a Content-Length included
+MAX_REQUEST_BODY_BYTES = 16 * 1024 * 1024
+ROUTE_BODY_LIMITS = {
+    "chat": 8 * 1024 * 1024,
+    "import_history": 64 * 1024 * 1024,  # Streamed to disk one message at a time, never held in memory
+    "compress_images": 64 * 1024 * 1024,  # Parsed one image at a time while earlier ones are compressing
+}
+
+# Generated image variants, rendered in a process pool and served by /get_image
+IMAGE_DIR = os.path.join(CHAT_DIR, 'images')  # Originals and variants; same retention and purges as histories
+IMAGE_VARIANT_WIDTHS = [256, 512, 768]  # The original (1024px) is served above the largest width
+IMAGE_VARIANT_FORMATS = ["avif", "webp"]  # AVIF needs a Pillow with AVIF support (e.g. pillow-avif-plugin)
+IMAGE_VARIANT_QUALITY = 75
+IMAGE_PLACEHOLDER_WIDTH = 16  # Tiny blurred preview shown while the real image loads
+IMAGE_PIPELINE_WORKERS = int(os.getenv("AIDM_IMAGE_WORKERS", "2"))  # 0 disables variant rendering
+# Ask Venice for raw image bytes (return_binary) and stream them into IMAGE_DIR: no base64 anywhere,
+# clients only get /get_image references. Those then expire with HISTORY_RETENTION_HOURS.
+IMAGE_BINARY_TRANSFER = os.getenv("AIDM_IMAGE_BINARY", "0") == "1"
+IMAGE_MAX_BYTES = 32 * 1024 * 1024  # Refuse larger upstream bodies rather than filling the disk
+# Near-duplicate images (same tavern, same NPC portrait) share one stored blob. Matching uses a 64-bit
+# perceptual difference hash; distance is the number of differing bits (0 = visually identical).
+# Off by default: a wrong match shows the player a different picture. Only renders of the same prompt are matched.
+IMAGE_DEDUP_ENABLED = os.getenv("AIDM_IMAGE_DEDUP", "0") == "1"
+IMAGE_DEDUP_MAX_DISTANCE = 4
+
+# Progressive images: /stream first pushes a cheap low-step preview, then swaps in the full render.
+# Costs one extra (small) upstream request per image, so it's opt-in and per model. Steps and size
+# are clamped to each model's constraints; models not listed here never preview.
+IMAGE_PREVIEW_ENABLED = os.getenv("AIDM_IMAGE_PREVIEW", "0") == "1"
+IMAGE_PREVIEW_SETTINGS = {
+    "lustify-sdxl": {"steps": 6, "size": 512},
+    "fluently-xl": {"steps": 6, "size": 512},
+    "pony-realism": {"steps": 6, "size": 512},
+    "hidream": {"steps": 8, "size": 512},
+}
+
+# /compress_image and /compress_images re-encode in their own bounded process pool
+IMAGE_COMPRESS_WORKERS = int(os.getenv("AIDM_COMPRESS_WORKERS", "2"))  # 0 compresses inline in the request
+IMAGE_COMPRESS_MAX_PENDING = 16  # Queued + running jobs across all requests; submitters wait beyond this
+IMAGE_COMPRESS_WAIT_SECONDS = 30  # How long a request waits for a free slot before giving up with 503
+IMAGE_COMPRESS_BATCH_MAX_IMAGES = 50
+
+# Sessions are signed with this key, so every worker and every restart must share it or a cookie set by
+# one worker is rejected by the next. Without AIDM_SECRET_KEY a random key is generated once into
+# SECRET_KEY_FILE, which covers every worker on one host; set AIDM_SECRET_KEY when running several hosts.
+# Point AIDM_SECRET_KEY_FILE outside the data directory to keep the key out of data backups and copies
+SECRET_KEY = os.getenv("AIDM_SECRET_KEY")
+SECRET_KEY_FILE = os.getenv("AIDM_SECRET_KEY_FILE", os.path.join(CHAT_DIR, '.secret_key'))
+
+# Live update channel (/subscribe_updates) configuration
+UPDATE_STREAM_KEEPALIVE_SECONDS = 15  # Heartbeat interval; also how often other workers' writes are noticed
+UPDATE_STREAM_MAX_SECONDS = 300  # Close long streams so EventSource reconnects and frees the worker
+
+# Prometheus metrics (/metrics). Each worker snapshots its counters into METRICS_DIR so one scrape
+# covers every worker on the host. Set AIDM_METRICS_TOKEN to require "Authorization: Bearer <token>";
+# without one, only direct (not proxied) requests from localhost are answered, unless AIDM_METRICS_PUBLIC=1.
+METRICS_ENABLED = os.getenv("AIDM_METRICS", "1") == "1"
+METRICS_DIR = os.path.join(CHAT_DIR, '.metrics')
+METRICS_SNAPSHOT_SECONDS = 5  # How stale another worker's numbers can be in a scrape
+METRICS_TOKEN = os.getenv("AIDM_METRICS_TOKEN")
+METRICS_PUBLIC = os.getenv("AIDM_METRICS_PUBLIC", "0") == "1"  # Explicit opt-out of the localhost-only default
+
+# Per-turn timing spans for /stream (history load, prompt build, upstream bytes, images...).
+# Logged as a "stream_turn_timing" INFO event (see LOG_SAMPLE_RATES; needs AIDM_LOG_LEVEL=INFO or lower,
+# which gunicorn.conf.py sets by default); also sent in the final SSE
+# "done" event when enabled here or when the client asks with ?timing=1
+STREAM_TIMING_IN_DONE = os.getenv("AIDM_STREAM_TIMING", "0") == "1"
+
+# Admin endpoints (/admin/*) and the request profiler are disabled unless AIDM_ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("AIDM_ADMIN_TOKEN")
+# Per-request profiler. Send "X-AIDM-Profile: <admin token>" to profile one request (streamed body
+# included), or set AIDM_PROFILE_SAMPLE_RATE to profile a random fraction of requests. Profiles are
+# listed and downloaded from /admin/profiles; the oldest are deleted beyond the file/byte budget
+PROFILE_SAMPLE_RATE = float(os.getenv("AIDM_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MODE = os.getenv("AIDM_PROFILE_MODE", "sample")  # 'sample': folded stacks for flamegraphs; 'cprofile': pstats dump
+PROFILE_INTERVAL_MS = 5  # Stack sampling interval in 'sample' mode
+PROFILE_DIR = os.path.join(CHAT_DIR, '.profiles')
+PROFILE_MAX_FILES = 50
+PROFILE_MAX_BYTES = 50 * 1024 * 1024
+PROFILE_MAX_CONCURRENT = 2  # Per worker; further requests run unprofiled
+
+# Logging. AIDM_LOG_LEVEL (DEBUG, INFO, WARNING...) overrides Flask's default level;
+# AIDM_LOG_FORMAT=json writes one JSON object per line for log shippers instead of plain text
+LOG_LEVEL = os.getenv("AIDM_LOG_LEVEL")
+LOG_FORMAT = os.getenv("AIDM_LOG_FORMAT", "text")
+# Fraction of each structured hot-path event that is written (events not listed are always written).
+# Sampled-out events cost nothing: their fields are never computed
+LOG_SAMPLE_RATES = {
+    "stream_turn_timing": 1.0,
+    "api_payload_built": 0.1,
+    "upstream_response": 0.1,
+    "upstream_body": 0.01,  # Full non-streaming replies - large
+    "image_response": 0.01,  # Image API replies carry base64 images - very large
+    "update_messages": 0.05,
+}
+
+# Usage accounting and /stream admission control. Each turn's input and output tokens (the upstream's
+# usage block when it sends one, otherwise estimates) are priced with AVAILABLE_MODELS "pricing" (USD per million tokens) and kept per user
+# and globally in one-minute buckets. AIDM_USAGE_STORE=sqlite shares the ledger between the workers
+# on one host (in-flight reservations and the upstream stream cap stay per worker). Limits of 0 are off.
+USAGE_STORE = os.getenv("AIDM_USAGE_STORE", "memory")
+USAGE_SQLITE_PATH = os.getenv("AIDM_USAGE_SQLITE_PATH", os.path.join(CHAT_DIR, '.usage.sqlite3'))
+USAGE_RETENTION_SECONDS = 24 * 3600  # Longest budget window
+# Budgets: a stream that would exceed one is shed at once, since waiting would not help
+USER_TOKEN_BUDGET_PER_HOUR = int(os.getenv("AIDM_USER_TOKENS_PER_HOUR", "0"))
+USER_COST_BUDGET_PER_DAY = float(os.getenv("AIDM_USER_COST_PER_DAY", "0"))
+GLOBAL_COST_BUDGET_PER_DAY = float(os.getenv("AIDM_GLOBAL_COST_PER_DAY", "0"))
+# Upstream rate: a stream that would exceed one waits in the admission queue instead
+UPSTREAM_MAX_STREAMS = int(os.getenv("AIDM_UPSTREAM_MAX_STREAMS", "0"))  # Concurrent upstream calls per worker
+UPSTREAM_TOKENS_PER_MINUTE = int(os.getenv("AIDM_UPSTREAM_TOKENS_PER_MINUTE", "0"))
+ADMISSION_OUTPUT_TOKEN_ESTIMATE = 1000  # Reserved per admitted stream until its real output is counted
+ADMISSION_MAX_WAIT_SECONDS = 20  # Queued streams are shed after this long (the client gives up at 30s)
+ADMISSION_MAX_QUEUED = 32  # Per worker; arrivals beyond this are shed at once
+ADMISSION_HEARTBEAT_SECONDS = 5  # How often a queued stream is told its place in line and ETA
+
+# Concurrency caps for slow work: /stream turns (images included) and /generate_image calls, per worker.
+# Jobs beyond a cap wait in a fair queue that takes turns across users, weighted by each kind's typical
+# duration, so one user's many tabs or repeated sends cannot hold every worker thread. 0 disables a cap
+JOBS_MAX_ACTIVE = int(os.getenv("AIDM_MAX_ACTIVE_JOBS", "16"))
+JOBS_MAX_PER_USER = int(os.getenv("AIDM_MAX_JOBS_PER_USER", "2"))
+# Per table, off by default: players at one table each send their own turns, so a cap of 1 would make
+# them wait on each other. Set it (e.g. 3) to stop one busy table crowding out the others on a worker
+JOBS_MAX_PER_GAME = int(os.getenv("AIDM_MAX_JOBS_PER_GAME", "0"))
+JOBS_MAX_QUEUED = 64
+JOBS_MAX_QUEUED_PER_USER = 4  # Further jobs from the same user are refused instead of queued
+JOBS_MAX_WAIT_SECONDS = 90
+JOBS_DEFAULT_SECONDS = {"stream": 15, "image": 20}  # Starting duration estimates for queue weights and ETAs
+
 # Available AI models from Venice - Updated with actual capabilities
 AVAILABLE_MODELS = [
     {
@@ -0,0 +1,78 @@
+"""
+Production gunicorn settings: gunicorn -c gunicorn.conf.py wsgi:app
+
+/stream and /subscribe_updates hold their request open for seconds to minutes, so the default worker
+is gthread: an open stream costs one thread, not a whole process, and the worker timeout is a
+heartbeat that long streams don't trip. 'sync' would let a handful of streams block every worker.
+The app is preloaded (imported once, then forked), so workers share its memory and one secret key.
+On SIGTERM (deploy, scale-down) each worker drains: it stops accepting, ends /subscribe_updates
+streams so clients reconnect elsewhere, and lets turns in flight finish within graceful_timeout.
+
+Every setting reads an AIDM_* environment variable; gunicorn's own flags still override this file.
+/chat and /stream may land on different workers, and budgets must count every worker's usage, so with
+more than one worker the context store and usage ledger default to sqlite, and the server refuses to
+start if AIDM_CONTEXT_STORE or AIDM_USAGE_STORE names a per-process store.
+"""
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+bind = os.getenv("AIDM_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+worker_class = os.getenv("AIDM_WORKER_CLASS", "gthread")
+workers = int(os.getenv("AIDM_WORKERS", str(min(4, multiprocessing.cpu_count()))))
+threads = int(os.getenv("AIDM_THREADS", "32"))  # gthread: concurrent requests (open streams) per worker
+worker_connections = int(os.getenv("AIDM_WORKER_CONNECTIONS", "1000"))  # gevent/eventlet only
+preload_app = os.getenv("AIDM_PRELOAD", "1") == "1"
+timeout = 120  # Heartbeat for gthread; for sync workers this would also cap a whole streamed turn
+graceful_timeout = int(os.getenv("AIDM_GRACEFUL_TIMEOUT", "150"))  # One turn: 60s upstream + 60s image + margin
+keepalive = 5
+accesslog = os.getenv("AIDM_ACCESS_LOG")  # "-" for stdout
+errorlog = "-"
+loglevel = os.getenv("AIDM_GUNICORN_LOG_LEVEL", "info")
+# Flask's logger otherwise inherits WARNING and drops the sampled INFO events (stream_turn_timing)
+os.environ.setdefault("AIDM_LOG_LEVEL", "INFO")
+
+if workers > 1:
+    # Read when the app is imported, which happens after this file
+    os.environ.setdefault("AIDM_CONTEXT_STORE", "sqlite")
+    os.environ.setdefault("AIDM_USAGE_STORE", "sqlite")
+
+_launched = time.monotonic()  # This file is read before the app is preloaded
+
+def on_starting(server):
+    from config import CLIENT_CONTEXT_STORE, USAGE_STORE
+
+    # Also catches -w/--workers on the command line, which this file's default can't see
+    if server.cfg.workers > 1 and CLIENT_CONTEXT_STORE not in ("sqlite", "redis"):
+        server.log.error("AIDM_CONTEXT_STORE=%s keeps each worker's /chat context to itself, so /stream and the "
+                         "rolling context hash break across %d workers. Use sqlite or redis, or run one worker.",
+                         CLIENT_CONTEXT_STORE, server.cfg.workers)
+        sys.exit(1)
+    if server.cfg.workers > 1 and USAGE_STORE != "sqlite":
+        server.log.error("AIDM_USAGE_STORE=%s counts usage per worker, so every token and cost budget would be "
+                         "multiplied by %d workers. Use sqlite, or run one worker.", USAGE_STORE, server.cfg.workers)
+        sys.exit(1)
+    if server.cfg.worker_class_str == "sync":
+        server.log.warning("sync workers serve one request at a time: each open /stream or "
+                           "/subscribe_updates blocks a whole worker. Use gthread for production.")
+
+def when_ready(server):
+    server.log.info("AIDM master ready %.2fs after launch (%s x %d workers, preload=%s)", time.monotonic() - _launched,
+                    server.cfg.worker_class_str, server.cfg.workers, server.cfg.preload_app)
+
+def post_worker_init(worker):
+    """Run the app's drain step before gunicorn's own graceful-exit handler"""
+    from app import begin_drain
+
+    graceful_exit = signal.getsignal(signal.SIGTERM)
+
+    def drain_and_exit(signum, frame):
+        begin_drain()
+        if callable(graceful_exit):
+            graceful_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_and_exit)
+    signal.siginterrupt(signal.SIGTERM, False)  # signal.signal() made it interrupt blocking calls again
+    worker.log.info("Worker %s serving %.2fs after launch", worker.pid, time.monotonic() - _launched)
@@ -0,0 +1,105 @@
+"""
+CPU-heavy image work run in app.py's spawned WorkerPool processes.
+
+A spawned worker unpickles a submitted function by importing its module, so these live apart from
+app.py: importing this module creates no Flask app, stores, threads or files, and Pillow is only
+imported on first use. Keep it that way - this module is imported once per pool process.
+"""
+import io
+import os
+import tempfile
+
+def save_image_atomic(image, file_path, image_format, **options):
+    """Encode a PIL image to a temp file and rename it into place, so half-written variants are never served"""
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(file_path))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            image.save(tmp_file, format=image_format, **options)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def render_image_variants(original_path, widths, formats, quality, placeholder_width):
+    """
+    Process-pool worker: write downscaled variants and a blurred placeholder next to the original.
+    Variant names are <original>_w<width>.<format> and <original>_placeholder.webp.
+    """
+    from PIL import Image, ImageFilter
+    
+    base = os.path.splitext(original_path)[0]
+    produced = []
+    with Image.open(original_path) as image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        
+        for width in widths:
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            for image_format in formats:
+                variant_path = f"{base}_w{width}.{image_format}"
+                save_image_atomic(resized, variant_path, image_format.upper(), quality=quality)
+                produced.append(os.path.basename(variant_path))
+        
+        height = max(1, round(image.height * placeholder_width / image.width))
+        placeholder = image.resize((placeholder_width, height), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+        save_image_atomic(placeholder, f"{base}_placeholder.webp", 'WEBP', quality=30)
+        produced.append(os.path.basename(f"{base}_placeholder.webp"))
+    return produced
+
+def compress_image_bytes(image_bytes, image_format='jpeg', quality=70, target_bytes=None, max_width=None):
+    """
+    Process-pool worker: re-encode one image as JPEG or WebP.
+    With target_bytes, picks the highest quality (down to 10) whose output fits,
+    shrinking the image by 25% steps when even that is too big.
+    """
+    from PIL import Image
+    
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    if max_width and image.width > max_width:
+        image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.LANCZOS)
+    
+    if image_format == 'jpeg':
+        # Convert to RGB if necessary (for JPEG compression)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')  # WebP keeps transparency
+    
+    def encode(candidate, candidate_quality):
+        output_buffer = io.BytesIO()
+        if image_format == 'jpeg':
+            candidate.save(output_buffer, format='JPEG', quality=candidate_quality, optimize=True)
+        else:
+            candidate.save(output_buffer, format='WEBP', quality=candidate_quality, method=4)
+        return output_buffer.getvalue()
+    
+    if not target_bytes:
+        return encode(image, quality)
+    
+    for _ in range(4):
+        best = None
+        low, high = 10, quality
+        while low <= high:
+            middle = (low + high) // 2
+            encoded = encode(image, middle)
+            if len(encoded) <= target_bytes:
+                best, low = encoded, middle + 1
+            else:
+                high = middle - 1
+        if best is not None:
+            return best
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+    return encode(image, 10)  # Smallest we'll go; the caller sees it still misses the target
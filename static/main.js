@@ -37,6 +37,8 @@ document.addEventListener('DOMContentLoaded', function() {
     const MAX_HISTORY_SIZE = 50;
     // Flag to prevent welcome message while loading history
     let isLoadingHistory = false;
+    // Incremental /chat sync: what the server's rolling context already holds for this game
+    let contextSync = null;
     
     // Helper function to get cookie value
     function getCookie(name) {
@@ -510,13 +512,20 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.warn("Base64 data appears to be too short or invalid");
             }
         }        // If we have a base64 image URL, create the image display
-        if (imageUrl && imageUrl.length > 50 && imageUrl.startsWith('data:image/')) {
+        // Binary image mode sends only a /get_image reference instead of a base64 data URL
+        const isImageReference = imageUrl && imageUrl.startsWith('/get_image/');
+        if (imageUrl && ((imageUrl.length > 50 && imageUrl.startsWith('data:image/')) || isImageReference)) {
+            // Server-rendered smaller variants let phones skip decoding the full 1024px image;
+            // if the server no longer has them (retention, client-only purge) drop back to the inline copy
+            const variantAttrs = message.image_srcset
+                ? `srcset="${message.image_srcset}" sizes="(max-width: 600px) 100vw, 600px"`
+                : '';
             contentSpan.innerHTML = `
                 <div class="image-message">
-                    <img src="${imageUrl}" alt="${imagePrompt}" 
+                    <img src="${imageUrl}" ${variantAttrs} alt="${imagePrompt}" 
                          style="max-width: 100%; border-radius: 8px; margin: 10px 0; display: block; background-color: #f0f0f0;" 
                          onload="console.log('Image loaded successfully:', this.alt); this.style.backgroundColor = 'transparent'; if(this.closest('#chat-window')) this.closest('#chat-window').scrollTop = this.closest('#chat-window').scrollHeight;"
-                         onerror="console.error('Image failed to load:', this.alt, this.src.substring(0, 50)); this.style.backgroundColor = '#ffebee'; this.alt = 'Image failed to load';">
+                         onerror="if (this.hasAttribute('srcset')) { this.removeAttribute('srcset'); return; } console.error('Image failed to load:', this.alt, this.src.substring(0, 50)); this.style.backgroundColor = '#ffebee'; this.alt = 'Image failed to load';">
                     <div class="image-caption">
                         <em>Generated image: ${imagePrompt}</em>
                     </div>
@@ -1286,6 +1295,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (msg.message_type === "image" || 
                 (msg.images && msg.images.length > 0 && msg.images[0] && msg.images[0].length > 50) || 
                 (msg.image_url && msg.image_url.length > 50 && msg.image_url.startsWith('data:image/')) ||
+                (msg.image_url && msg.image_url.startsWith('/get_image/')) ||
                 (msg.content && msg.content.includes('Generated image:')) ||
                 (msg.content && msg.content.includes('<img src="data:image/')) ||
                 (msg.text && msg.text && typeof msg.text === 'string' && msg.role === 'assistant' && 
@@ -1552,27 +1562,13 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Build recent history for context (limit to last 150 messages to keep payload reasonable)
         const fullLocal = Utils.loadChatHistory(currentGameId) || [];
-        const clientHistoryForServer = fullLocal.slice(-150).map(m => ({
-            role: m.role || (m.type === 'dm' ? 'assistant' : (m.type === 'system' ? 'system' : 'user')),
-            content: m.content || m.text || '',
-            player: m.player || (m.role === 'user' ? (m.player || undefined) : undefined)
-        }));
 
-        fetch('/chat', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({
-                message: userMessage,
-                game_id: currentGameId,
-                player_number: playerNumber,
-                player_names: playerContext,
-                client_history: clientHistoryForServer
-            })
-        })
-        .then(response => {
-            if (!response.ok) throw new Error(`Server error: ${response.status}`);
-            return response.json();
-        })
+        postChatWithContext({
+            message: userMessage,
+            game_id: currentGameId,
+            player_number: playerNumber,
+            player_names: playerContext
+        }, fullLocal)
         .then(data => {
             if (data && data.message_id) {
                 sendStreamRequest(data.message_id, loadingDiv);
@@ -1603,6 +1599,69 @@ document.addEventListener('DOMContentLoaded', function() {
         inputElement.focus();
     }
     
+    function toServerContextMessage(m) {
+        let content = m.content || m.text || '';
+        // The AI only needs to know an image was shown; never upload the base64 payload as context
+        if (m.message_type === 'image' || (typeof content === 'string' && content.includes('data:image/'))) {
+            const prompt = (m.image_prompt || '').trim().substring(0, 200);
+            content = prompt ? `[image: ${prompt}]` : '[image]';
+        }
+        return {
+            role: m.role || (m.type === 'dm' ? 'assistant' : (m.type === 'system' ? 'system' : 'user')),
+            content: content,
+            player: m.player || (m.role === 'user' ? (m.player || undefined) : undefined)
+        };
+    }
+
+    function contextSyncKey(m) {
+        const entry = toServerContextMessage(m);
+        return `${entry.role}|${entry.player || ''}|${entry.content}`;
+    }
+
+    /**
+     * POST /chat sending only the messages added since the last sync when the server
+     * still holds our rolling context; falls back to the full recent history otherwise.
+     */
+    function postChatWithContext(body, fullLocal, forceFull = false) {
+        const canSendDelta = !forceFull && contextSync &&
+            contextSync.gameId === currentGameId &&
+            contextSync.count > 0 && contextSync.count <= fullLocal.length &&
+            contextSyncKey(fullLocal[contextSync.count - 1]) === contextSync.lastKey;
+
+        const payload = { ...body };
+        if (canSendDelta) {
+            payload.base_hash = contextSync.hash;
+            payload.client_history_delta = fullLocal.slice(contextSync.count).map(toServerContextMessage);
+        } else {
+            payload.client_history = fullLocal.slice(-150).map(toServerContextMessage);
+        }
+
+        return fetch('/chat', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(payload)
+        })
+        .then(response => {
+            if (response.status === 409 && canSendDelta) {
+                debugLog("Server context out of sync, resending full history");
+                contextSync = null;
+                return postChatWithContext(body, fullLocal, true);
+            }
+            if (!response.ok) throw new Error(`Server error: ${response.status}`);
+            return response.json().then(data => {
+                if (data && data.context_hash && fullLocal.length > 0) {
+                    contextSync = {
+                        gameId: currentGameId,
+                        hash: data.context_hash,
+                        count: fullLocal.length,
+                        lastKey: contextSyncKey(fullLocal[fullLocal.length - 1])
+                    };
+                }
+                return data;
+            });
+        });
+    }
+
     /**
      * Check if a player has sent any messages
      * @param {number} playerNumber - The player number to check
@@ -1667,7 +1726,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
         const eventSource = new EventSource(eventSourceUrl.toString());
         
-        let responseTimeout = setTimeout(() => {
+        const onResponseTimeout = () => {
             debugLog("Response timeout - closing connection for messageId:", messageId);
             if (eventSource) eventSource.close(); 
             const responseTextElem = loadingDiv.querySelector('[id^="response-text"]');
@@ -1683,7 +1742,8 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             debugLog("Setting isGenerating = false (sendStreamRequest - timeout)");
             isGenerating = false;
-        }, 30000); // 30 seconds timeout
+        };
+        let responseTimeout = setTimeout(onResponseTimeout, 30000); // 30 seconds timeout
         
         eventSource.onopen = function(e) {
             debugLog("EventSource connection opened for messageId:", messageId);
@@ -1711,9 +1771,27 @@ document.addEventListener('DOMContentLoaded', function() {
                     isGenerating = false;
                 }, 30000);                debugLog("Received message chunk for messageId:", messageId, "Data:", event.data.substring(0, 50) + "...");
                 const data = JSON.parse(event.data);                // Handle image generation messages
+                if (data.image_preview) {
+                    // Quick low-step render; replaced when the full image arrives, never saved
+                    const previewDiv = document.createElement('div');
+                    previewDiv.className = 'message dm-message image-message-container';
+                    previewDiv.id = `image-preview-${data.image_id}`;
+                    previewDiv.innerHTML = `
+                        <span class="message-sender">${dmName}: </span>
+                        <span class="message-content">
+                            <div class="image-message">
+                                <img src="${data.preview_url}" alt="${data.image_prompt}" style="max-width: 100%; border-radius: 8px; margin: 10px 0; display: block; filter: blur(2px);">
+                                <div class="image-caption"><em>Rendering image: ${data.image_prompt}...</em></div>
+                            </div>
+                        </span>`;
+                    chatWindow.appendChild(previewDiv);
+                    scrollToBottom();
+                    return;
+                }
                 if (data.image_generated) {
                     console.log("=== RECEIVED IMAGE FROM STREAM ===");
                     console.log("Image message:", data.image_message);
+                    document.getElementById(`image-preview-${data.image_message.image_reference}`)?.remove();
                     
                     // Ensure the image message has the correct format for localStorage
                     const formattedImageMessage = {
@@ -1794,6 +1872,24 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         };
         
+        // Sent while the server holds this turn in a queue: waiting for a job slot or for upstream capacity
+        eventSource.addEventListener('queued', function(event) {
+            clearTimeout(responseTimeout);
+            responseTimeout = setTimeout(onResponseTimeout, 30000);
+            try {
+                const queued = JSON.parse(event.data);
+                debugLog("Turn queued for messageId:", messageId, "stage:", queued.stage, "position:", queued.position,
+                         "eta:", queued.eta, "waited:", queued.waited);
+                const responseTextElem = loadingDiv.querySelector('[id^="response-text"]');
+                if (responseTextElem && !fullResponseText) {
+                    const eta = queued.eta ? ` (about ${Math.max(1, Math.round(queued.eta))}s)` : '';
+                    responseTextElem.innerHTML = `<em style="color: #6272a4; font-style: italic;">🚦 The Dungeon Master is busy, you are #${queued.position} in line${eta}...</em><span class="cursor"></span>`;
+                }
+            } catch (e) {
+                debugLog("Could not parse queued event data:", e);
+            }
+        });
+        
         eventSource.addEventListener('done', function(event) {
             console.log("=== STREAM DONE EVENT FIRED ===");
             console.log("messageId:", messageId, "Event data:", event.data);
@@ -1802,6 +1898,15 @@ document.addEventListener('DOMContentLoaded', function() {
             
             debugLog("Stream complete for messageId:", messageId, "Event data:", event.data);
             clearTimeout(responseTimeout);
+            try {
+                // Server-side stage timings for this turn, present when the server sends them
+                const doneData = event.data ? JSON.parse(event.data) : {};
+                if (doneData.timing) {
+                    debugLog("Turn timing (ms):", doneData.timing.total_ms, doneData.timing.spans);
+                }
+            } catch (e) {
+                debugLog("Could not parse done event data:", e);
+            }
             
             const responseTextElem = loadingDiv.querySelector('[id^="response-text"]');
             if (responseTextElem) {
@@ -1924,7 +2029,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const images = Array.from(imageElements).map(img => {
                     console.log("Found image in message:", img.src.substring(0, 50) + "...");
                     return img.src;
-                }).filter(src => src && src.startsWith('data:image/')); // Only keep base64 data URLs
+                }).filter(src => src && (src.startsWith('data:image/') || src.includes('/get_image/'))); // Base64 data URLs or server image references
                 
                 console.log(`Message from ${senderText}: found ${images.length} images`);
                 
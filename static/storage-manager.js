@@ -147,6 +147,85 @@ class StorageManager {
         });
     }
 
+    // Shrink every inline image in a stored game with one /compress_images round trip.
+    // Results stream back as NDJSON and are applied as they arrive.
+    async compressArchive(gameId, options = {}) {
+        const chatHistory = this.loadFromLocalStorage(gameId);
+        const images = [];
+        chatHistory.forEach((message, index) => {
+            if (message.image_url && message.image_url.startsWith('data:image/')) {
+                images.push({ id: index, image_data: message.image_url });
+            }
+        });
+        if (images.length === 0) {
+            return { compressed: 0, savedBytes: 0 };
+        }
+
+        const response = await fetch('/compress_images', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            // Options go before the images so the server can start compressing while it reads
+            body: JSON.stringify({
+                format: options.format || 'webp',
+                quality: options.quality || this.compressionQuality,
+                target_bytes: options.targetBytes || null,
+                images: images
+            })
+        });
+        if (!response.ok || !response.body) {
+            throw new Error(`Image compression failed: ${response.status}`);
+        }
+
+        let compressed = 0;
+        let savedBytes = 0;
+        const applyResult = (line) => {
+            if (!line.trim()) return;
+            const result = JSON.parse(line);
+            if (result.done || !result.success) return;
+            if (result.compressed_size_bytes >= result.original_size_bytes) return; // No gain, keep original
+
+            const message = chatHistory[result.id];
+            const original = message.image_url;
+            message.image_url = result.compressed_image;
+            if (message.content && message.content.includes(original)) {
+                message.content = message.content.split(original).join(result.compressed_image);
+            }
+            if (Array.isArray(message.images)) {
+                message.images = message.images.map(url => url === original ? result.compressed_image : url);
+            }
+            compressed++;
+            savedBytes += result.original_size_bytes - result.compressed_size_bytes;
+        };
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.forEach(applyResult);
+        }
+        applyResult(buffer);
+
+        this.saveToLocalStorage(gameId, chatHistory);
+        this.showNotification(`Compressed ${compressed} images, saved ${(savedBytes / 1024).toFixed(0)}KB`, 'success');
+        return { compressed, savedBytes };
+    }
+
+    // Compress images from the storage options dialog
+    async compressAndSave(gameId) {
+        document.getElementById('storage-options')?.remove();
+        try {
+            await this.compressArchive(gameId);
+        } catch (error) {
+            console.error('Error compressing images:', error);
+            this.showNotification('Could not compress images. Try cleaning up old messages.', 'error');
+        }
+    }
+
     // Generate unique image ID
     generateImageId(imageUrl) {
         const hash = this.simpleHash(imageUrl);
@@ -209,6 +288,10 @@ class StorageManager {
                 <h3>Storage Limit Reached</h3>
                 <p>Your chat history is too large for browser storage. Choose an option:</p>
                 <div style="margin: 16px 0;">
+                    <button onclick="storageManager.compressAndSave('${gameId}')" 
+                            style="display: block; width: 100%; margin: 8px 0; padding: 10px; background: #9C27B0; color: white; border: none; border-radius: 6px; cursor: pointer;">
+                        Compress Images
+                    </button>
                     <button onclick="storageManager.cleanupAndSave('${gameId}')" 
                             style="display: block; width: 100%; margin: 8px 0; padding: 10px; background: #4CAF50; color: white; border: none; border-radius: 6px; cursor: pointer;">
                         Clean Up Old Messages
@@ -0,0 +1,10 @@
+"""Test setup: app.py needs an API key at import and keeps its data under the working directory"""
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+os.environ.setdefault("VENICE_API_KEY", "test-key")
+os.chdir(tempfile.mkdtemp(prefix="aidm-tests-"))  # chat_histories/ and images/ land here, not in the repo
@@ -0,0 +1,137 @@
+"""Shared context stores: a token handed off by one worker is consumed exactly once by any other"""
+import threading
+
+import pytest
+
+import app as aidm
+
+def make_messages():
+    return [aidm.ContextMessage.from_dict({"role": "user", "content": "I open the <b>door</b>", "player": "player2"}),
+            aidm.ContextMessage.from_dict({"role": "assistant", "content": "A draft howls through."})]
+
+def states(messages):
+    return [msg.to_state() for msg in messages]
+
+def pop_from_threads(store, token, count=8):
+    """Pop one token from several threads at once (each with its own connection); returns every result"""
+    start = threading.Barrier(count)
+    results = []
+
+    def pop():
+        start.wait()
+        results.append(store.pop(token))
+
+    threads = [threading.Thread(target=pop) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / "context.sqlite3")
+
+def test_sqlite_put_on_one_connection_pop_on_another(sqlite_path):
+    writer = aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6)
+    reader = aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6)  # As another worker process would open it
+    writer.put("token-1", make_messages())
+
+    popped = reader.pop("token-1")
+    assert states(popped) == states(make_messages())
+    assert popped[0].api_text == "I open the door" and popped[0].player_label == "2"
+    assert reader.stats()["consumed"] == 1
+
+def test_sqlite_second_pop_returns_nothing(sqlite_path):
+    store = aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6)
+    store.put("token-1", make_messages())
+
+    assert store.pop("token-1") is not None
+    assert store.pop("token-1") is None
+    assert aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6).pop("token-1") is None
+    assert store.stats()["entries"] == 0
+
+def test_sqlite_concurrent_pops_consume_once(sqlite_path):
+    store = aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6)
+    store.put("token-1", make_messages())
+
+    results = pop_from_threads(store, "token-1")
+    assert sum(result is not None for result in results) == 1
+
+def test_sqlite_expired_token_is_not_returned(sqlite_path, monkeypatch):
+    store = aidm.SQLiteContextStore(sqlite_path, 60, 100, 10 ** 6)
+    now = aidm.time.time()
+    monkeypatch.setattr(aidm.time, "time", lambda: now)
+    store.put("token-1", make_messages())
+    store.put("token-2", make_messages())
+
+    monkeypatch.setattr(aidm.time, "time", lambda: now + 61)
+    assert store.pop("token-1") is None
+    assert store.stats()["expirations"] == 1
+    store.put("token-3", make_messages())  # Each put sweeps out whatever else has expired
+    assert store.stats()["entries"] == 1
+    assert store.stats()["expirations"] == 2
+
+class FakeRedis:
+    """
+    Just enough of a Redis client for RedisContextStore: SET with EX, and MULTI pipelines
+    whose queued commands run together under one lock, as a Redis transaction would.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.lock = threading.Lock()
+        self.transactions = 0
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.data[key] = value
+            self.ttls[key] = ex
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self, transaction)
+
+class FakePipeline:
+    def __init__(self, client, transaction):
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append(lambda data: data.get(key))
+
+    def delete(self, key):
+        self.commands.append(lambda data: int(data.pop(key, None) is not None))
+
+    def execute(self):
+        assert self.transaction, "pop must use a MULTI/EXEC pipeline"
+        with self.client.lock:
+            self.client.transactions += 1
+            return [command(self.client.data) for command in self.commands]
+
+def test_redis_pop_gets_and_deletes_in_one_transaction():
+    client = FakeRedis()
+    store = aidm.RedisContextStore(None, 60, client=client)
+    store.put("token-1", make_messages())
+    assert client.ttls == {"aidm:context:token-1": 60}
+
+    assert states(store.pop("token-1")) == states(make_messages())
+    assert client.transactions == 1
+    assert client.data == {}
+
+def test_redis_second_pop_is_a_miss():
+    store = aidm.RedisContextStore(None, 60, client=FakeRedis())
+    store.put("token-1", make_messages())
+
+    assert store.pop("token-1") is not None
+    assert store.pop("token-1") is None
+    assert store.stats()["consumed"] == 1
+    assert store.stats()["misses"] == 1
+
+def test_redis_concurrent_pops_consume_once():
+    store = aidm.RedisContextStore(None, 60, client=FakeRedis())
+    store.put("token-1", make_messages())
+
+    results = pop_from_threads(store, "token-1")
+    assert sum(result is not None for result in results) == 1
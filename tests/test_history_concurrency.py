@@ -0,0 +1,53 @@
+"""Concurrent appends to one stored history: none may be lost, duplicated or reordered"""
+import os
+import queue
+import threading
+import multiprocessing
+
+import pytest
+
+import app as aidm
+from benchmarks.history_concurrency import USER_ID, GAME_ID, run_writer, check_history
+
+THREADS = 4
+APPENDS = 5
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    # chat_histories/ is relative to the working directory, which spawned writers inherit
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(aidm.HISTORY_LOCK_DIR)  # The app creates these at import, in the directory it started in
+    return tmp_path
+
+def stored_history():
+    return aidm.read_history_file(aidm.get_chat_file_path(USER_ID, GAME_ID))
+
+def test_threads_in_one_process_lose_no_appends(history_dir):
+    start = threading.Event()
+    results = queue.Queue()
+    start.set()
+    run_writer(0, THREADS, APPENDS, False, start, results)
+
+    writers = [f"0-{t}" for t in range(THREADS)]
+    assert check_history(stored_history(), writers, APPENDS) == []
+    assert len(stored_history()) == THREADS * APPENDS
+
+def test_threads_in_several_processes_lose_no_appends(history_dir):
+    processes_count = 3
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=run_writer, args=(i, THREADS, APPENDS, False, start, results))
+                 for i in range(processes_count)]
+    for process in processes:
+        process.start()
+    start.set()
+    for _ in processes:
+        results.get(timeout=120)
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    writers = [f"{p}-{t}" for p in range(processes_count) for t in range(THREADS)]
+    assert check_history(stored_history(), writers, APPENDS) == []
+    assert len(stored_history()) == processes_count * THREADS * APPENDS
@@ -0,0 +1,99 @@
+"""fetch_image_binary against a local stand-in for the Venice image endpoint"""
+import io
+import os
+import json
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import app as aidm
+
+USER_ID = "user-1"
+PAYLOAD = {"model": "test-model", "prompt": "a blue dragon", "width": 64, "height": 64}
+
+def encode_image(image_format):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (9, 80, 200)).save(buffer, image_format)
+    return buffer.getvalue()
+
+class ImageUpstream(ThreadingHTTPServer):
+    """Answers every POST with the configured (status, content type, body, declared length)"""
+    daemon_threads = True
+    reply = (200, "image/webp", b"", None)
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.requests.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+        status, content_type, body, declared_length = self.server.reply
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(declared_length if declared_length is not None else len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    server = ImageUpstream(("127.0.0.1", 0), ImageHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(aidm, "VENICE_IMAGE_URL", f"http://127.0.0.1:{server.server_address[1]}/image")
+    monkeypatch.setattr(aidm, "IMAGE_DIR", str(tmp_path))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def stored_files(directory):
+    return sorted(os.listdir(directory))
+
+def test_binary_body_is_streamed_into_the_store(upstream):
+    webp = encode_image("WEBP")
+    upstream.reply = (200, "image/webp", webp, None)
+
+    assert aidm.fetch_image_binary(PAYLOAD, USER_ID, "img1") == "/get_image/img1"
+    assert upstream.requests[0]["return_binary"] is True
+    with open(os.path.join(aidm.IMAGE_DIR, f"{USER_ID}_img1.webp"), "rb") as stored:
+        assert stored.read() == webp
+
+def test_json_base64_body_is_decoded_into_the_store(upstream):
+    png = encode_image("PNG")
+    body = json.dumps({"images": [base64.b64encode(png).decode("ascii")]}).encode()
+    upstream.reply = (200, "application/json", body, None)
+
+    assert aidm.fetch_image_binary(PAYLOAD, USER_ID, "img2") == "/get_image/img2"
+    with open(os.path.join(aidm.IMAGE_DIR, f"{USER_ID}_img2.png"), "rb") as stored:
+        assert stored.read() == png
+
+def test_json_body_without_an_image_is_rejected(upstream):
+    upstream.reply = (200, "application/json", json.dumps({"images": []}).encode(), None)
+
+    with pytest.raises(Exception, match="Invalid response"):
+        aidm.fetch_image_binary(PAYLOAD, USER_ID, "img3")
+    assert stored_files(aidm.IMAGE_DIR) == []
+
+def test_truncated_body_leaves_nothing_behind(upstream):
+    webp = encode_image("WEBP")
+    upstream.reply = (200, "image/webp", webp[:len(webp) // 2], len(webp))
+
+    with pytest.raises(Exception):
+        aidm.fetch_image_binary(PAYLOAD, USER_ID, "img4")
+    assert stored_files(aidm.IMAGE_DIR) == []  # Including the .tmp_ file it was streaming into
+
+def test_non_image_body_is_rejected(upstream):
+    upstream.reply = (200, "text/html", b"<html><body>Bad gateway</body></html>" * 10, None)
+
+    with pytest.raises(ValueError, match="Not an image"):
+        aidm.fetch_image_binary(PAYLOAD, USER_ID, "img5")
+    assert stored_files(aidm.IMAGE_DIR) == []
+
+def test_error_status_is_raised(upstream):
+    upstream.reply = (500, "application/json", b'{"error": "overloaded"}', None)
+
+    with pytest.raises(Exception, match="500"):
+        aidm.fetch_image_binary(PAYLOAD, USER_ID, "img6")
+    assert stored_files(aidm.IMAGE_DIR) == []
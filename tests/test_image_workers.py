@@ -0,0 +1,44 @@
+"""Process-pool image workers: they must run in spawned processes without importing the app"""
+import io
+import os
+import sys
+import subprocess
+
+from PIL import Image
+
+import app as aidm
+import image_workers
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_worker_module_imports_without_the_app():
+    # What a spawned pool process does to unpickle a submitted function
+    check = "import sys, image_workers; print(sorted({'app', 'flask', 'PIL'} & set(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", check], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
+
+def test_pool_functions_come_from_the_worker_module():
+    assert aidm.compress_image_bytes.__module__ == "image_workers"
+    assert aidm.render_image_variants.__module__ == "image_workers"
+
+def test_compress_in_a_spawned_pool(tmp_path):
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), (200, 40, 40)).save(buffer, "PNG")
+    pool = aidm.WorkerPool("test-compress", 1, max_pending=2)
+    try:
+        compressed = pool.submit(image_workers.compress_image_bytes, buffer.getvalue(), "webp", 60, None, 200).result(60)
+    finally:
+        pool._executor.shutdown()
+    with Image.open(io.BytesIO(compressed)) as image:
+        assert (image.format, image.size) == ("WEBP", (200, 150))
+
+def test_render_variants_in_a_spawned_pool(tmp_path):
+    original = tmp_path / "user_abc.png"
+    Image.new("RGB", (1024, 1024), (10, 90, 160)).save(original)
+    pool = aidm.WorkerPool("test-variants", 1, max_pending=2)
+    try:
+        produced = pool.submit(image_workers.render_image_variants, str(original), [256], ["webp"], 70, 16).result(60)
+    finally:
+        pool._executor.shutdown()
+    assert sorted(produced) == ["user_abc_placeholder.webp", "user_abc_w256.webp"]
+    assert sorted(os.listdir(tmp_path)) == ["user_abc.png", "user_abc_placeholder.webp", "user_abc_w256.webp"]